@@ -1,6 +1,7 @@
 from .components import (
 	DRYP_ABM_connector,
 	DRYP_Gen_Func,
+	DRYP_flow_topology,
 	DRYP_groundwater_EFD,
 	DRYP_infiltration,
 	DRYP_io,
@@ -13,6 +14,7 @@ from .components import (
 COMPONENTS = [
 	DRYP_ABM_connector,
 	DRYP_Gen_Func,
+	DRYP_flow_topology,
 	DRYP_groundwater_EFD,
 	DRYP_infiltration,
 	DRYP_io,
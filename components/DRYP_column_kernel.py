@@ -0,0 +1,257 @@
+import numpy as np
+from numba import njit
+
+# Compiled column kernel (numba). Saturation excess, infiltration and the
+# soil water balance are computed in one pass over active cells, states
+# and fluxes are read and written in place (infiltration_model, SWBM and
+# SWBMh of the python components).
+
+MOD_GA_TOL = 0.001 # Relative tolerance of the ponding time, Modified GA
+MOD_GA_MAX_ITER = 50 # Maximum Newton iterations, Modified GA
+
+@njit(cache=True, error_model='numpy')
+def column_step_jit(inf_method, daily, rain_day_before, act_nodes, rain,
+		K_sat, PSI_f, ga_kdt, to_0, Duz, SORP0, L_inf, Lsat, t_0, Ft_0,
+		inf_dt, exs_dt, pet, Kc, Ksat_soil, L_0, fs, fc, wp, c,
+		aet_dt, pcl_dt, tht_dt, sro_dt, WRSI):
+	"""Infiltration and soil water balance of active cells, inf_method
+	0 (Schaake), 1 (Philip) or 3 (Modified GA). K_sat, PSI_f, ga_kdt and
+	to_0 are arrays of active cells, other arrays are at nodes.
+	L_inf is the water content of the infiltration model and L_0 the
+	water content of the soil water balance. to_0 is the ponding time of
+	the previous step (Modified GA), updated for ponding cells.
+	Returns the rain flag of the next step (rain_day_before) and the
+	ponding cells, Newton iterations and not converged cells of
+	Modified GA.
+	"""
+	n = act_nodes.shape[0]
+	ponding = 0
+	iterations = 0
+	not_converged = 0
+
+	# Infiltration is only computed if it rains over any cell
+	any_rain = False
+	for k in range(n):
+		i = act_nodes[k]
+		if rain[i] > 0.0 and (Lsat[i] - L_inf[i]) > 0.0 and Duz[i] > 0.0:
+			any_rain = True
+			break
+
+	for k in range(n):
+		i = act_nodes[k]
+
+		# Saturation excess
+		P = rain[i]
+		sat_excess = 0.0
+		if (Lsat[i] - L_inf[i]) <= 0.0:
+			sat_excess = P
+			P = 0.0
+		if Duz[i] <= 0.0:
+			sat_excess = P
+			P = 0.0
+
+		I = 0.0
+		RO = 0.0
+		Ft = 0.0
+		SORP = 0.0
+		if any_rain:
+			if inf_method == 0:
+				I, RO = schaake_cell(P, ga_kdt[k], Lsat[i], L_inf[i])
+			else:
+				if Duz[i] != 0:
+					SORP = np.sqrt(2*K_sat[k]*PSI_f[k]*((Lsat[i] - L_inf[i])/Duz[i]))
+				t_i = 0.0
+				F = 0.0
+				if rain_day_before == 1 and P > 0.0:
+					SORP = SORP0[i]
+					t_i = t_0[i]
+					F = Ft_0[i]
+				if inf_method == 1:
+					Ft, I, RO = philip_cell(P, 0.5*K_sat[k], SORP, F, t_i)
+				elif inf_method == 3:
+					Ft, I, RO, nit, conv = mod_ga_cell(P, K_sat[k], SORP, F,
+						t_i, 1.0, to_0, k)
+					if nit > 0:
+						ponding += 1
+						iterations += nit
+						not_converged += 1 - conv
+			if P > 0.0:
+				t_0[i] += 1
+		else:
+			t_0[i] = 0.0
+
+		Ft_0[i] = Ft
+		SORP0[i] = SORP
+		inf_dt[i] = I
+		exs_dt[i] = RO + sat_excess
+
+		# Soil water balance
+		if Duz[i] > 0.0:
+			swbm_cell(i, daily, I, pet, Kc, Ksat_soil, L_0, Duz, fs, fc, wp, c,
+				aet_dt, pcl_dt, tht_dt, sro_dt, WRSI)
+
+	if any_rain:
+		return 1, ponding, iterations, not_converged
+	return 0, ponding, iterations, not_converged
+
+@njit(cache=True, error_model='numpy')
+def swbm_jit(daily, nodes, inf, pet, Kc, Ksat, L_0, Duz, fs, fc, wp, c,
+		aet_dt, pcl_dt, tht_dt, sro_dt, WRSI):
+	"""Soil water balance of nodes, arrays are at nodes"""
+	for k in range(nodes.shape[0]):
+		i = nodes[k]
+		if Duz[i] > 0.0:
+			swbm_cell(i, daily, inf[i], pet, Kc, Ksat, L_0, Duz, fs, fc, wp, c,
+				aet_dt, pcl_dt, tht_dt, sro_dt, WRSI)
+
+@njit(cache=True, error_model='numpy')
+def swbm_cell(i, daily, I, pet, Kc, Ksat, L_0, Duz, fs, fc, wp, c,
+		aet_dt, pcl_dt, tht_dt, sro_dt, WRSI):
+	"""Soil water balance of node i (SWBM for daily time steps, SWBMh
+	otherwise)
+	"""
+	z_soil = Duz[i]
+	L0 = L_0[i]
+	PET = Kc[i]*pet[i]
+	Lsat = z_soil*fs[i]
+	Lwp = z_soil*wp[i]
+	Lfc = z_soil*fc[i]
+	TAW = Lfc - Lwp
+	RAW = 0.5*TAW
+	L_RAW = Lfc - RAW
+	L_TAW = Lfc - TAW
+	beta = (L0 - L_TAW)/(L_RAW - L_TAW)
+	if beta > 1:
+		beta = 1.0
+	if beta < 0:
+		beta = 0.0
+	I_AET = I
+	if I > PET:
+		I_AET = PET
+	AET = I_AET*(1 - beta) + beta*PET
+	if AET < 0:
+		AET = 0.0
+	L = L0 + I - AET
+	if (L - Lwp) < 0:
+		AET = L0 + I - Lwp
+	L = L0 + I - AET
+
+	if daily == 1:
+		D = 0.0
+		if L - Lfc > 0.0:
+			D = L - Lfc
+		L = L - D
+		RO = 0.0
+		if L > Lsat:
+			RO = L - Lsat
+	else:
+		RO = 0.0
+		if L > Lsat:
+			RO = L - Lsat
+		L -= RO
+		DL = 0.0
+		if L > Lfc:
+			kd = (c[i] - 1)*Ksat[i]/(z_soil*np.power(fs[i], c[i]))
+			DL = z_soil*np.exp((-c[i] + 1)*np.log(np.power(L/z_soil, -c[i] + 1) + kd)) - Lfc
+		if DL < 0.0:
+			DL = L - Lfc
+		else:
+			DL = 0.0
+		L_aux = L
+		L = L_aux - DL
+		D = L_aux - L + RO
+
+	aet_dt[i] = AET
+	pcl_dt[i] = D
+	tht_dt[i] = L/z_soil
+	sro_dt[i] = RO
+	WRSI[i] = 0.0
+	if pet[i] != 0:
+		WRSI[i] = AET/pet[i]
+	L_0[i] = L
+
+@njit(cache=True, error_model='numpy')
+def schaake_cell(P, ga_kdt, Lsat, L):
+	"""Schaake infiltration of one cell (SCHAAKE)"""
+	I_aux = (Lsat - L)*ga_kdt
+	I = 0.0
+	if P + I_aux != 0.0:
+		I = P*I_aux/(P + I_aux)
+	return I, P - I
+
+@njit(cache=True, error_model='numpy')
+def philip_cell(P, ks, Sp, F, t):
+	"""Philip infiltration of one cell (Philip)"""
+	dt = 1.0
+	Fp = 0.0
+	dtp = 0.0
+	if P > 0:
+		Fp = 0.5*(Sp**2)*(P - 0.5*ks)*((P - ks)**(-2))
+		dtp = (Fp - F)/P
+	ts = t + dtp
+	if dtp > dt:
+		ts = t + dt
+	Faux = Fp
+	if dtp < 0:
+		ts = t
+		Faux = F
+	sp_aux = np.sqrt(Sp**2 + 4*ks*Faux) - Sp
+	to_p = 0.25*(sp_aux/ks)**2
+	to = t + dt - ts
+	if dtp < dt:
+		to = ts - to_p
+	dtc = 0.0
+	if P != 0.0:
+		dtc = t + dt - to
+	Ft = 0.0
+	if dtc != 0.0:
+		Ft = Sp*dtc**0.5 + ks*dtc
+	if F + P < Ft:
+		Ft = F + P
+	I = Ft - F
+	return Ft, I, P - I
+
+@njit(cache=True, error_model='numpy')
+def mod_ga_cell(P, ks, Sp, F, t, dt, to_0, k):
+	"""Modified Green & Ampt infiltration of cell k (Mod_GA), the
+	ponding time is solved by Newton iterations from the ponding time
+	of the previous step (to_0[k], updated here), as Newthon_Rap_Mod_GA.
+	Returns also the Newton iterations and 1 if they converged.
+	"""
+	tp = 0.0
+	if P > ks:
+		tp = Sp/(P - ks)
+	to = t
+	nit = 0
+	conv = 1
+	if (tp - t)*(t + 1 - tp) > 0:
+		# start below the solution, convergence is monotonic from there
+		to_it = to_0[k]
+		if not (to_it > 0):
+			to_it = 0.1
+		if ks*(tp - to_it) + Sp*np.log(tp/to_it) - F - P*(tp - t) <= 0:
+			to_it = 0.1
+			while ks*(tp - to_it) + Sp*np.log(tp/to_it) - F - P*(tp - t) <= 0:
+				to_it *= 0.5
+		conv = 0
+		for it in range(MOD_GA_MAX_ITER):
+			f = ks*(tp - to_it) + Sp*np.log(tp/to_it) - F - P*(tp - t)
+			to = to_it + f/(ks + Sp/to_it)
+			nit += 1
+			if not (np.abs(to - to_it)/to >= MOD_GA_TOL):
+				conv = 1
+				break
+			to_it = to
+		to_0[k] = to
+	Faux = 0.0
+	if to != 0:
+		Faux = ks*(t + dt - to) + Sp*np.log((t + dt)/to)
+	F_tf = Faux
+	if tp > t + 1:
+		F_tf = F + P
+	if tp < to:
+		F_tf += F
+	if tp == 0:
+		F_tf = P + F
+	I = F_tf - F
+	return F_tf, I, P - I, nit, conv
@@ -0,0 +1,199 @@
+import os
+import hashlib
+import numpy as np
+from landlab.components import FlowDirectorD8
+from landlab.components.flow_accum import flow_accum_bw
+
+class flow_topology(object):
+	"""Routing structure of a single receiver (D8) flow network.
+	Nodes are grouped in topological levels: all donors of a node belong
+	to a lower level, so every node of a level can be routed at once.
+	Parameters:
+		receivers:		Receiver node of each node
+		node_cell_area:	Cell area of each node, zero at closed nodes
+		stack:			Upstream node order, computed if not given
+		level:			Topological level of nodes, computed if not given
+	"""
+	def __init__(self, receivers, node_cell_area, stack=None, level=None):
+		r = np.array(receivers, dtype=int)
+		nodes = np.arange(len(r))
+
+		# Upstream node order as built by the landlab accumulators
+		if stack is None:
+			nd = flow_accum_bw._make_number_of_donors_array(r)
+			delta = flow_accum_bw._make_delta_array(nd)
+			D = flow_accum_bw._make_array_of_donors(r, delta)
+			stack = flow_accum_bw.make_ordered_node_array(r, nd, delta, D)
+		s = np.array(stack, dtype=int)
+
+		# Position of each node in the stack
+		stack_pos = np.zeros(len(r), dtype=int)
+		stack_pos[s] = nodes
+
+		flowing = np.where(r != nodes)[0]
+
+		# Donors of each node are sorted as they are visited by the
+		# sequential accumulator (from the top to the bottom of the stack)
+		# so discharges are added in the same order
+		donors = flowing[np.lexsort((-stack_pos[flowing], r[flowing]))]
+		donor_rcv = r[donors]
+		ndonors = np.bincount(donor_rcv, minlength=len(r))
+		first = np.concatenate(([0], np.cumsum(ndonors)[:-1]))
+		donor_rank = np.arange(len(donors)) - first[donor_rcv]
+
+		if level is None:
+			level = flow_levels(r)
+		level = np.array(level, dtype=int)
+		
+		self.levels = group_levels(nodes, donor_rcv, donors, donor_rank, r, level)
+		
+		self.receivers = r
+		self.stack = s
+		self.donors = donors
+		self.donor_rank = donor_rank
+		self.ndonors = ndonors
+		self.level = level
+		self.node_cell_area = node_cell_area
+		self.drainage_area = self.accumulate(np.ones(len(r)))
+
+	def accumulate(self, runoff):
+		"""Accumulate local runoff [depth] downstream, without losses
+		"""
+		q = self.node_cell_area*runoff
+		for level_nodes, flow_nodes, pull in self.levels:
+			for rcv, don in pull:
+				q[rcv] += q[don]
+		return q
+
+	def downstream(self, seeds):
+		"""Mask of the nodes reached by flow from seed nodes, the
+		walk only visits the flow paths below the seeds
+		"""
+		mark = np.zeros(len(self.receivers), dtype=bool)
+		front = np.unique(seeds)
+		while len(front) > 0:
+			mark[front] = True
+			front = np.unique(self.receivers[front])
+			front = front[~mark[front]]
+		return mark
+
+	def subset_levels(self, mark):
+		"""Levels of the sub-network of marked nodes, marked nodes must
+		include all nodes downstream of them
+		"""
+		pairs = mark[self.donors]
+		return group_levels(np.where(mark)[0], self.receivers[self.donors[pairs]],
+			self.donors[pairs], self.donor_rank[pairs], self.receivers, self.level)
+
+	def subset_stack(self, mark):
+		"""Upstream node order of the sub-network of marked nodes
+		"""
+		return self.stack[mark[self.stack]]
+
+	def save(self, fname, key):
+		"""Save receivers, upstream order and levels to a numpy file
+		"""
+		np.savez(fname, key=key, receivers=self.receivers,
+			stack=self.stack, level=self.level)
+
+def set_flow_topology(grid, fname_DEM, update_flow_director, save_topology):
+	"""Flow network of the model grid. Flow directions are computed only
+	once, since the DEM does not change during the simulation.
+	Parameters:
+		grid:					Landlab grid
+		fname_DEM:				DEM file, the network is stored next to it
+		update_flow_director:	Compute D8 flow directions from the DEM
+		save_topology:			Read or save the network next to the DEM
+	"""
+	area = node_cell_area(grid)
+	fname = os.path.splitext(fname_DEM)[0] + '_flow_topology.npz'
+	
+	# Signature of the inputs the flow network depends on
+	aux_key = hashlib.sha1(np.array(grid.at_node['topographic__elevation']).tobytes())
+	aux_key.update(np.array(grid.status_at_node).tobytes())
+	if not update_flow_director:
+		aux_key.update(np.array(grid.at_node['flow__receiver_node'], dtype=int).tobytes())
+	key = aux_key.hexdigest()
+	
+	if save_topology == 1 and os.path.exists(fname):
+		data = np.load(fname)
+		if str(data['key']) == key:
+			print('Reading flow network: ' + fname)
+			grid.add_field('flow__receiver_node', np.array(data['receivers']),
+				at='node', clobber=True)
+			return flow_topology(data['receivers'], area,
+				data['stack'], data['level'])
+	
+	if update_flow_director:
+		FlowDirectorD8(grid, 'topographic__elevation').run_one_step()
+	topology = flow_topology(grid.at_node['flow__receiver_node'], area)
+	
+	if save_topology == 1:
+		topology.save(fname, key)
+		print('Flow network saved: ' + fname)
+	return topology
+
+def group_levels(nodes, pair_rcv, pair_don, pair_rank, receivers, level):
+	"""Nodes and donor pairs grouped by topological level. Donors of a
+	node are pulled by rank, so discharges are added in stack order.
+	Parameters:
+		nodes:		Nodes to route
+		pair_rcv:	Receiver of each donor pair
+		pair_don:	Donor of each donor pair
+		pair_rank:	Rank of the donor between donors of its receiver
+		receivers:	Receiver node of each node
+		level:		Topological level of nodes
+	"""
+	node_level = level[nodes]
+	node_order = np.argsort(node_level, kind='stable')
+	nodes, node_level = nodes[node_order], node_level[node_order]
+	pair_level = level[pair_rcv]
+	pair_order = np.lexsort((pair_rcv, pair_rank, pair_level))
+	pair_level = pair_level[pair_order]
+	
+	ilevels = np.unique(node_level)
+	edges = np.append(ilevels, ilevels.max()+1 if len(ilevels) > 0 else 0)
+	node_bounds = np.searchsorted(node_level, edges)
+	pair_bounds = np.searchsorted(pair_level, edges)
+	
+	levels = []
+	for i in range(len(ilevels)):
+		level_nodes = nodes[node_bounds[i]:node_bounds[i+1]]
+		pairs = pair_order[pair_bounds[i]:pair_bounds[i+1]]
+		rank = pair_rank[pairs]
+		pull = []
+		for k in range(rank.max()+1 if len(rank) > 0 else 0):
+			pull.append((pair_rcv[pairs[rank == k]], pair_don[pairs[rank == k]]))
+		levels.append((level_nodes,
+			level_nodes[receivers[level_nodes] != level_nodes],
+			pull))
+	return levels
+
+def flow_levels(receivers):
+	"""Topological level of each node of a single receiver flow network,
+	nodes without donors are in level zero.
+	"""
+	r = np.asarray(receivers)
+	nodes = np.arange(len(r))
+	flowing = r != nodes
+	indegree = np.bincount(r[flowing], minlength=len(r))
+	level = np.full(len(r), -1, dtype=int)
+	front = np.where(indegree == 0)[0]
+	ilevel = 0
+	while len(front) > 0:
+		level[front] = ilevel
+		rcv = r[front[flowing[front]]]
+		indegree -= np.bincount(rcv, minlength=len(r))
+		rcv = np.unique(rcv)
+		front = rcv[indegree[rcv] == 0]
+		ilevel += 1
+	if np.any(level < 0):
+		raise Exception("Flow network has cycles, check flow directions")
+	return level
+
+def node_cell_area(grid):
+	"""Cell area at nodes used by the landlab flow accumulators
+	"""
+	area = np.array(grid.cell_area_at_node)
+	area[grid.closed_boundary_nodes] = 0.0
+	return area
@@ -1,16 +1,33 @@
 
 import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import spsolve, splu
+from landlab.io import write_esri_ascii
 from landlab.grid.mappers import (
 	map_mean_of_link_nodes_to_link,
 	map_max_of_node_links_to_node,
 	map_max_of_link_nodes_to_link,
 	map_min_of_link_nodes_to_link)
+try:
+	# compiled groundwater kernel (numba)
+	from components.DRYP_groundwater_kernel import explicit_steps_jit
+except ImportError:
+	explicit_steps_jit = None
+from components.DRYP_groundwater_parallel import gw_domain
+from timing import perf
 
 #Global variables
 REG_FACTOR = 0.001 #Regularisation factor
 COURANT_2D = 0.25 # Courant Number 2D flow
 COURANT_1D = 0.50 # Courant number 1D flow
 STR_RIVER = 0.001 # Riverbed storage factor
+PICARD_MAX_ITER = 20 # Maximum Picard iterations, implicit solver
+PICARD_TOL = 1e-5 # Head change tolerance [m], implicit solver
+LTS_MAX_CLASS = 6 # Slowest time step class (2**6 sub-steps), local time stepping
+STEADY_DT_INI = 24.0 # First pseudo time step [h], steady-state solver
+STEADY_DT_MAX = 1e8 # Longest pseudo time step [h], steady-state solver
+STEADY_MAX_STEPS = 100 # Maximum pseudo time steps, steady-state solver
+STEADY_TOL = 1e-9 # Head change rate tolerance [m/h], steady-state solver
 # provisional
 a_faq = 150
 b_faq = 131
@@ -70,12 +87,77 @@ class gwflow_EFD(object):
 		self.kAriv = Ariv*self.kaq
 		self.f = 30
 		self.dh = np.zeros_like(Ariv)
+		self.layers = 1
+		self.deep_storage_change = 0
+		
+		# River nodes (cells with river-aquifer exchange), river exchange
+		# is computed over compact arrays of these nodes
+		self.riv_nodes = np.where((self.kriv != 0)
+			| (env_state.grid.at_node['SS_loss'] != 0))[0]
+		self.is_river = np.zeros(len(self.kriv), dtype=bool)
+		self.is_river[self.riv_nodes] = True
 		
 		if len(env_state.SZgrid.open_boundary_nodes) > 0:			
 			self.fixed_links = env_state.SZgrid.links_at_node[
 				env_state.SZgrid.open_boundary_nodes]
 			self.act_fix_link = 1
 		
+		# Grid operators and static link quantities used at every sub-step
+		self.ops = grid_operators(env_state.SZgrid)
+		self.act_links = act_links
+		self.bm = self.ops.mean_at_link(env_state.SZgrid.at_node['BOT'])
+		self.T_static = np.zeros(len(self.Ksat))
+		self.T_static[act_links] = self.Ksat[act_links]
+		
+		# Groundwater solver, explicit, implicit (backward Euler), explicit
+		# compiled or constant transmissivity (factorized once)
+		self.solver = data_in.gw_solver
+		if self.solver == 2 and explicit_steps_jit is None:
+			print('Compiled groundwater kernel needs numba, using python solver')
+			self.solver = 0
+		if self.solver == 3 and env_state.func != 2:
+			print('Factorized solver needs constant transmissivity, using implicit solver')
+			self.solver = 1
+		self.lu = None
+		self.lu_dt = None
+		# Local time stepping of the explicit solver
+		self.local_steps = data_in.gw_local_steps
+		if self.local_steps == 1 and self.solver != 0:
+			print('Local time stepping is only available for the python explicit solver')
+			self.local_steps = 0
+		if self.solver == 1:
+			print('Groundwater solver: implicit (backward Euler)')
+		elif self.solver == 2:
+			print('Groundwater solver: explicit compiled')
+			self.act_link = np.zeros(len(self.Ksat), dtype=bool)
+			self.act_link[act_links] = True
+			if self.act_fix_link == 1:
+				self.fixed_link_index = np.ravel(self.fixed_links) % len(self.Ksat)
+			else:
+				self.fixed_link_index = np.zeros(0, dtype=int)
+			self.T_buffer = np.zeros(len(self.Ksat))
+		elif self.solver == 3:
+			print('Groundwater solver: constant transmissivity, factorized once')
+		# Quiescence of the explicit solver, head change rate tolerance [m/h]
+		self.dormant_tol = data_in.gw_dormant_tol*0.001/24
+		if self.dormant_tol > 0 and (self.solver != 0 or self.local_steps == 1
+				or data_in.gw_workers > 1):
+			print('Dormant groundwater regions are only available for the python explicit solver')
+			self.dormant_tol = 0
+		# Worker processes of the explicit solver
+		self.domain = None
+		if data_in.gw_workers > 1:
+			if self.solver == 0 and self.local_steps == 0:
+				self.domain = gw_domain(self, env_state, data_in.gw_workers)
+			else:
+				print('Groundwater worker processes are only available for the python explicit solver')
+		# Sub-steps and Courant limiting nodes of the explicit solver
+		self.telemetry = None
+		if data_in.gw_telemetry == 1:
+			if self.solver == 0 and self.local_steps == 0 and self.domain is None:
+				self.telemetry = courant_telemetry(env_state.SZgrid)
+			else:
+				print('Groundwater telemetry is only available for the python explicit solver')
 		
 	def add_second_layer_gw(self, env_state, thickness, Ksat, Sy, Ss):	
 		# thickness:	Thickness of the deep aquifer
@@ -88,11 +170,13 @@ class gwflow_EFD(object):
 		env_state.SZgrid.add_zeros('node', 'Ss_2', dtype=float)
 		env_state.SZgrid.add_zeros('node', 'HEAD_2', dtype=float)
 	
-		env_state.SZgrid.at_node['BOT_2'] = np.array(
+		# Top of the deep layer, below the surface elevation
+		env_state.SZgrid.at_node['BOT_2'] = np.minimum(
 			env_state.SZgrid.at_node['BOT']
-			+ thickness)
+			+ thickness, env_state.SZgrid.at_node['topographic__elevation'])
 		
-		self.thickness = thickness
+		self.thickness = (env_state.SZgrid.at_node['BOT_2']
+			- env_state.SZgrid.at_node['BOT'])
 		
 		env_state.SZgrid.at_node['Sy_2'][:] = Sy		
 		env_state.SZgrid.at_node['Ss_2'][:] = Ss		
@@ -105,134 +189,156 @@ class gwflow_EFD(object):
 		
 		self.Ksat_2 = np.zeros(len(Ksl))		
 		self.Ksat_2[act_links] = Kmax[act_links]*Kmin[act_links]/Ksl[act_links]		
-		env_state.SZgrid.at_node['HEAD_2'][:] = np.array(env_state.SZgrid.at_node['water_table__elevation'])		
+		env_state.SZgrid.at_node['HEAD_2'][:] = np.array(env_state.SZgrid.at_node['water_table__elevation'])
+		
+		# The upper layer lies above the deep layer, it is dry (water table
+		# at its bottom) where the water table is in the deep layer
+		env_state.SZgrid.at_node['water_table__elevation'][:] = np.maximum(
+			env_state.SZgrid.at_node['water_table__elevation'],
+			env_state.SZgrid.at_node['BOT_2'])
+		self.wte_dt = np.array(env_state.SZgrid.at_node['water_table__elevation'])
+		self.layers = 2
+		print('Groundwater deep layer: ' + str(thickness) + ' m thick')
+		if (self.solver != 0 or self.local_steps == 1 or self.dormant_tol > 0
+				or self.domain is not None):
+			print('Two-layer groundwater model uses the python explicit solver')
 
-	def run_one_step_gw_2Layer(self, env_state, dt, tht_dt, rtht_dt, Droot):	
-				
+	def run_one_step_gw_2Layer(self, env_state, dt, tht_dt, Droot):
+		"""Explicit groundwater sub-steps over dt of the upper layer and
+		the deep layer (HEAD_2). Lateral fluxes of both layers are explicit,
+		leakage between layers is implicit and solved at each node as a
+		2x2 system. Both layers are unconfined with variable thickness,
+		rivers, head boundaries and the unsaturated zone only interact
+		with the upper layer.
 		"""
-		Function to update water table depending on the unsaturated zone.
-		Parameters:
-		Droot:		Rooting depth [mm]
-		tht_dt:		Water content at time t [-]
-		Duz:		Unsaturated zone depth
-		env_state:	grid:	z:	Topograhic elevation
-							h:	water table
-							fs:	Saturated water content
-							fc:	Field capacity
-							Sy:	Specific yield
-							dq:	water storage anomaly
-					
-		Groundwater storage variation
-		"""
-		dts = time_step(COURANT_2D, env_state.SZgrid.at_node['SZ_Sy'],
-						env_state.SZgrid.at_node['Hydraulic_Conductivity'],
-						env_state.SZgrid.at_node['water_table__elevation'],
-						env_state.SZgrid.at_node['BOT'],
-						env_state.SZgrid.dx,
-						env_state.SZgrid.core_nodes)
+		# Fields that do not change during sub-steps
+		z = env_state.SZgrid.at_node['topographic__elevation']
+		Sy = env_state.SZgrid.at_node['SZ_Sy']
+		BOT = env_state.SZgrid.at_node['BOT']
+		BOT_2 = env_state.SZgrid.at_node['BOT_2']
+		K_1 = env_state.SZgrid.at_node['Hydraulic_Conductivity']
+		K_2 = env_state.SZgrid.at_node['Ksat_2']
+		Sy_2 = env_state.SZgrid.at_node['Sy_2']
+		S_2 = env_state.SZgrid.at_node['Ss_2']*self.thickness
+		h_2 = env_state.SZgrid.at_node['HEAD_2']
+		FHB = env_state.SZgrid.at_node['SZ_FHB']
+		recharge = env_state.SZgrid.at_node['recharge']
+		discharge = env_state.SZgrid.at_node['discharge']
+		anomaly = env_state.SZgrid.at_node['water_storage_anomaly']
+		z_riv = env_state.grid.at_node['river_topo_elevation']
+		SS_loss = env_state.grid.at_node['SS_loss']
+		core_nodes = env_state.SZgrid.core_nodes
+		core = np.zeros(len(z), dtype=bool)
+		core[core_nodes] = True
+		
+		stage = env_state.grid.at_node['Q_ini'] * self.kriv
+		aux_riv = np.ones(len(stage))
+		aux_riv[stage > 0] = 0
+		
+		# River exchange over river nodes only
+		riv = self.riv_nodes
+		z_riv_r = z_riv[riv]
+		SS_loss_r = SS_loss[riv]
+		stage_r = stage[riv]
+		aux_riv_r = aux_riv[riv]
+		W_r = self.W[riv]
+		kriv_r = self.kriv[riv]
+		kAriv_r = self.kAriv[riv]
+		Sy_r = Sy[riv]
+		self.hriv = np.minimum(self.hriv, z_riv)
+		hriv = self.hriv[riv]
+		
+		h = env_state.SZgrid.at_node['water_table__elevation']
+		T = self.upstream_transmissivity(self.Ksat, h - BOT_2, h)
+		T_2 = self.upstream_transmissivity(self.Ksat_2, np.clip(h_2 - BOT, 0, self.thickness), h_2)
+		dts = self.time_step_2Layer(Sy, T, np.where(h_2 > BOT_2, S_2, Sy_2), T_2,
+			env_state.SZgrid.dx, core_nodes)
 		
-		act_links = env_state.SZgrid.active_links
-		A = np.power(env_state.SZgrid.dx,2)
 		dtp = np.nanmin([dt, dts])
 		dtsp = dtp
-		env_state.SZgrid.at_node['discharge'][:] = 0.0
+		discharge[:] = 0.0
+		self.flux_out = 0
+		self.dh[:] = 0
+		storage_ini = deep_layer_storage(h_2, BOT, BOT_2, Sy_2, S_2)
+		
+		qs = np.zeros(len(self.Ksat))
+		qs_2 = np.zeros(len(self.Ksat))
 		
 		while dtp <= dt:
 			
-			## specifiying river flow boundary conditions for groundwater flow
-			env_state.SZgrid.at_node['water_table__elevation'][:] = np.maximum(
-				env_state.SZgrid.at_node['water_table__elevation'],
-				env_state.SZgrid.at_node['BOT'])
-			## specifiying river flow boundary conditions for groundwater flow
-			env_state.SZgrid.at_node['water_table__elevation'][:] = np.minimum(
-				env_state.SZgrid.at_node['topographic__elevation'],
-				env_state.SZgrid.at_node['water_table__elevation'])				
-			# Calculate vertical conductivity for river cells
-			p = np.where((env_state.SZgrid.at_node['HEAD_2']
-				-env_state.SZgrid.at_node['BOT_2']) > 0,1,0)
-			
-			dh_1 = (env_state.SZgrid.at_node['water_table__elevation']
-				- env_state.SZgrid.at_node['BOT_2'])*p
-						
-			dh_2 = (env_state.SZgrid.at_node['HEAD_2']
-				- env_state.SZgrid.at_node['BOT'])*(1-p)
-						
-			Cz = (np.where(dh_1 > 0,1/(env_state.SZgrid.at_node['Hydraulic_Conductivity']
-				/(0.5*dh_1)),0) + 1/(env_state.SZgrid.at_node['Ksat_2']
-				/(0.5*self.thickness)))
-		
-			aux_h = np.where((env_state.SZgrid.at_node['HEAD_2']
-				-env_state.SZgrid.at_node['BOT_2']) > 0, env_state.SZgrid.at_node['water_table__elevation'],
-				env_state.SZgrid.at_node['HEAD_2'])
+			perf.count('groundwater sub-steps')
+			perf.count('groundwater node updates', 2*len(z))
+			if self.telemetry is not None:
+				self.telemetry.substep(dtsp)
 			
-			dhdz = np.where((dh_2+dh_1) > 0,
-				(aux_h - env_state.SZgrid.at_node['HEAD_2'])/np.power(self.thickness+dh_1,2),0)
+			# The water table field is replaced by fun_update_UZ_SZ_depth
+			h = env_state.SZgrid.at_node['water_table__elevation']
 			
-			dqz = - (1/Cz)*dhdz
+			# Make water table always below or equal surface elevation
+			h[:] = np.minimum(z, h)
+			hriv = np.minimum(hriv, z_riv_r)
 			
-			# Calculate the hydraulic gradients
-			dhdl_1 = env_state.SZgrid.calc_grad_at_link(env_state.SZgrid.at_node['water_table__elevation'])
-			dhdl_2 = env_state.SZgrid.calc_grad_at_link(env_state.SZgrid.at_node['HEAD_2'])
+			# Flux per unit length at each face of both layers
+			T = self.upstream_transmissivity(self.Ksat, h - BOT_2, h)
+			T_2 = self.upstream_transmissivity(self.Ksat_2, np.clip(h_2 - BOT, 0, self.thickness), h_2)
+			qs[self.act_links] = -T[self.act_links]*self.ops.grad_at_link(h)[self.act_links]
+			qs_2[self.act_links] = -T_2[self.act_links]*self.ops.grad_at_link(h_2)[self.act_links]
 			
-			# mean hydraulic head at the face of the of the patch
-			qxy_1 = np.zeros(len(self.Ksat))
-			qxy_2 = np.zeros(len(self.Ksat_2))
+			if self.act_fix_link == 1:
+				self.flux_out += ((np.sum(qs[self.fixed_links])
+					+ np.sum(qs_2[self.fixed_links]))/env_state.SZgrid.dx)*dtsp
 			
-			hm = map_mean_of_link_nodes_to_link(env_state.SZgrid,'water_table__elevation')
-			bm = map_mean_of_link_nodes_to_link(env_state.SZgrid,'BOT_2')
-						
-			# Calculate flux per unit length at each face layer 1
-			qxy_1[act_links] = -self.Ksat[act_links]*(hm[act_links]-bm[act_links])*dhdl_1[act_links]
+			# Calculate flux head boundary conditions
+			dfhbc = exponential_T(FHB, 60, z, h)
+			self.flux_out += np.sum(dfhbc)
 			
-			# Calculate flux per unit length at each face layer 2
-			hm = map_mean_of_link_nodes_to_link(env_state.SZgrid,'HEAD_2')
-			bm = map_mean_of_link_nodes_to_link(env_state.SZgrid,'BOT')
+			# Calculate flux gradient
+			dqsdxy = -self.ops.flux_div_at_node(qs) - dfhbc + recharge/dt
+			dq_2 = -self.ops.flux_div_at_node(qs_2)
 			
-			b2 = np.minimum(hm-bm, Self.thickness)			
-			qxy_2[act_links] = -self.Ksat_2[act_links]*b2[act_links]*dhdl_2[act_links]
-					
-			# Calculate the flux gradient
-			dqxy_1 = (-env_state.SZgrid.calc_flux_div_at_node(qxy_1) + dqz + p*env_state.SZgrid.at_node['recharge']/dt)#*dtsp
-			dqxy_2 = (-env_state.SZgrid.calc_flux_div_at_node(qxy_2) - dqz + (1-p)*env_state.SZgrid.at_node['recharge']/dt)#*dtsp
-						
-			CRIV =  smoth_func(env_state.SZgrid.at_node['water_table__elevation'],
-					env_state.grid.at_node['river_topo_elevation'],0.00001,
-					dqxy_1, env_state.SZgrid.core_nodes)*(1/A)*env_state.grid.at_node['SS_loss']
-			
-			FSy, FSs = smoth_func_L2(env_state.SZgrid.at_node['HEAD_2'][:],
-				env_state.SZgrid.at_node['BOT'][:],
-				self.thickness, REG_FACTOR, env_state.SZgrid.core_nodes)
-			
-			alpha = 1/(env_state.SZgrid.at_node['SZ_Sy'] + dtsp*CRIV)
-			
-			# Update water table upper layer
-			env_state.SZgrid.at_node['water_table__elevation'][env_state.SZgrid.core_nodes] = (dtsp*alpha[env_state.SZgrid.core_nodes]
-				*((p*dqxy_1)[env_state.SZgrid.core_nodes] + CRIV[env_state.SZgrid.core_nodes]*env_state.grid.at_node['river_topo_elevation'][env_state.SZgrid.core_nodes])
-				+ env_state.SZgrid.at_node['SZ_Sy'][env_state.SZgrid.core_nodes]*alpha[env_state.SZgrid.core_nodes]
-				*env_state.SZgrid.at_node['water_table__elevation'][env_state.SZgrid.core_nodes])
-			
-			# Update water table lower layer
-			env_state.SZgrid.at_node['HEAD_2'][env_state.SZgrid.core_nodes] += (dqxy_2[env_state.SZgrid.core_nodes]*dtsp*
-				(FSy[env_state.SZgrid.core_nodes]/env_state.SZgrid.at_node['Sy_2'][env_state.SZgrid.core_nodes]+
-				FSs[env_state.SZgrid.core_nodes]/env_state.SZgrid.at_node['Ss_2'][env_state.SZgrid.core_nodes]))
-			
-			env_state.SZgrid.at_node['water_table__elevation'][env_state.SZgrid.core_nodes] = np.maximum(
-				env_state.SZgrid.at_node['water_table__elevation'][env_state.SZgrid.core_nodes],
-				env_state.SZgrid.at_node['BOT_2'][env_state.SZgrid.core_nodes])
-			
-			# Update water storage anomalies
-			env_state.grid.at_node['Base_flow'][env_state.SZgrid.core_nodes] += (
-				CRIV[env_state.SZgrid.core_nodes]
-				*np.abs(env_state.SZgrid.at_node['water_table__elevation'][env_state.SZgrid.core_nodes]
-				-env_state.grid.at_node['river_topo_elevation'][env_state.SZgrid.core_nodes]))
-						
-			dtsp = time_step(COURANT_2D, env_state.SZgrid.at_node['SZ_Sy'],
-						env_state.SZgrid.at_node['Hydraulic_Conductivity'],
-						env_state.SZgrid.at_node['water_table__elevation'],
-						env_state.SZgrid.at_node['BOT'],
-						env_state.SZgrid.dx,
-						env_state.SZgrid.core_nodes)
+			# Calculate river cell flux
+			qs_riv = river_cell_flux(SS_loss_r, z_riv_r, hriv, h[riv], stage_r,
+				aux_riv_r, W_r, env_state.SZgrid.dx)
+			dqsdxy[riv] += self.kaq*qs_riv
+			
+			# Leakage from the upper to the deep layer
+			S = np.where(h_2 > BOT_2, S_2, Sy_2)
+			qz = leakage(h, h_2, BOT_2, dqsdxy, dq_2, Sy, S, K_1, K_2,
+				self.thickness, dtsp)
+			qz[~core] = 0.0
+			dqsdxy -= qz
+			dq_2 += qz
+			
+			# Regularization approach for aquifer and river cells
+			dqs = regularization_T(z, h, self.faq_node, dqsdxy, REG_FACTOR)
+			dqs_riv = regularization_T(z_riv_r, hriv, self.f,
+				-kriv_r*qs_riv, REG_FACTOR)
+			
+			# Update the head elevations, water drained below the bottom of
+			# the upper layer is taken from the deep layer
+			h += ((dqsdxy-dqs) * dtsp / Sy)
+			hriv += (-kriv_r*qs_riv - dqs_riv)*dtsp/Sy_r
+			deficit = np.maximum(BOT_2 - h, 0)*Sy
+			h[:] = np.maximum(h, BOT_2)
 			
+			# Update storage change for soil-gw interactions
+			anomaly[:] = (dqsdxy-dqs) *dtsp + deficit
+			fun_update_UZ_SZ_depth(env_state, tht_dt, Droot)
+			
+			# Update the deep layer head from its storage
+			storage_2 = (deep_layer_storage(h_2, BOT, BOT_2, Sy_2, S_2)
+				+ dq_2*dtsp - deficit)
+			h_2[core] = deep_layer_head(storage_2, BOT, BOT_2, Sy_2, S_2)[core]
+			
+			# Calculate total discharge
+			dqs[riv] += dqs_riv*kAriv_r
+			discharge[:] += dqs*dtsp
+			
+			# Calculate maximum time step
+			dtsp = self.time_step_2Layer(Sy, T, np.where(h_2 > BOT_2, S_2, Sy_2), T_2,
+				env_state.SZgrid.dx, core_nodes)
+			
+			# Update time step
 			if dtsp <= 0:
 				raise Exception("invalid time step", dtsp)
 			if dtp == dt:
@@ -242,16 +348,48 @@ class gwflow_EFD(object):
 				dtp += dtsp
 			else:
 				dtp += dtsp
-			
-		self.wte_dt = np.array(env_state.SZgrid.at_node['water_table__elevation'])
-		
-		env_state.SZgrid.at_node['discharge'][:] *= (1/dt)
-		
-		env_state.grid.at_node['riv_sat_deficit'][:] = np.power(env_state.grid.dx,2)\
-				*np.array(env_state.grid.at_node['topographic__elevation']-\
-				env_state.SZgrid.at_node['water_table__elevation'][:])
 		
-		pass
+		self.hriv[riv] = hriv
+		self.deep_storage_change = np.sum((deep_layer_storage(h_2, BOT, BOT_2,
+			Sy_2, S_2) - storage_ini)[core_nodes])
+	
+	def courant_time_step(self, Sy, Tmax, dx, core_nodes):
+		"""Maximum stable time step of core nodes (time_step_confined),
+		the limiting node is recorded by the telemetry
+		"""
+		if self.telemetry is not None:
+			self.telemetry.limit(COURANT_2D*Sy[core_nodes]*np.power(dx, 2)
+				/ (4*Tmax[core_nodes]), core_nodes)
+		return time_step_confined(COURANT_2D, Sy, Tmax, dx, core_nodes)
+	
+	def save_telemetry(self, fname):
+		"""Save the sub-steps of groundwater steps and the map of Courant
+		limiting nodes, fname is the output file prefix
+		"""
+		if self.telemetry is not None:
+			self.telemetry.save(fname)
+	
+	def time_step_2Layer(self, S_1, T_1, S_2, T_2, dx, core_nodes):
+		"""Maximum stable time step of core nodes of both layers, it is
+		not limited where layers are dry
+		"""
+		rate = np.maximum(self.ops.max_at_node(T_1)/S_1,
+			self.ops.max_at_node(T_2)/S_2)[core_nodes]
+		with np.errstate(divide='ignore'):
+			dt_node = COURANT_2D*np.power(dx, 2)/(4*rate)
+		dt_node[dt_node <= 0] = np.inf
+		if self.telemetry is not None:
+			self.telemetry.limit(dt_node, core_nodes)
+		return np.min(dt_node)
+	
+	def upstream_transmissivity(self, Ksat, b, h):
+		"""Transmissivity at links from the saturated thickness b of the
+		upstream node, dry nodes do not drain.
+		"""
+		up = np.where(h[self.ops.head] > h[self.ops.tail], self.ops.head, self.ops.tail)
+		T = np.zeros(len(Ksat))
+		T[self.act_links] = Ksat[self.act_links]*np.maximum(b[up[self.act_links]], 0)
+		return T
 	
 	def run_one_step_gw(self, env_state, dt, tht_dt, Droot):
 		"""
@@ -270,13 +408,67 @@ class gwflow_EFD(object):
 					
 		Groundwater storage variation
 		"""
-		act_links = env_state.SZgrid.active_links
+		if self.layers == 2:
+			self.run_one_step_gw_2Layer(env_state, dt, tht_dt, Droot)
+		elif self.solver == 1:
+			self.implicit_step(env_state, dt, tht_dt, Droot)
+		elif self.solver == 2:
+			self.explicit_steps_compiled(env_state, dt, tht_dt, Droot)
+		elif self.solver == 3:
+			self.factorized_step(env_state, dt, tht_dt, Droot)
+		elif self.local_steps == 1:
+			self.local_explicit_steps(env_state, dt, tht_dt, Droot)
+		elif self.dormant_tol > 0:
+			self.quiescent_explicit_steps(env_state, dt, tht_dt, Droot)
+		elif self.domain is not None:
+			self.dh[:] = 0
+			nsteps = self.domain.run(self, env_state, dt, tht_dt, Droot)
+			perf.count('groundwater sub-steps', nsteps)
+			perf.count('groundwater node updates', nsteps*len(self.hriv))
+		else:
+			self.explicit_steps(env_state, dt, tht_dt, Droot)
+		
+		if self.telemetry is not None:
+			self.telemetry.end_step()
+		
+		# Update state variables
+		self.dh = np.array(env_state.SZgrid.at_node['water_table__elevation'])-self.wte_dt
+		self.wte_dt = np.array(env_state.SZgrid.at_node['water_table__elevation'])
+
+		env_state.SZgrid.at_node['discharge'][:] *= (1/dt)
+
+		env_state.grid.at_node['riv_sat_deficit'][:] = (np.power(env_state.grid.dx,2)
+				* np.array(env_state.grid.at_node['river_topo_elevation'][:]
+				- env_state.SZgrid.at_node['water_table__elevation'][:]))
+
+		env_state.grid.at_node['riv_sat_deficit'][env_state.grid.at_node['riv_sat_deficit'][:] < 0] = 0.0
+
+		if self.act_fix_link == 1:
+				self.flux_out *= 1/dt
+		
+		pass
+	
+	def explicit_steps(self, env_state, dt, tht_dt, Droot):
+		"""Explicit groundwater sub-steps over dt, the sub-step is limited
+		by the Courant number.
+		"""
+		# Fields that do not change during sub-steps
+		z = env_state.SZgrid.at_node['topographic__elevation']
+		Sy = env_state.SZgrid.at_node['SZ_Sy']
+		BOT = env_state.SZgrid.at_node['BOT']
+		FHB = env_state.SZgrid.at_node['SZ_FHB']
+		recharge = env_state.SZgrid.at_node['recharge']
+		discharge = env_state.SZgrid.at_node['discharge']
+		anomaly = env_state.SZgrid.at_node['water_storage_anomaly']
+		z_riv = env_state.grid.at_node['river_topo_elevation']
+		SS_loss = env_state.grid.at_node['SS_loss']
+		core_nodes = env_state.SZgrid.core_nodes
 		
-		T = transmissivity(env_state, self.Ksat, act_links, self.faq, self.zm)
+		T = self.link_transmissivity(env_state,
+			env_state.SZgrid.at_node['water_table__elevation'])
 		
-		dts = time_step_confined(COURANT_2D, env_state.SZgrid.at_node['SZ_Sy'],
-			map_max_of_node_links_to_node(env_state.SZgrid, T),
-			env_state.SZgrid.dx, env_state.SZgrid.core_nodes)
+		dts = self.courant_time_step(Sy, self.ops.max_at_node(T),
+			env_state.SZgrid.dx, core_nodes)
 	
 		stage = env_state.grid.at_node['Q_ini'] * self.kriv
 		
@@ -284,120 +476,105 @@ class gwflow_EFD(object):
 		
 		aux_riv[stage > 0] = 0
 		
-		Tch = exponential_T(env_state.grid.at_node['SS_loss'], STR_RIVER,
-				env_state.grid.at_node['river_topo_elevation'], self.hriv)
-		
-		dts_riv = time_step_confined(COURANT_1D, env_state.SZgrid.at_node['SZ_Sy'],
-						Tch/self.W, 0.25*(env_state.SZgrid.dx - self.W),
-						env_state.riv_nodes)
+		# River exchange over river nodes only
+		riv = self.riv_nodes
+		z_riv_r = z_riv[riv]
+		SS_loss_r = SS_loss[riv]
+		stage_r = stage[riv]
+		aux_riv_r = aux_riv[riv]
+		W_r = self.W[riv]
+		kriv_r = self.kriv[riv]
+		kAriv_r = self.kAriv[riv]
+		Sy_r = Sy[riv]
+		self.hriv = np.minimum(self.hriv, z_riv)
+		hriv = self.hriv[riv]
 
 		#dtp = np.nanmin([dt, dts, dts_riv])
 		dtp = np.nanmin([dt, dts])
 		
 		dtsp = dtp
 		
-		env_state.SZgrid.at_node['discharge'][:] = 0.0
+		discharge[:] = 0.0
 
 		self.flux_out = 0
 
 		self.dh[:] = 0
 		
+		qs = np.zeros(len(self.Ksat))
+		
 		while dtp <= dt:
 
+			perf.count('groundwater sub-steps')
+			perf.count('groundwater node updates', len(z))
+			if self.telemetry is not None:
+				self.telemetry.substep(dtsp)
+			
+			# The water table field is replaced by fun_update_UZ_SZ_depth
+			h = env_state.SZgrid.at_node['water_table__elevation']
+
 			# Make water table always greater or equal to bottom elevation
-			env_state.SZgrid.at_node['water_table__elevation'][:] = np.minimum(
-				env_state.SZgrid.at_node['topographic__elevation'],
-				env_state.SZgrid.at_node['water_table__elevation'])
+			h[:] = np.minimum(z, h)
 						
 			# Make water table always above the bottom elevation
 			if env_state.func == 2:
-				env_state.SZgrid.at_node['water_table__elevation'][:] = np.maximum(
-					env_state.SZgrid.at_node['water_table__elevation'],
-					env_state.SZgrid.at_node['BOT'])
+				h[:] = np.maximum(h, BOT)
 
 			# Make river water table always below or equal surface elevation
-			self.hriv = np.minimum(self.hriv,
-				env_state.grid.at_node['river_topo_elevation'])
+			hriv = np.minimum(hriv, z_riv_r)
 
 			# Calculate transmissivity
-			T = transmissivity(env_state, self.Ksat, act_links, self.faq, self.zm)
+			T = self.link_transmissivity(env_state, h)
 
 			# Calculate the hydraulic gradients			
-			dhdl = env_state.SZgrid.calc_grad_at_link(env_state.SZgrid.at_node['water_table__elevation'])
+			dhdl = self.ops.grad_at_link(h)
 
 			# Calculate flux per unit length at each face
-			qs = np.zeros(len(self.Ksat))
-			qs[act_links] = -T[act_links]*dhdl[act_links]
+			qs[self.act_links] = -T[self.act_links]*dhdl[self.act_links]
 			
 			if self.act_fix_link == 1:
 				self.flux_out += (np.sum(qs[self.fixed_links])/env_state.SZgrid.dx)*dtsp
 
 			# Calculate flux head boundary conditions
-			dfhbc = exponential_T(env_state.SZgrid.at_node['SZ_FHB'], 60,
-				env_state.SZgrid.at_node['topographic__elevation'],
-				env_state.SZgrid.at_node['water_table__elevation'])
+			dfhbc = exponential_T(FHB, 60, z, h)
 			self.flux_out += np.sum(dfhbc)
 
 			# Calculate flux gradient
-			dqsdxy = (-env_state.SZgrid.calc_flux_div_at_node(qs)
-					- dfhbc + env_state.SZgrid.at_node['recharge']/dt)		# This one here needs a bit time to warm up in the first interation
+			dqsdxy = (-self.ops.flux_div_at_node(qs)
+					- dfhbc + recharge/dt)		# This one here needs a bit time to warm up in the first interation
 
 			# Calculate river cell flux
-			Tch = exponential_T(env_state.grid.at_node['SS_loss'], STR_RIVER,
-				env_state.grid.at_node['river_topo_elevation'], self.hriv)
-
-			diff_stage = (env_state.SZgrid.at_node['water_table__elevation']
-				- self.hriv)
+			qs_riv = river_cell_flux(SS_loss_r, z_riv_r, hriv, h[riv], stage_r,
+				aux_riv_r, W_r, env_state.SZgrid.dx)
 			
-			stage_aux = np.array(stage)
-			stage_aux[diff_stage < 0] = 0
-			
-			qs_riv = -(Tch*(diff_stage-stage_aux)*50 / (env_state.SZgrid.dx - self.W))
-			qs_riv[qs_riv < 0] = qs_riv[qs_riv < 0]*aux_riv[qs_riv < 0]
-			
-			dqsdxy += self.kaq*qs_riv
+			dqsdxy[riv] += self.kaq*qs_riv
 
 			# Regularization approach for aquifer cells
 			if env_state.func == 1 or  env_state.func == 2:
-				dqs = regularization_T(
-					env_state.SZgrid.at_node['topographic__elevation'],
-					env_state.SZgrid.at_node['water_table__elevation'],
-					self.faq_node, dqsdxy, REG_FACTOR)
+				dqs = regularization_T(z, h, self.faq_node, dqsdxy, REG_FACTOR)
 			
 			else:
-				dqs = regularization(
-					env_state.SZgrid.at_node['topographic__elevation'],
-					env_state.SZgrid.at_node['water_table__elevation'],
-					env_state.SZgrid.at_node['BOT'],
-					dqsdxy, REG_FACTOR)
+				dqs = regularization(z, h, BOT, dqsdxy, REG_FACTOR)
 			
 			# Regularization approach for river cells
-			dqs_riv = regularization_T(
-				env_state.grid.at_node['river_topo_elevation'],
-				self.hriv, 	self.f, -self.kriv*qs_riv, REG_FACTOR)
+			dqs_riv = regularization_T(z_riv_r, hriv, self.f,
+				-kriv_r*qs_riv, REG_FACTOR)
 
 			# Update the head elevations
-			env_state.SZgrid.at_node['water_table__elevation'] += ((dqsdxy-dqs)
-				* dtsp / env_state.SZgrid.at_node['SZ_Sy'])
+			h += ((dqsdxy-dqs) * dtsp / Sy)
 						
-			self.hriv += (-self.kriv*qs_riv - dqs_riv)*dtsp/env_state.SZgrid.at_node['SZ_Sy']
+			hriv += (-kriv_r*qs_riv - dqs_riv)*dtsp/Sy_r
 
 			# Update storage change for soil-gw interactions
-			env_state.SZgrid.at_node['water_storage_anomaly'][:] = (dqsdxy-dqs) *dtsp			
+			anomaly[:] = (dqsdxy-dqs) *dtsp			
 			fun_update_UZ_SZ_depth(env_state, tht_dt, Droot)
 
 			# Calculate total discharge
-			env_state.SZgrid.at_node['discharge'][:] += (dqs + dqs_riv*self.kAriv)*dtsp
+			dqs[riv] += dqs_riv*kAriv_r
+			discharge[:] += dqs*dtsp
 
 			# Calculate maximum time step
-			dtsp = time_step_confined(COURANT_2D, env_state.SZgrid.at_node['SZ_Sy'],
-				map_max_of_node_links_to_node(env_state.SZgrid, T),
-				env_state.SZgrid.dx, env_state.SZgrid.core_nodes)
-			
-			dtsp_riv = time_step_confined(COURANT_1D, env_state.SZgrid.at_node['SZ_Sy'],
-						Tch/self.W, 0.02*(env_state.SZgrid.dx - self.W), env_state.riv_nodes)
-
-			#dtsp = np.min([dtsp, dtsp_riv])			
+			dtsp = self.courant_time_step(Sy, self.ops.max_at_node(T),
+				env_state.SZgrid.dx, core_nodes)
 			
 			# Update time step
 			if dtsp <= 0:
@@ -410,23 +587,756 @@ class gwflow_EFD(object):
 			else:			
 				dtp += dtsp
 		
-		# Update state variables
-		self.dh = np.array(env_state.SZgrid.at_node['water_table__elevation'])-self.wte_dt
-		self.wte_dt = np.array(env_state.SZgrid.at_node['water_table__elevation'])
+		self.hriv[riv] = hriv
+	
+	def local_explicit_steps(self, env_state, dt, tht_dt, Droot):
+		"""Explicit groundwater steps over dt with local time stepping.
+		Nodes are grouped in classes k by their Courant time step, class k
+		is updated every 2**k sub-steps of the fastest class. Links are
+		updated at the rate of their fastest node and the volume they
+		exchange is added to both nodes, so fluxes are conserved.
+		"""
+		# Fields that do not change during sub-steps
+		z = env_state.SZgrid.at_node['topographic__elevation']
+		Sy = env_state.SZgrid.at_node['SZ_Sy']
+		BOT = env_state.SZgrid.at_node['BOT']
+		discharge = env_state.SZgrid.at_node['discharge']
+		z_riv = env_state.grid.at_node['river_topo_elevation']
+		core_nodes = env_state.SZgrid.core_nodes
+		nn = len(z)
+		fc = np.broadcast_to(env_state.fc, (nn,))
+		tht = np.broadcast_to(tht_dt, (nn,))
+		Dr = np.broadcast_to(Droot, (nn,))
+		W = np.broadcast_to(self.W, (nn,))
+		head, tail = self.ops.head, self.ops.tail
+		
+		stage = env_state.grid.at_node['Q_ini'] * self.kriv
+		
+		aux_riv = np.ones(len(stage))
+		
+		aux_riv[stage > 0] = 0
+		
+		discharge[:] = 0.0
 
-		env_state.SZgrid.at_node['discharge'][:] *= (1/dt)
+		self.flux_out = 0
 
-		env_state.grid.at_node['riv_sat_deficit'][:] = (np.power(env_state.grid.dx,2)
-				* np.array(env_state.grid.at_node['river_topo_elevation'][:]
-				- env_state.SZgrid.at_node['water_table__elevation'][:]))
+		self.dh[:] = 0
+		
+		# Water table is only updated in place
+		h = np.array(env_state.SZgrid.at_node['water_table__elevation'])
+		
+		# Volume exchanged by links and flow into nodes since their last update
+		flow_link = np.zeros(len(self.Ksat))
+		flow_node = np.zeros(nn)
+		
+		t = 0.0
+		
+		while t < dt:
+			
+			# Make water table always below surface elevation, above the
+			# bottom elevation for constant transmissivity
+			h[:] = np.minimum(z, h)
+			if env_state.func == 2:
+				h[:] = np.maximum(h, BOT)
+			self.hriv = np.minimum(self.hriv, z_riv)
+			
+			# Time step of nodes, sub-step of the fastest class (base)
+			T = self.link_transmissivity(env_state, h)
+			dt_node = np.full(nn, np.inf)
+			dt_node[core_nodes] = (COURANT_2D*Sy*np.power(env_state.SZgrid.dx, 2)
+				/ (4*self.ops.max_at_node(T)))[core_nodes]
+			dt_node[~(dt_node > 0)] = np.inf
+			
+			base = min(np.min(dt_node), dt - t)
+			if base <= 0:
+				raise Exception("invalid time step", base)
+			nclass = 0
+			while nclass < LTS_MAX_CLASS and base*2**(nclass+1) <= dt - t:
+				nclass += 1
+			
+			node_class = np.minimum(np.floor(np.log2(dt_node/base)), nclass).astype(int)
+			node_class[node_class < 0] = 0
+			link_class = np.minimum(node_class[head[self.act_links]],
+				node_class[tail[self.act_links]])
+			class_links = [self.act_links[link_class == k] for k in range(nclass+1)]
+			class_nodes = [np.where(node_class == k)[0] for k in range(nclass+1)]
+			
+			for m in range(2**nclass):
+				
+				perf.count('groundwater sub-steps')
+				
+				for k in range(nclass+1):
+					if m % 2**k != 0 or len(class_links[k]) == 0:
+						continue
+					# Volume exchanged by links starting their step
+					links = class_links[k]
+					dtk = base*2**k
+					qs = (-self.active_transmissivity(env_state, h, links)
+						* (h[head[links]] - h[tail[links]])*self.ops.inv_length[links])
+					flow_link[links] += qs*dtk
+					vol = qs*self.ops.width_at_link[links]*dtk
+					flow_node += np.bincount(head[links], vol, minlength=nn)
+					flow_node -= np.bincount(tail[links], vol, minlength=nn)
+				
+				# Nodes ending their step
+				nodes = [class_nodes[k] for k in range(nclass+1)
+					if (m+1) % 2**k == 0]
+				dtv = np.concatenate([np.full(len(class_nodes[k]), base*2**k)
+					for k in range(nclass+1) if (m+1) % 2**k == 0])
+				nodes = np.concatenate(nodes)
+				if len(nodes) == 0:
+					continue
+				perf.count('groundwater node updates', len(nodes))
+				
+				self.update_nodes(env_state, nodes, h, flow_node, dtv, dt, stage,
+					aux_riv, tht, fc, Dr, W)
+			
+			# Update time, the last step ends at dt
+			if base*2**nclass >= dt - t:
+				t = dt
+			else:
+				t += base*2**nclass
+		
+		if self.act_fix_link == 1:
+			self.flux_out += np.sum(flow_link[self.fixed_links])/env_state.SZgrid.dx
+		
+		env_state.SZgrid.at_node['water_table__elevation'][:] = h
+	
+	def quiescent_explicit_steps(self, env_state, dt, tht_dt, Droot):
+		"""Explicit groundwater sub-steps over dt of active nodes only.
+		Nodes whose head change rate (at the start of the step and over
+		the last step) is below the tolerance are dormant and advanced with
+		a single step of dt. Volumes exchanged by links between active and
+		dormant nodes are accumulated during the sub-steps, so fluxes are
+		conserved. Dormant nodes are reactivated when the flow of active
+		neighbours would change their heads more than the tolerance over dt,
+		they are first advanced to the current time.
+		"""
+		# Fields that do not change during sub-steps
+		z = env_state.SZgrid.at_node['topographic__elevation']
+		Sy = env_state.SZgrid.at_node['SZ_Sy']
+		BOT = env_state.SZgrid.at_node['BOT']
+		FHB = env_state.SZgrid.at_node['SZ_FHB']
+		recharge = env_state.SZgrid.at_node['recharge']
+		discharge = env_state.SZgrid.at_node['discharge']
+		anomaly = env_state.SZgrid.at_node['water_storage_anomaly']
+		z_riv = env_state.grid.at_node['river_topo_elevation']
+		SS_loss = env_state.grid.at_node['SS_loss']
+		core_nodes = env_state.SZgrid.core_nodes
+		nn = len(z)
+		fc = np.broadcast_to(env_state.fc, (nn,))
+		tht = np.broadcast_to(tht_dt, (nn,))
+		Dr = np.broadcast_to(Droot, (nn,))
+		W = np.broadcast_to(self.W, (nn,))
+		head, tail = self.ops.head, self.ops.tail
+		width = self.ops.width_at_link
+		
+		stage = env_state.grid.at_node['Q_ini'] * self.kriv
+		
+		aux_riv = np.ones(len(stage))
+		
+		aux_riv[stage > 0] = 0
+		
+		# Head change over the last step
+		rate_dt = np.abs(self.dh)/dt
+		
+		discharge[:] = 0.0
 
-		env_state.grid.at_node['riv_sat_deficit'][env_state.grid.at_node['riv_sat_deficit'][:] < 0] = 0.0
+		self.flux_out = 0
 
+		self.dh[:] = 0
+		
+		# Water table is only updated in place
+		h = np.array(env_state.SZgrid.at_node['water_table__elevation'])
+		h[:] = np.minimum(z, h)
+		if env_state.func == 2:
+			h[:] = np.maximum(h, BOT)
+		self.hriv = np.minimum(self.hriv, z_riv)
+		
+		# Head change rate at the start of the step
+		links = self.act_links
+		qs = (-self.active_transmissivity(env_state, h, links)
+			* (h[head[links]] - h[tail[links]])*self.ops.inv_length[links])
+		inflow = (np.bincount(head[links], qs*width[links], minlength=nn)
+			- np.bincount(tail[links], qs*width[links], minlength=nn))
+		dqsdxy = (inflow*self.ops.inv_area_at_node
+			- exponential_T(FHB, 60, z, h) + recharge/dt)
+		qs_riv = river_cell_flux(SS_loss, z_riv, self.hriv, h, stage, aux_riv,
+			W, env_state.SZgrid.dx)
+		dqsdxy += self.kaq*qs_riv
+		if env_state.func == 1 or  env_state.func == 2:
+			dqs = regularization_T(z, h, self.faq_node, dqsdxy, REG_FACTOR)
+		else:
+			dqs = regularization(z, h, BOT, dqsdxy, REG_FACTOR)
+		dq_riv = -self.kriv*qs_riv
+		dq_riv -= regularization_T(z_riv, self.hriv, self.f, dq_riv, REG_FACTOR)
+		rate = np.maximum(np.abs(dqsdxy - dqs), np.abs(dq_riv))/Sy
+		
+		# Dormant nodes, their heads change slower than the tolerance
+		active = ~((rate < self.dormant_tol) & (rate_dt < self.dormant_tol))
+		perf.count('groundwater dormant nodes', int(np.sum(~active)))
+		
+		# Volume exchanged by links and flow into nodes since their last update
+		flow_link = np.zeros(len(self.Ksat))
+		flow_node = np.zeros(nn)
+		
+		# Links with an active node are sub-stepped
+		link_on = np.zeros(len(links), dtype=bool)
+		
+		new = np.where(active)[0]
+		nodes = new
+		t = 0.0
+		
+		while True:
+			
+			if len(new) > 0:
+				# Links starting their sub-steps exchanged the volume of
+				# the start of the step until t
+				on = (active[head[links]] | active[tail[links]]) & ~link_on
+				link_on |= on
+				flow_link[links[on]] += qs[on]*t
+				vol = qs[on]*width[links[on]]*t
+				flow_node += np.bincount(head[links[on]], vol, minlength=nn)
+				flow_node -= np.bincount(tail[links[on]], vol, minlength=nn)
+				
+				# Reactivated nodes are advanced to t
+				if t > 0:
+					perf.count('groundwater reactivated nodes', len(new))
+					self.update_nodes(env_state, new, h, flow_node, t, dt, stage,
+						aux_riv, tht, fc, Dr, W)
+				
+				nodes = np.where(active)[0]
+				sub_links = links[link_on]
+				sub_core = core_nodes[active[core_nodes]]
+				links_at_core = self.ops.links_at_node[sub_core]
+			
+			if t >= dt or len(nodes) == 0:
+				break
+			
+			perf.count('groundwater sub-steps')
+			perf.count('groundwater node updates', len(nodes))
+			
+			hi = np.minimum(z[nodes], h[nodes])
+			if env_state.func == 2:
+				hi = np.maximum(hi, BOT[nodes])
+			h[nodes] = hi
+			
+			# Courant time step of active core nodes
+			T = np.zeros(len(self.Ksat))
+			T[sub_links] = self.active_transmissivity(env_state, h, sub_links)
+			T_node = np.where(links_at_core >= 0, T[links_at_core], -np.inf)
+			dt_node = (COURANT_2D*Sy[sub_core]*np.power(env_state.SZgrid.dx, 2)
+				/ (4*np.max(T_node, axis=1)))
+			if self.telemetry is not None:
+				self.telemetry.limit(dt_node, sub_core)
+			dt_node = dt_node[dt_node > 0]
+			dtsp = dt - t
+			if len(dt_node) > 0:
+				dtsp = min(np.min(dt_node), dtsp)
+			if dtsp <= 0:
+				raise Exception("invalid time step", dtsp)
+			if self.telemetry is not None:
+				self.telemetry.substep(dtsp)
+			
+			# Volume exchanged by links of active nodes
+			qs_sub = (-T[sub_links]*(h[head[sub_links]] - h[tail[sub_links]])
+				* self.ops.inv_length[sub_links])
+			flow_link[sub_links] += qs_sub*dtsp
+			vol = qs_sub*width[sub_links]*dtsp
+			flow_node += np.bincount(head[sub_links], vol, minlength=nn)
+			flow_node -= np.bincount(tail[sub_links], vol, minlength=nn)
+			
+			self.update_nodes(env_state, nodes, h, flow_node, dtsp, dt, stage,
+				aux_riv, tht, fc, Dr, W)
+			
+			t = t + dtsp if dt - t - dtsp > 1e-9*dt else dt
+			
+			# Dormant nodes reached by the flow of active nodes
+			new = np.where(~active & (np.abs(flow_node)*self.ops.inv_area_at_node/Sy
+				> self.dormant_tol*dt))[0]
+			active[new] = True
+		
+		# Links between dormant nodes exchange the volume of the start of
+		# the step, dormant nodes are advanced with a single step
+		still = ~link_on
+		flow_link[links[still]] += qs[still]*dt
+		vol = qs[still]*width[links[still]]*dt
+		flow_node += np.bincount(head[links[still]], vol, minlength=nn)
+		flow_node -= np.bincount(tail[links[still]], vol, minlength=nn)
+		dormant = np.where(~active)[0]
+		if len(dormant) > 0:
+			perf.count('groundwater node updates', len(dormant))
+			self.update_nodes(env_state, dormant, h, flow_node, dt, dt, stage,
+				aux_riv, tht, fc, Dr, W)
+		
 		if self.act_fix_link == 1:
-				self.flux_out *= 1/dt
+			self.flux_out += np.sum(flow_link[self.fixed_links])/env_state.SZgrid.dx
+		
+		env_state.SZgrid.at_node['water_table__elevation'][:] = h
+	
+	def update_nodes(self, env_state, nodes, h, flow_node, dtv, dt, stage, aux_riv,
+			tht, fc, Dr, W):
+		"""Update heads of nodes over dtv (scalar or per node) from the
+		volume that flowed into them (flow_node, reset here), boundary
+		fluxes, recharge and river exchange; soil-gw interactions and
+		discharge are updated.
+		"""
+		z = env_state.SZgrid.at_node['topographic__elevation']
+		Sy = env_state.SZgrid.at_node['SZ_Sy']
+		BOT = env_state.SZgrid.at_node['BOT']
+		discharge = env_state.SZgrid.at_node['discharge']
+		anomaly = env_state.SZgrid.at_node['water_storage_anomaly']
+		z_riv = env_state.grid.at_node['river_topo_elevation']
+		ths = env_state.grid.at_node['saturated_water_content']
+		
+		hi = h[nodes]
+		dtv = np.broadcast_to(dtv, (len(nodes),))
+		
+		# River nodes of the update
+		rpos = np.where(self.is_river[nodes])[0]
+		rnodes = nodes[rpos]
+		hriv = np.minimum(self.hriv[rnodes], z_riv[rnodes])
+		
+		# Calculate flux head boundary conditions
+		dfhbc = exponential_T(env_state.SZgrid.at_node['SZ_FHB'][nodes], 60, z[nodes], hi)
+		self.flux_out += np.sum(dfhbc)
+		
+		# Calculate flux gradient
+		dqsdxy = (flow_node[nodes]*self.ops.inv_area_at_node[nodes]/dtv
+			- dfhbc + env_state.SZgrid.at_node['recharge'][nodes]/dt)
+		flow_node[nodes] = 0.0
+		
+		# Calculate river cell flux
+		qs_riv = river_cell_flux(env_state.grid.at_node['SS_loss'][rnodes],
+			z_riv[rnodes], hriv, hi[rpos], stage[rnodes], aux_riv[rnodes], W[rnodes],
+			env_state.SZgrid.dx)
+		
+		dqsdxy[rpos] += self.kaq*qs_riv
+		
+		# Regularization approach for aquifer and river cells
+		if env_state.func == 1 or  env_state.func == 2:
+			dqs = regularization_T(z[nodes], hi, self.faq_node[nodes],
+				dqsdxy, REG_FACTOR)
+		else:
+			dqs = regularization(z[nodes], hi, BOT[nodes], dqsdxy, REG_FACTOR)
+		
+		dqs_riv = regularization_T(z_riv[rnodes], hriv, self.f,
+			-self.kriv[rnodes]*qs_riv, REG_FACTOR)
+		
+		# Update the head elevations and soil-gw interactions
+		anomaly[nodes] = (dqsdxy-dqs)*dtv
+		hi, dis = update_UZ_SZ_depth(hi + (dqsdxy-dqs)*dtv/Sy[nodes],
+			anomaly[nodes], Sy[nodes], ths[nodes], tht[nodes], fc[nodes],
+			z[nodes], Dr[nodes])
+		if env_state.func == 2:
+			hi = np.maximum(hi, BOT[nodes])
+		h[nodes] = hi
+		
+		self.hriv[rnodes] = np.minimum(hriv
+			+ (-self.kriv[rnodes]*qs_riv - dqs_riv)*dtv[rpos]/Sy[rnodes], z_riv[rnodes])
+		
+		# Calculate total discharge
+		dqs[rpos] += dqs_riv*self.kAriv[rnodes]
+		discharge[nodes] += dis + dqs*dtv
+	
+	def active_transmissivity(self, env_state, h, links):
+		"""Transmissivity at a subset of active links"""
+		if env_state.func == 2: # Constant transmissivity
+			return self.Ksat[links]
+		
+		hm = 0.5*(h[self.ops.head[links]] + h[self.ops.tail[links]])
+		
+		if env_state.func == 1: # Variable transmissivity
+			return exponential_T(self.Ksat[links], self.faq[links], self.zm[links], hm)
+		
+		# Unconfined aquifer
+		return self.Ksat[links]*(hm - self.bm[links])
+	
+	def explicit_steps_compiled(self, env_state, dt, tht_dt, Droot):
+		"""Explicit groundwater sub-steps over dt in the compiled kernel,
+		heads are updated in place.
+		"""
+		self.dh[:] = 0
+		
+		stage = env_state.grid.at_node['Q_ini'] * self.kriv
+		
+		aux_riv = np.ones(len(stage))
+		
+		aux_riv[stage > 0] = 0
+		
+		nsteps, self.flux_out = explicit_steps_jit(dt, env_state.func,
+			env_state.SZgrid.dx, COURANT_2D, REG_FACTOR, self.f, STR_RIVER,
+			env_state.SZgrid.at_node['water_table__elevation'], self.hriv,
+			env_state.SZgrid.at_node['topographic__elevation'],
+			env_state.SZgrid.at_node['BOT'],
+			env_state.SZgrid.at_node['SZ_Sy'],
+			env_state.SZgrid.at_node['SZ_FHB'],
+			env_state.SZgrid.at_node['recharge'],
+			env_state.grid.at_node['river_topo_elevation'],
+			env_state.grid.at_node['SS_loss'],
+			stage, aux_riv, self.W, self.kriv, self.kaq, self.kAriv, self.faq_node,
+			env_state.grid.at_node['saturated_water_content'],
+			np.asarray(env_state.fc, dtype=float), np.asarray(tht_dt, dtype=float),
+			np.asarray(Droot, dtype=float),
+			self.Ksat, self.faq, self.zm, self.bm,
+			self.ops.head, self.ops.tail, self.ops.inv_length, self.act_link,
+			self.ops.links_at_node, self.ops.cells, self.ops.area,
+			self.ops.links_at_cell, self.ops.width_at_cell, self.ops.dirs_at_cell,
+			env_state.SZgrid.core_nodes, self.fixed_link_index,
+			env_state.SZgrid.at_node['discharge'],
+			env_state.SZgrid.at_node['water_storage_anomaly'],
+			self.T_buffer, np.zeros(len(self.Ksat)), np.zeros(len(self.hriv)),
+			np.zeros(len(env_state.SZgrid.core_nodes)))
+		
+		perf.count('groundwater sub-steps', nsteps)
+	
+	def link_transmissivity(self, env_state, h):
+		"""Transmissivity at links for water table h, static link values
+		are computed once.
+		"""
+		if env_state.func == 2: # Constant transmissivity
+			return self.T_static
+		
+		hm = self.ops.mean_at_link(h)
+		
+		if env_state.func == 1: # Variable transmissivity
+			return exponential_T(self.Ksat, self.faq, self.zm, hm)
+		
+		# Unconfined aquifer
+		T = np.zeros(len(self.Ksat))
+		T[self.act_links] = self.Ksat[self.act_links]*(hm[self.act_links]-self.bm[self.act_links])
+		return T
+	
+	def implicit_step(self, env_state, dt, tht_dt, Droot):
+		"""Backward Euler groundwater step over dt. Transmissivity, head
+		boundary fluxes, river exchange and regularization are linearized
+		at the last iterate (Picard iterations), river heads are eliminated
+		node by node and the conductance system is solved on SZgrid.
+		"""
+		act_links = env_state.SZgrid.active_links
+		
+		Sy = env_state.SZgrid.at_node['SZ_Sy']
+		z = env_state.SZgrid.at_node['topographic__elevation']
+		z_riv = env_state.grid.at_node['river_topo_elevation']
+		h = env_state.SZgrid.at_node['water_table__elevation']
+		
+		# Make water table always below or equal surface elevation
+		h[:] = np.minimum(z, h)
+		
+		# Make water table always above the bottom elevation
+		if env_state.func == 2:
+			h[:] = np.maximum(h, env_state.SZgrid.at_node['BOT'])
+		
+		# Make river water table always below or equal surface elevation
+		self.hriv = np.minimum(self.hriv, z_riv)
+		
+		stage = env_state.grid.at_node['Q_ini'] * self.kriv
+		
+		aux_riv = np.ones(len(stage))
+		
+		aux_riv[stage > 0] = 0
+		
+		env_state.SZgrid.at_node['discharge'][:] = 0.0
+		
+		self.flux_out = 0
+		
+		self.dh[:] = 0
+		
+		h0 = np.array(h)
+		hriv0 = np.array(self.hriv)
+		S = Sy/dt
+		unit = np.ones(len(h))
+		
+		for it in range(PICARD_MAX_ITER):
+			
+			perf.count('groundwater Picard iterations')
+			
+			# Conductance matrix, net inflow of nodes is L*h
+			T = np.zeros(len(self.Ksat))
+			T[act_links] = self.link_transmissivity(env_state, h)[act_links]
+			L = self.ops.div @ sparse.diags(T) @ self.ops.grad
+			
+			# Calculate flux head boundary conditions
+			dfhbc = exponential_T(env_state.SZgrid.at_node['SZ_FHB'], 60, z, h)
+			
+			# River conductance, river cells only drain if there is no flow
+			Tch = exponential_T(env_state.grid.at_node['SS_loss'], STR_RIVER,
+				z_riv, self.hriv)
+			
+			diff_stage = h - self.hriv
+			
+			stage_aux = np.array(stage)
+			stage_aux[diff_stage < 0] = 0
+			
+			Criv = Tch*50 / (env_state.SZgrid.dx - self.W)
+			Criv[diff_stage - stage_aux > 0] *= aux_riv[diff_stage - stage_aux > 0]
+			
+			# Net inflow of aquifer and river cells at the last iterate
+			qs_riv = -Criv*(diff_stage - stage_aux)
+			dqsdxy = (L @ h - dfhbc + env_state.SZgrid.at_node['recharge']/dt
+				+ self.kaq*qs_riv)
+			dqsdxy_riv = -self.kriv*qs_riv
+			
+			# Fraction of the inflow stored, the rest is rejected as discharge
+			if env_state.func == 1 or  env_state.func == 2:
+				w = 1 - regularization_T(z, h, self.faq_node, unit, REG_FACTOR)*(dqsdxy > 0)
+			else:
+				w = 1 - regularization(z, h, env_state.SZgrid.at_node['BOT'],
+					unit, REG_FACTOR)*(dqsdxy > 0)
+			w_riv = 1 - regularization_T(z_riv, self.hriv, self.f, unit,
+				REG_FACTOR)*(dqsdxy_riv > 0)
+			
+			# River heads as a function of aquifer heads: hriv = (b + a*h)/(S + a)
+			a = w_riv*self.kriv*Criv
+			b = S*hriv0 - a*stage_aux
+			c = w*self.kaq*Criv
+			
+			A = sparse.diags(S + c - c*a/(S + a)) - sparse.diags(w) @ L
+			rhs = (S*h0 + c*b/(S + a)
+				+ w*(-dfhbc + env_state.SZgrid.at_node['recharge']/dt + self.kaq*Criv*stage_aux))
+			
+			h_it = spsolve(A.tocsc(), rhs)
+			
+			change = np.max(np.abs(h_it - h))
+			h[:] = h_it
+			self.hriv = (b + a*h_it)/(S + a)
+			
+			if change < PICARD_TOL:
+				break
+		else:
+			perf.count('groundwater Picard not converged')
+		
+		# One implicit step of dt, compared with explicit sub-steps
+		perf.count('groundwater sub-steps')
+		
+		# Fluxes at the new heads with the coefficients of the last iterate
+		qs_riv = -Criv*(h - self.hriv - stage_aux)
+		dqsdxy = (L @ h - dfhbc + env_state.SZgrid.at_node['recharge']/dt
+			+ self.kaq*qs_riv)
+		dqs = (1 - w)*dqsdxy
+		dqs_riv = (1 - w_riv)*(-self.kriv*qs_riv)
+		
+		if self.act_fix_link == 1:
+			qs = np.zeros(len(self.Ksat))
+			qs[act_links] = -T[act_links]*self.ops.grad_at_link(h)[act_links]
+			self.flux_out += (np.sum(qs[self.fixed_links])/env_state.SZgrid.dx)*dt
+		self.flux_out += np.sum(dfhbc)*dt
+		
+		# Update storage change for soil-gw interactions
+		env_state.SZgrid.at_node['water_storage_anomaly'][:] = (dqsdxy-dqs)*dt
+		fun_update_UZ_SZ_depth(env_state, tht_dt, Droot)
+		
+		# Calculate total discharge
+		env_state.SZgrid.at_node['discharge'][:] += (dqs + dqs_riv*self.kAriv)*dt
 		
 		pass
 	
+	def factorized_step(self, env_state, dt, tht_dt, Droot):
+		"""Groundwater step over dt for constant transmissivity. Flow
+		between cells is implicit (backward Euler) with a system matrix
+		factorized once, head boundary fluxes and river exchange use the
+		heads at the start of the step (river heads are implicit node by
+		node) and inflow rejected by the regularization is discharged.
+		"""
+		Sy = env_state.SZgrid.at_node['SZ_Sy']
+		z = env_state.SZgrid.at_node['topographic__elevation']
+		z_riv = env_state.grid.at_node['river_topo_elevation']
+		h = env_state.SZgrid.at_node['water_table__elevation']
+		
+		# Make water table always below or equal surface elevation and
+		# above the bottom elevation
+		h[:] = np.maximum(np.minimum(z, h), env_state.SZgrid.at_node['BOT'])
+		
+		# Make river water table always below or equal surface elevation
+		self.hriv = np.minimum(self.hriv, z_riv)
+		
+		S = Sy/dt
+		
+		# System matrix of the step, factorized only if dt changes
+		if self.lu is None or self.lu_dt != dt:
+			L = self.ops.div @ sparse.diags(self.T_static) @ self.ops.grad
+			self.lu = splu((sparse.diags(S) - L).tocsc())
+			self.lu_dt = dt
+			perf.count('groundwater factorizations')
+		
+		stage = env_state.grid.at_node['Q_ini'] * self.kriv
+		
+		aux_riv = np.ones(len(stage))
+		
+		aux_riv[stage > 0] = 0
+		
+		env_state.SZgrid.at_node['discharge'][:] = 0.0
+		
+		self.flux_out = 0
+		
+		self.dh[:] = 0
+		
+		h0 = np.array(h)
+		
+		# Calculate flux head boundary conditions
+		dfhbc = exponential_T(env_state.SZgrid.at_node['SZ_FHB'], 60, z, h0)
+		
+		# River exchange, river heads are implicit for the aquifer head h0
+		Tch = exponential_T(env_state.grid.at_node['SS_loss'], STR_RIVER,
+			z_riv, self.hriv)
+		
+		diff_stage = h0 - self.hriv
+		
+		stage_aux = np.array(stage)
+		stage_aux[diff_stage < 0] = 0
+		
+		Criv = Tch*50 / (env_state.SZgrid.dx - self.W)
+		Criv[diff_stage - stage_aux > 0] *= aux_riv[diff_stage - stage_aux > 0]
+		
+		w_riv = 1 - regularization_T(z_riv, self.hriv, self.f, np.ones(len(h0)),
+			REG_FACTOR)*(diff_stage - stage_aux > 0)
+		a = w_riv*self.kriv*Criv
+		self.hriv = (S*self.hriv + a*(h0 - stage_aux))/(S + a)
+		
+		qs_riv = -Criv*(h0 - self.hriv - stage_aux)
+		dqs_riv = (1 - w_riv)*(-self.kriv*qs_riv)
+		
+		# Flow between cells, one solve with the factorized matrix
+		h_lin = self.lu.solve(S*h0 - dfhbc + env_state.SZgrid.at_node['recharge']/dt
+			+ self.kaq*qs_riv)
+		perf.count('groundwater sub-steps')
+		
+		# Regularization approach for aquifer cells
+		dqsdxy = S*(h_lin - h0)
+		dqs = regularization_T(z, h0, self.faq_node, dqsdxy, REG_FACTOR)
+		
+		if self.act_fix_link == 1:
+			qs = -self.T_static*self.ops.grad_at_link(h_lin)
+			self.flux_out += (np.sum(qs[self.fixed_links])/env_state.SZgrid.dx)*dt
+		self.flux_out += np.sum(dfhbc)*dt
+		
+		# Update the head elevations and soil-gw interactions
+		h[:] = h0 + (dqsdxy-dqs)*dt/Sy
+		env_state.SZgrid.at_node['water_storage_anomaly'][:] = (dqsdxy-dqs)*dt
+		fun_update_UZ_SZ_depth(env_state, tht_dt, Droot)
+		
+		# Calculate total discharge
+		env_state.SZgrid.at_node['discharge'][:] += (dqs + dqs_riv*self.kAriv)*dt
+		
+		pass
+	
+	def steady_state(self, env_state, recharge):
+		"""Equilibrium water table for a constant recharge rate. Backward
+		Euler pseudo time steps of growing length are taken until heads stop
+		changing (the storage term only keeps the first systems regular).
+		Each step is solved with Picard iterations of the transmissivity,
+		head boundary outflow is linearized (Newton), rivers drain the
+		aquifer above the river bed and cells where the water table reaches
+		the surface are kept at the surface while they seep water.
+		Parameters:
+			recharge:	Recharge rate at nodes [m/h]
+		Returns the number of pseudo time steps.
+		"""
+		act_links = env_state.SZgrid.active_links
+		core = env_state.SZgrid.core_nodes
+		
+		Sy = env_state.SZgrid.at_node['SZ_Sy']
+		z = env_state.SZgrid.at_node['topographic__elevation']
+		z_riv = env_state.grid.at_node['river_topo_elevation']
+		h = env_state.SZgrid.at_node['water_table__elevation']
+		
+		h[:] = np.minimum(z, h)
+		if env_state.func == 2:
+			h[:] = np.maximum(h, env_state.SZgrid.at_node['BOT'])
+		
+		# Heads of boundary nodes are fixed, recharge only at core nodes
+		free = np.zeros(len(h), dtype=bool)
+		free[core] = True
+		qin = np.zeros(len(h))
+		qin[core] = recharge[core]
+		
+		# River conductance of a full river (river head at the river bed)
+		Criv = self.kaq*exponential_T(env_state.grid.at_node['SS_loss'],
+			STR_RIVER, z_riv, z_riv)*50 / (env_state.SZgrid.dx - self.W)
+		
+		seep = np.zeros(len(h), dtype=bool)
+		dt = STEADY_DT_INI
+		rate = np.inf
+		for it in range(STEADY_MAX_STEPS):
+			
+			perf.count('groundwater steady-state steps')
+			
+			h0 = np.array(h)
+			seep0 = np.array(seep)
+			S = Sy/dt
+			
+			for k in range(PICARD_MAX_ITER):
+				
+				perf.count('groundwater Picard iterations')
+				
+				# Conductance matrix, net inflow of nodes is L*h
+				T = np.zeros(len(self.Ksat))
+				T[act_links] = self.link_transmissivity(env_state, h)[act_links]
+				L = self.ops.div @ sparse.diags(T) @ self.ops.grad
+				
+				# Flux head boundary conditions and its derivative
+				dfhbc = exponential_T(env_state.SZgrid.at_node['SZ_FHB'], 60, z, h)
+				ddfhbc = dfhbc/60
+				
+				# Rivers only drain the aquifer
+				c = Criv*(h > z_riv)
+				
+				# Seepage cells and boundary nodes are fixed head nodes
+				var = free & ~seep
+				A = (sparse.diags(var*1.0) @ (sparse.diags(S + c + ddfhbc) - L)
+					+ sparse.diags(1.0 - var))
+				rhs = np.where(var, S*h0 + qin - dfhbc + ddfhbc*h + c*z_riv,
+					np.where(seep, z, h))
+				
+				h_it = spsolve(A.tocsc(), rhs)
+				if env_state.func == 2:
+					h_it = np.maximum(h_it, env_state.SZgrid.at_node['BOT'])
+				
+				# Seepage cells are released if they need inflow
+				dqs = (L @ h_it + qin - dfhbc - ddfhbc*(h_it - h)
+					- c*(h_it - z_riv) - S*(h_it - h0))
+				seep_it = free & ((h_it > z) | (seep & (dqs > 0)))
+				
+				change = np.max(np.abs(h_it - h))
+				h[:] = np.minimum(z, h_it)
+				
+				if change < PICARD_TOL and np.array_equal(seep_it, seep):
+					break
+				seep = seep_it
+			else:
+				# Restart the pseudo step with a shorter length
+				perf.count('groundwater Picard not converged')
+				h[:] = h0
+				seep = seep0
+				dt *= 0.25
+				continue
+			
+			rate = np.max(np.abs(h - h0)[core])/dt
+			if rate < STEADY_TOL:
+				break
+			dt = min(4*dt, STEADY_DT_MAX)
+		else:
+			print('Groundwater steady state not reached, max dh/dt [m/h] = ', rate)
+		
+		# Water balance of the steady state [m3/h]
+		A_cell = np.power(env_state.SZgrid.dx, 2)
+		q_seep = np.sum(dqs[seep])*A_cell
+		q_riv = np.sum((c*(h - z_riv))[core])*A_cell
+		q_fhb = np.sum(dfhbc[core])*A_cell
+		print('Groundwater steady state, steps: ', it+1, 'recharge [m3/h]: ', np.sum(qin)*A_cell,
+			'seepage: ', q_seep, 'river drainage: ', q_riv, 'head boundaries: ', q_fhb)
+		
+		self.hriv = np.minimum(h, z_riv)
+		self.wte_dt = np.array(h)
+		
+		return it+1
+	
+	def close(self):
+		"""Stop the groundwater worker processes"""
+		if self.domain is not None:
+			self.domain.close()
+			self.domain = None
+	
 	def SZ_potential_ET(self, env_state, pet_sz):
 		SZ_aet = (env_state.SZgrid.at_node['water_table__elevation']
 			- env_state.grid.at_node['topographic__elevation']
@@ -435,6 +1345,131 @@ class gwflow_EFD(object):
 		f = SZ_aet/env_state.Droot
 		return f*pet_sz
 
+class courant_telemetry(object):
+	"""Sub-steps of the explicit groundwater solver and the nodes that
+	limit their Courant time step. Each groundwater step logs its number
+	of sub-steps and the node that limited most of them, the number of
+	limited sub-steps is accumulated at nodes.
+	Parameters:
+		grid:	Groundwater grid
+	"""
+	def __init__(self, grid):
+		self.grid = grid
+		self.count = np.zeros(grid.number_of_nodes)
+		self.step_nodes = []
+		self.log = []
+		self.node = -1
+		self.dt_limit = np.inf
+	
+	def limit(self, dt_node, nodes):
+		"""Limiting node of the next sub-step from the maximum time step
+		of nodes
+		"""
+		valid = (dt_node > 0) & np.isfinite(dt_node)
+		self.node = -1
+		self.dt_limit = np.inf
+		if np.any(valid):
+			i = np.argmin(np.where(valid, dt_node, np.inf))
+			self.node = nodes[i]
+			self.dt_limit = dt_node[i]
+	
+	def substep(self, dtsp):
+		"""Sub-step of length dtsp, shorter sub-steps than the limit end
+		the groundwater step and are not counted at the limiting node
+		"""
+		node = self.node if dtsp >= self.dt_limit*(1 - 1e-9) else -1
+		self.step_nodes.append(node)
+		if node >= 0:
+			self.count[node] += 1
+	
+	def end_step(self):
+		nodes = np.array(self.step_nodes, dtype=int)
+		nodes = nodes[nodes >= 0]
+		node = np.argmax(np.bincount(nodes)) if len(nodes) > 0 else -1
+		self.log.append((len(self.step_nodes), node))
+		self.step_nodes = []
+	
+	def save(self, fname):
+		log = np.array(self.log, dtype=int).reshape(-1, 2)
+		np.savetxt(fname + '_gw_substeps.csv',
+			np.column_stack((np.arange(len(log)), log)), fmt='%d',
+			delimiter=',', header='Step,Sub_steps,Limiting_node', comments='')
+		
+		self.grid.at_node['courant_limiter'] = np.array(self.count)
+		write_esri_ascii(fname + '_courant_limiter.asc', self.grid,
+			'courant_limiter', clobber=True)
+		
+		if np.sum(self.count) > 0:
+			node = np.argmax(self.count)
+			print('Courant limiting node: ' + str(node) + ', '
+				+ str(int(self.count[node])) + ' of '
+				+ str(int(np.sum(log[:, 0]))) + ' groundwater sub-steps')
+
+class grid_operators(object):
+	"""Gradient, flux divergence and link mapping operators of a raster
+	grid as index arrays, computed once and used at every groundwater
+	sub-step. Results are the same as the landlab calc_grad_at_link,
+	calc_flux_div_at_node, map_mean_of_link_nodes_to_link and
+	map_max_of_node_links_to_node. Sparse gradient and divergence
+	matrices are used by the implicit solver.
+	Parameters:
+		grid:	Landlab raster grid
+	"""
+	def __init__(self, grid):
+		self.head = np.array(grid.node_at_link_head)
+		self.tail = np.array(grid.node_at_link_tail)
+		self.inv_length = 1.0/np.array(grid.length_of_link)
+		self.links_at_node = np.array(grid.links_at_node)
+		self.number_of_nodes = grid.number_of_nodes
+		
+		# Faces of cells, flux is outwards for negative link directions
+		self.cells = np.array(grid.node_at_cell)
+		self.area = np.array(grid.area_of_cell)
+		self.links_at_cell = grid.link_at_face[grid.faces_at_cell]
+		self.width_at_cell = grid.length_of_face[grid.faces_at_cell]
+		self.dirs_at_cell = grid.link_dirs_at_node[grid.node_at_cell]
+		self.width_at_link = np.where(grid.face_at_link >= 0,
+			grid.length_of_face[grid.face_at_link], 0.0)
+		self.inv_area_at_node = np.zeros(grid.number_of_nodes)
+		self.inv_area_at_node[self.cells] = 1/self.area
+		
+		# Link values padded with the smallest float for missing links
+		self.link_values = np.empty(grid.number_of_links+1)
+		self.link_values[-1] = np.finfo(dtype=float).min
+		
+		links = np.arange(grid.number_of_links)
+		self.grad = sparse.csr_matrix((np.concatenate((self.inv_length, -self.inv_length)),
+			(np.concatenate((links, links)), np.concatenate((self.head, self.tail)))),
+			shape=(grid.number_of_links, grid.number_of_nodes))
+		
+		rows = np.repeat(self.cells, self.links_at_cell.shape[1])
+		val = (-self.dirs_at_cell*self.width_at_cell/self.area[:, None]).ravel()
+		self.div = sparse.csr_matrix((val, (rows, self.links_at_cell.ravel())),
+			shape=(grid.number_of_nodes, grid.number_of_links))
+	
+	def grad_at_link(self, h):
+		"""Gradient of node values at links"""
+		return (h[self.head] - h[self.tail])*self.inv_length
+	
+	def flux_div_at_node(self, q):
+		"""Divergence at nodes of unit fluxes at links"""
+		total_flux = q[self.links_at_cell]*self.width_at_cell
+		net = np.zeros(len(self.cells))
+		for c in range(total_flux.shape[1]):
+			net -= total_flux[:, c]*self.dirs_at_cell[:, c]
+		out = np.zeros(self.number_of_nodes)
+		out[self.cells] = net/self.area
+		return out
+	
+	def mean_at_link(self, h):
+		"""Mean of the node values of links"""
+		return 0.5*(h[self.head] + h[self.tail])
+	
+	def max_at_node(self, v):
+		"""Maximum of the link values of nodes"""
+		self.link_values[:-1] = v
+		return np.amax(self.link_values[self.links_at_node], axis=1)
+
 def transmissivity(env_state, Ksat, act_links, f, zm):
 
 	T = np.zeros(len(Ksat))
@@ -467,23 +1502,45 @@ def fun_update_UZ_SZ_depth(env_state, tht_dt, Droot):
 						dq:	water storage anomaly
 	Groundwater storage variation
 	"""	
-	h0 = env_state.SZgrid.at_node['water_table__elevation'] - \
-		env_state.SZgrid.at_node['water_storage_anomaly']/ \
-		env_state.SZgrid.at_node['SZ_Sy']
+	h, dis = update_UZ_SZ_depth(env_state.SZgrid.at_node['water_table__elevation'],
+		env_state.SZgrid.at_node['water_storage_anomaly'],
+		env_state.SZgrid.at_node['SZ_Sy'],
+		env_state.grid.at_node['saturated_water_content'],
+		tht_dt, env_state.fc,
+		env_state.grid.at_node['topographic__elevation'], Droot)
+	
+	env_state.SZgrid.at_node['water_table__elevation'] = h
+	
+	env_state.SZgrid.at_node['discharge'][:] += dis
+	
+	pass
+
+def update_UZ_SZ_depth(h, dq, Sy, ths, tht_dt, fc, z, Droot):
+	"""Water table after a storage change depending on the water content
+	of the unsaturated zone, for all nodes or a subset of nodes.
+	Parameters:
+	h:		Water table after the storage change [m]
+	dq:		Water storage anomaly [m]
+	Sy:		Specific yield
+	ths:	Saturated water content
+	tht_dt:	Water content at time t [-]
+	fc:		Field capacity
+	z:		Topograhic elevation [m]
+	Droot:	Rooting depth [m]
+	Returns the water table and the discharge of the water table above
+	the surface.
+	"""
+	h0 = h - dq/Sy
 	
-	tht_dt = np.where(env_state.SZgrid.at_node['water_storage_anomaly'][:] < 0.0,
-			env_state.fc, tht_dt)
+	tht_dt = np.where(dq < 0.0, fc, tht_dt)
 	
-	dtht = env_state.grid.at_node['saturated_water_content'] - tht_dt
+	dtht = ths - tht_dt
 		
-	ruz = (env_state.grid.at_node['topographic__elevation']-Droot) - h0
+	ruz = (z-Droot) - h0
 				
-	dh = np.where((h0-(env_state.grid.at_node['topographic__elevation']-Droot)) > 0.0,
-		env_state.SZgrid.at_node['water_storage_anomaly']/dtht,
-		env_state.SZgrid.at_node['water_storage_anomaly']/
-		env_state.SZgrid.at_node['SZ_Sy'])				
+	dh = np.where((h0-(z-Droot)) > 0.0, dq/dtht, dq/Sy)				
 			
-	h_aux = h0+dh-(env_state.grid.at_node['topographic__elevation']-Droot)
+	h_aux = h0+dh-(z-Droot)
 	
 	dhr_aux = np.abs(ruz)-np.abs(dh)
 	
@@ -499,23 +1556,13 @@ def fun_update_UZ_SZ_depth(env_state, tht_dt, Droot):
 	
 	gama[h_aux < 0] = 1
 			
-	dht = ((env_state.SZgrid.at_node['water_storage_anomaly']
-		+ ruz*(alpha*env_state.SZgrid.at_node['SZ_Sy'] + beta*dtht))
-		/ ((gama*env_state.SZgrid.at_node['SZ_Sy'] + (1-gama)*dtht)))
+	dht = (dq + ruz*(alpha*Sy + beta*dtht)) / ((gama*Sy + (1-gama)*dtht))
 	
-	env_state.SZgrid.at_node['water_table__elevation'] = h0 + dht
+	h = h0 + dht
 	
-	env_state.SZgrid.at_node['discharge'][:] += np.where((
-		env_state.SZgrid.at_node['topographic__elevation']
-		- env_state.SZgrid.at_node['water_table__elevation']) <= 0.0,
-		- (env_state.SZgrid.at_node['topographic__elevation']
-		- env_state.SZgrid.at_node['water_table__elevation'])*dtht, 0.0)
-			
-	env_state.SZgrid.at_node['water_table__elevation'][:] = np.minimum(
-		env_state.SZgrid.at_node['water_table__elevation'],
-		env_state.SZgrid.at_node['topographic__elevation'])
+	dis = np.where((z - h) <= 0.0, - (z - h)*dtht, 0.0)
 	
-	pass
+	return np.minimum(h, z), dis
 
 def storage(env_state):
 	storage = np.sum((env_state.SZgrid.at_node['water_table__elevation'][env_state.SZgrid.core_nodes] -\
@@ -529,21 +1576,53 @@ def storage_2layer(env_state):
 		env_state.SZgrid.at_node['BOT_2'])
 		- env_state.SZgrid.at_node['BOT_2'])
 
-	storage_1 = np.sum(head_Ss[env_state.SZgrid.core_nodes]
+	storage_1 = np.sum(head_Sy[env_state.SZgrid.core_nodes]
 		*env_state.SZgrid.at_node['SZ_Sy'][env_state.SZgrid.core_nodes])
 	
-	head_Sy = (np.minimun(env_state.SZgrid.at_node['HEAD_2'],
-		env_state.SZgrid.at_node['BOT_2'])
-		- env_state.SZgrid.at_node['BOT'])
-	
-	head_Ss = (np.maximum(env_state.SZgrid.at_node['HEAD_2'],
-		env_state.SZgrid.at_node['BOT_2'])
-		- env_state.SZgrid.at_node['BOT_2'])
+	storage_2 = deep_layer_storage(env_state.SZgrid.at_node['HEAD_2'],
+		env_state.SZgrid.at_node['BOT'],
+		env_state.SZgrid.at_node['BOT_2'],
+		env_state.SZgrid.at_node['Sy_2'],
+		env_state.SZgrid.at_node['Ss_2']*(env_state.SZgrid.at_node['BOT_2']
+		- env_state.SZgrid.at_node['BOT']))
 	
-	storage_2 = np.sum((head_Sy*env_state.SZgrid.at_node['Sy_2']
-		+head_Ss*env_state.SZgrid.at_node['Ss_2'])[env_state.SZgrid.core_nodes]
-		)
-	return storage_1+storage_2
+	return storage_1+np.sum(storage_2[env_state.SZgrid.core_nodes])
+
+def deep_layer_storage(h, bot, top, Sy, S):
+	"""Water stored in the deep layer [m], specific yield below the top
+	of the layer and storage coefficient S above it (confined)
+	"""
+	return Sy*(np.minimum(h, top) - bot) + S*np.maximum(h - top, 0)
+
+def deep_layer_head(storage, bot, top, Sy, S):
+	"""Hydraulic head of the deep layer for the water stored in it [m]"""
+	full = Sy*(top - bot)
+	return np.where(storage > full, top + (storage - full)/S, bot + storage/Sy)
+
+def leakage(h_1, h_2, top, dq_1, dq_2, S_1, S_2, K_1, K_2, b_2, dt):
+	"""Leakage from the upper to the deep layer over dt, implicit in the
+	heads of both layers (2x2 system at each node). Lateral fluxes dq_1
+	and dq_2 are explicit. Water drains freely from the upper layer when
+	the deep layer head is below its top.
+	Parameters:
+		h_1, h_2:	Heads of the upper and deep layer [m]
+		top:		Top elevation of the deep layer [m]
+		dq_1, dq_2:	Net flux per unit area of each layer [m/h]
+		S_1, S_2:	Storage coefficients [-]
+		K_1, K_2:	Vertical hydraulic conductivities [m/h]
+		b_2:		Thickness of the deep layer [m]
+	Output:
+		q:			Leakage per unit area [m/h]
+	"""
+	# Vertical conductance between the centres of the saturated layers
+	C = 1/(0.5*(h_1 - top)/K_1 + 0.5*b_2/K_2)
+	a_1 = dt/S_1
+	a_2 = dt/S_2
+	h_1s = h_1 + a_1*dq_1
+	h_2s = h_2 + a_2*dq_2
+	q = np.where(h_2 > top, C*(h_1s - h_2s)/(1 + C*(a_1 + a_2)),
+		np.maximum(C*(h_1s - top)/(1 + C*a_1), 0))
+	return q
 
 def storage_uz_sz(env_state, tht, dh):
 	"""
@@ -553,14 +1632,28 @@ def storage_uz_sz(env_state, tht, dh):
 	Output:
 		total:		Volume of water stored in the saturated zone [m]
 	"""
-	str_uz1 = (env_state.SZgrid.at_node['water_table__elevation']
+	str_node = storage_change_uz_sz(env_state,
+		env_state.SZgrid.at_node['water_table__elevation'], tht, dh)
+	
+	total = np.sum(str_node[env_state.SZgrid.core_nodes])
+	return total
+
+def storage_change_uz_sz(env_state, h, tht, dh):
+	"""
+	Storage change of the saturated zone at nodes for a change dh of
+	the water table to h, tht is replaced by the field capacity where
+	the water table falls.
+	Output:
+		str_node:	Storage change at nodes [m]
+	"""
+	str_uz1 = (h
 		- (env_state.grid.at_node['topographic__elevation']
 		- env_state.Droot*0.001)
 		)
 	
 	str_uz1[str_uz1 < 0] = 0.0
 		
-	str_uz0 = (env_state.SZgrid.at_node['water_table__elevation'] - dh
+	str_uz0 = (h - dh
 		- (env_state.grid.at_node['topographic__elevation']
 		- env_state.Droot*0.001)
 		)
@@ -575,10 +1668,22 @@ def storage_uz_sz(env_state, tht, dh):
 	
 	str_sz = (dh-str_uz1+str_uz0)*env_state.SZgrid.at_node['SZ_Sy']
 	
-	total = np.sum(str_sz[env_state.SZgrid.core_nodes]
-		+ str_uz[env_state.SZgrid.core_nodes]
-		)
-	return total
+	return str_sz + str_uz
+
+def river_cell_flux(SS_loss, z_riv, hriv, h, stage, aux_riv, W, dx):
+	"""Flux from river cells to the aquifer, river cells only drain the
+	aquifer if there is no flow (aux_riv). All arrays are at river nodes.
+	"""
+	Tch = exponential_T(SS_loss, STR_RIVER, z_riv, hriv)
+	
+	diff_stage = h - hriv
+	
+	stage_aux = np.array(stage)
+	stage_aux[diff_stage < 0] = 0
+	
+	qs_riv = -(Tch*(diff_stage-stage_aux)*50 / (dx - W))
+	qs_riv[qs_riv < 0] = qs_riv[qs_riv < 0]*aux_riv[qs_riv < 0]
+	return qs_riv
 
 def smoth_func_L1(h, hr, r, dq, *nodes):
 
@@ -0,0 +1,302 @@
+import numpy as np
+from scipy import sparse
+from landlab import RasterModelGrid
+from components.DRYP_groundwater_EFD import gwflow_EFD, storage_change_uz_sz, update_UZ_SZ_depth
+from timing import perf
+
+# Groundwater model on a coarser grid than the surface grid. Each coarse
+# cell aggregates k x k surface cells (perimeter rows and columns of both
+# grids are closed). Parameters and recharge are restricted to the coarse
+# grid, heads are interpolated back to the surface grid and corrected to
+# the storage change of the coarse grid.
+
+# Node fields of SZgrid restricted to the coarse grid
+SZ_FIELDS = ['SZ_Sy', 'water_table__elevation', 'BOT', 'Hydraulic_Conductivity',
+	'SZ_FHB', 'SZ_a_aq', 'SZ_b_aq']
+
+class gwflow_coarse(object):
+	"""Groundwater flow (gwflow_EFD) on a grid coarser than the surface
+	grid by an integer factor. It is used as gwflow_EFD, fields of
+	env_state are exchanged at the surface grid resolution.
+	Parameters:
+		env_state:	State variables and model parameters
+		data_in:	Input variables, gw_coarse_factor is the grid factor
+	"""
+	def __init__(self, env_state, data_in):
+
+		SZgrid = env_state.SZgrid
+		for name in ['recharge', 'discharge', 'river_stage__elevation',
+				'water_storage_anomaly']:
+			SZgrid.add_zeros('node', name, dtype=float)
+		SZgrid.at_node['topographic__elevation'] = np.array(env_state.grid.at_node['topographic__elevation'])
+
+		self.ops = coarse_grid_operators(SZgrid, data_in.gw_coarse_factor)
+		self.state = coarse_state(env_state, self.ops)
+		print('Groundwater grid: ' + str(self.ops.shape[0]) + 'x' + str(self.ops.shape[1])
+			+ ' nodes, ' + str(data_in.gw_coarse_factor) + ' times the surface grid size')
+
+		self.gw = gwflow_EFD(self.state, data_in)
+
+		self.wte_dt = np.array(SZgrid.at_node['water_table__elevation'])
+		self.dh = np.zeros_like(self.wte_dt)
+		self.flux_out = 0
+		self.layers = 1
+		self.deep_storage_change = 0
+		self.volume_error = 0
+
+	def run_one_step_gw(self, env_state, dt, tht_dt, Droot):
+		"""Groundwater step on the coarse grid. Recharge volume and river
+		flow are aggregated, the head change is interpolated to the surface grid
+		and water above the surface is discharged.
+		"""
+		R = self.ops.restriction
+		c = self.state
+		nn = env_state.SZgrid.number_of_nodes
+
+		c.SZgrid.at_node['recharge'][:] = self.ops.volume @ env_state.SZgrid.at_node['recharge']
+		c.grid.at_node['Q_ini'][:] = self.ops.aggregation @ env_state.grid.at_node['Q_ini']
+
+		hc = np.array(c.SZgrid.at_node['water_table__elevation'])
+		tht_c = R @ np.broadcast_to(tht_dt, (nn,))
+		self.gw.run_one_step_gw(c, dt, tht_c, R @ np.broadcast_to(Droot, (nn,)))
+
+		# Storage change of coarse nodes [m per surface cell]
+		dhc = c.SZgrid.at_node['water_table__elevation'] - hc
+		dsc = self.ops.area_ratio*storage_change_uz_sz(c,
+			c.SZgrid.at_node['water_table__elevation'], np.array(tht_c), dhc)
+
+		self.update_surface_grid(env_state, self.wte_dt + self.ops.prolongation @ dhc,
+			dsc, tht_dt, dt)
+
+		# Boundary outflow per surface cell
+		self.flux_out = self.gw.flux_out*self.ops.area_ratio
+
+	def update_surface_grid(self, env_state, h, dsc, tht_dt, dt):
+		"""Water table, discharge and river saturation deficit of the
+		surface grid from the water table h interpolated from the coarse
+		grid, the storage change dsc and the discharge of the coarse grid.
+		The storage change of core nodes is corrected to the storage change
+		of their coarse node, water above the surface is discharged.
+		"""
+		ops = self.ops
+		SZgrid = env_state.SZgrid
+		core = SZgrid.core_nodes
+		z = env_state.grid.at_node['topographic__elevation']
+		Sy = SZgrid.at_node['SZ_Sy']
+		tht = np.array(np.broadcast_to(tht_dt, (SZgrid.number_of_nodes,)), dtype=float)
+
+		# Difference of the storage change of coarse nodes and their core
+		# nodes is spread evenly over core nodes
+		ds = storage_change_uz_sz(env_state, h, np.array(tht), h - self.wte_dt)
+		dq = ops.spread @ (dsc - ops.aggregation @ (ds*ops.core))
+
+		h_aux = np.array(h)
+		h = np.minimum(h, z)
+		h[core], dis = update_UZ_SZ_depth(h_aux[core] + dq[core]/Sy[core], dq[core], Sy[core],
+			env_state.grid.at_node['saturated_water_content'][core], tht[core],
+			env_state.fc[core], z[core], env_state.Droot[core]*0.001)
+
+		# Remaining error of the storage change [m]
+		ds = storage_change_uz_sz(env_state, h, np.array(tht), h - self.wte_dt)
+		ds[core] += dis
+		self.volume_error = np.sum(np.abs(dsc - ops.aggregation @ (ds*ops.core)))
+		perf.count('coarse groundwater volume error [m]', float(self.volume_error))
+
+		# Discharge of coarse nodes is spread over core nodes, depth of the
+		# step is converted to a rate as in gwflow_EFD
+		discharge = ops.spread @ (dt*ops.area_ratio*self.state.SZgrid.at_node['discharge'])
+		discharge[core] += dis
+		SZgrid.at_node['water_table__elevation'][:] = h
+		SZgrid.at_node['discharge'][:] = discharge*(1/dt)
+
+		self.dh = h - self.wte_dt
+		self.wte_dt = np.array(h)
+
+		env_state.grid.at_node['riv_sat_deficit'][:] = (np.power(env_state.grid.dx,2)
+				* np.array(env_state.grid.at_node['river_topo_elevation'][:] - h))
+
+		env_state.grid.at_node['riv_sat_deficit'][env_state.grid.at_node['riv_sat_deficit'][:] < 0] = 0.0
+
+	def steady_state(self, env_state, recharge):
+		"""Equilibrium water table on the coarse grid for a constant
+		recharge rate [m/h] at surface grid nodes, it is interpolated to
+		the surface grid. Returns the number of pseudo time steps.
+		"""
+		c = self.state
+		nsteps = self.gw.steady_state(c, self.ops.volume @ recharge)
+
+		z = env_state.grid.at_node['topographic__elevation']
+		h = np.minimum(self.ops.prolongation @ c.SZgrid.at_node['water_table__elevation'], z)
+		env_state.SZgrid.at_node['water_table__elevation'][:] = h
+		self.wte_dt = np.array(h)
+		return nsteps
+
+	def add_second_layer_gw(self, env_state, thickness, Ksat, Sy, Ss):
+		raise Exception("Groundwater deep layer is not available on a coarse groundwater grid")
+
+	def save_telemetry(self, fname):
+		"""Sub-steps and Courant limiting nodes of the coarse grid"""
+		self.gw.save_telemetry(fname)
+
+	def close(self):
+		"""Stop the groundwater worker processes"""
+		self.gw.close()
+
+	def SZ_potential_ET(self, env_state, pet_sz):
+		return self.gw.SZ_potential_ET(env_state, pet_sz)
+
+class coarse_state(object):
+	"""State variables and parameters of the coarse grid used by
+	gwflow_EFD (SZgrid and the surface fields it reads).
+	Parameters:
+		env_state:	State variables and model parameters
+		ops:		Coarse grid operators
+	"""
+	def __init__(self, env_state, ops):
+		fine = env_state.SZgrid
+		R = ops.restriction
+		A = ops.aggregation
+		nn = fine.number_of_nodes
+
+		self.SZgrid = ops.new_grid(fine)
+		for name in SZ_FIELDS:
+			self.SZgrid.add_field(name, R @ fine.at_node[name], at='node')
+		self.SZgrid.add_zeros('link', 'unit_flux', dtype=float)
+
+		# Heads of fixed head nodes from fixed head nodes of the surface grid
+		fixed = ops.fixed_nodes
+		if len(fixed) > 0:
+			is_fixed = (fine.status_at_node == fine.BC_NODE_IS_FIXED_VALUE)*1.0
+			n_fixed = A @ is_fixed
+			self.SZgrid.at_node['water_table__elevation'][fixed] = (A
+				@ (fine.at_node['water_table__elevation']*is_fixed))[fixed]/n_fixed[fixed]
+
+		# River fields, river area and losses are added, river elevation
+		# is the mean of river cells
+		rg = env_state.grid
+		self.grid = ops.new_grid(fine)
+		Ariv = A @ (rg.at_node['river_width']*rg.at_node['river_length'])
+		length = A @ rg.at_node['river_length']
+		width = np.zeros(len(length))
+		width[length != 0] = Ariv[length != 0]/length[length != 0]
+		z_riv = R @ rg.at_node['river_topo_elevation']
+		z_riv[Ariv != 0] = ((A @ (rg.at_node['river_width']*rg.at_node['river_length']
+			*rg.at_node['river_topo_elevation']))[Ariv != 0]/Ariv[Ariv != 0])
+
+		self.grid.add_field('topographic__elevation', R @ rg.at_node['topographic__elevation'], at='node')
+		self.grid.add_field('river_length', length, at='node')
+		self.grid.add_field('river_width', width, at='node')
+		self.grid.add_field('river_topo_elevation', z_riv, at='node')
+		self.grid.add_field('SS_loss', A @ rg.at_node['SS_loss'], at='node')
+		self.grid.add_field('saturated_water_content',
+			R @ rg.at_node['saturated_water_content'], at='node')
+		self.grid.add_zeros('node', 'Q_ini', dtype=float)
+		self.grid.add_zeros('node', 'riv_sat_deficit', dtype=float)
+		self.grid.add_zeros('node', 'Base_flow', dtype=float)
+
+		self.func = env_state.func
+		self.fc = R @ np.broadcast_to(env_state.fc, (nn,))
+		self.Droot = R @ np.broadcast_to(env_state.Droot, (nn,))
+
+class coarse_grid_operators(object):
+	"""Restriction and prolongation between a raster grid and a grid
+	coarser by an integer factor k. Coarse interior nodes are centred in
+	blocks of k x k interior nodes of the fine grid.
+	Parameters:
+		grid:	Fine raster grid
+		k:		Grid factor
+	"""
+	def __init__(self, grid, k):
+		nr, nc = grid.shape
+		rows, I, nrc = coarse_index(nr, k)
+		cols, J, ncc = coarse_index(nc, k)
+		nn = nr*nc
+		nodes = np.arange(nn)
+		parent = (I[:, None]*ncc + J[None, :]).ravel()
+		nnc = nrc*ncc
+
+		core = np.zeros(nn)
+		core[grid.core_nodes] = 1.0
+		fixed = (grid.status_at_node == grid.BC_NODE_IS_FIXED_VALUE)*1.0
+		n_core = np.bincount(parent, core, minlength=nnc)
+		n_fixed = np.bincount(parent, fixed, minlength=nnc)
+
+		# Sum of fine nodes of coarse nodes
+		self.aggregation = sparse.csr_matrix((np.ones(nn), (parent, nodes)),
+			shape=(nnc, nn))
+		# Mean of core fine nodes (all fine nodes if there are no core nodes)
+		w = np.where(n_core[parent] > 0, core, 1.0)
+		self.restriction = (sparse.diags(1/np.bincount(parent, w, minlength=nnc))
+			@ sparse.csr_matrix((w, (parent, nodes)), shape=(nnc, nn))).tocsr()
+		# Volume of core fine nodes per unit area of the coarse node
+		self.volume = (self.aggregation @ sparse.diags(core)).tocsr()/(k*k)
+		# Value of the coarse node at its fine nodes
+		self.injection = self.aggregation.T.tocsr()
+		# Value of the coarse node divided evenly over its core fine nodes
+		self.core = core
+		self.spread = (sparse.diags(core) @ self.injection
+			@ sparse.diags(np.where(n_core > 0, 1/np.maximum(n_core, 1), 0))).tocsr()
+
+		# Coarse node status, perimeter nodes are closed
+		status = np.full((nrc, ncc), grid.BC_NODE_IS_CLOSED)
+		inner = np.zeros((nrc, ncc), dtype=bool)
+		inner[1:-1, 1:-1] = True
+		status[inner & (n_core > 0).reshape(nrc, ncc)] = grid.BC_NODE_IS_CORE
+		status[inner & (n_fixed > 0).reshape(nrc, ncc)] = grid.BC_NODE_IS_FIXED_VALUE
+		self.status = status.ravel()
+		self.fixed_nodes = np.where(self.status == grid.BC_NODE_IS_FIXED_VALUE)[0]
+
+		# Bilinear interpolation from active coarse nodes, fine nodes
+		# without active coarse neighbours take the coarse node value
+		active = self.status != grid.BC_NODE_IS_CLOSED
+		r0, fr = interpolation_index(rows, nr, k)
+		c0, fc = interpolation_index(cols, nc, k)
+		row, col, val = [], [], []
+		for di, wr in [(0, 1 - fr), (1, fr)]:
+			for dj, wc in [(0, 1 - fc), (1, fc)]:
+				cnode = ((r0 + di)[:, None]*ncc + (c0 + dj)[None, :]).ravel()
+				weight = (wr[:, None]*wc[None, :]).ravel()*active[cnode]
+				row.append(nodes)
+				col.append(cnode)
+				val.append(weight)
+		row, col, val = np.concatenate(row), np.concatenate(col), np.concatenate(val)
+		total = np.bincount(row, val, minlength=nn)
+		val = np.where(total[row] > 0, val/np.where(total[row] > 0, total[row], 1), 0)
+		P = sparse.csr_matrix((val, (row, col)), shape=(nn, nnc))
+		P = P + sparse.csr_matrix(((total <= 0)*1.0, (nodes, parent)), shape=(nn, nnc))
+		P.eliminate_zeros()
+		self.prolongation = P.tocsr()
+
+		self.shape = (nrc, ncc)
+		self.spacing = k*grid.dx
+		self.area_ratio = k*k
+		self.xy_of_lower_left = (grid.x_of_node[0] + cols[0]*grid.dx,
+			grid.y_of_node[0] + rows[0]*grid.dx)
+
+	def new_grid(self, grid):
+		"""Coarse raster grid with the status of coarse nodes"""
+		cgrid = RasterModelGrid(self.shape, xy_spacing=self.spacing,
+			xy_of_lower_left=self.xy_of_lower_left)
+		cgrid.status_at_node[:] = self.status
+		return cgrid
+
+def coarse_index(n, k):
+	"""Coarse row (column) of n fine rows (columns), first and last rows
+	are perimeter rows of both grids.
+	Returns the fine row coordinate of coarse rows, the coarse row of
+	fine rows and the number of coarse rows.
+	"""
+	ncoarse = 2 + int(np.ceil((n - 2)/k))
+	index = 1 + (np.arange(n) - 1)//k
+	index[0] = 0
+	index[-1] = ncoarse - 1
+	position = 1 + (np.arange(ncoarse) - 1)*k + (k - 1)/2
+	return position, index, ncoarse
+
+def interpolation_index(position, n, k):
+	"""Lower coarse row (column) and weight of the upper one for the
+	linear interpolation at n fine rows (columns)
+	"""
+	u = np.clip((np.arange(n) - position[0])/k, 0, len(position) - 1)
+	i0 = np.minimum(np.floor(u).astype(int), len(position) - 2)
+	return i0, u - i0
@@ -0,0 +1,200 @@
+import numpy as np
+from numba import njit, prange
+
+# Compiled explicit groundwater scheme (numba). One call advances the
+# water table over a whole groundwater time step, sub-steps limited by
+# the Courant number are not returned to the interpreter.
+
+@njit(parallel=True, cache=True)
+def explicit_steps_jit(dt, func, dx, courant, reg_factor, f_riv, str_river,
+		h, hriv, z, BOT, Sy, FHB, recharge, z_riv, SS_loss, stage, aux_riv,
+		W, kriv, kaq, kAriv, faq_node, ths, fc, tht_dt, Droot,
+		Ksat, faq, zm, bm, head, tail, inv_length, act_link,
+		links_at_node, cells, area, links_at_cell, width_at_cell, dirs_at_cell,
+		core_nodes, fixed_links, discharge, anomaly, T, qs, dqsdxy, dt_node):
+	"""Explicit groundwater sub-steps over dt, arrays of heads (h, hriv),
+	discharge and storage anomaly are updated in place.
+	Returns the number of sub-steps and the boundary outflow.
+	"""
+	nn = h.shape[0]
+	nl = T.shape[0]
+	dx2 = dx*dx
+	flux_out = 0.0
+	nsteps = 0
+
+	transmissivity_jit(func, h, Ksat, faq, zm, bm, head, tail, act_link, T)
+	dtsp = min(dt, time_step_jit(courant, Sy, T, dx2, links_at_node, core_nodes, dt_node))
+	dtp = dtsp
+
+	for i in prange(nn):
+		discharge[i] = 0.0
+
+	while dtp <= dt:
+		nsteps += 1
+
+		# Make water table always below surface elevation (above the
+		# bottom elevation for constant transmissivity), and the river
+		# water table below the river elevation
+		for i in prange(nn):
+			if z[i] < h[i]:
+				h[i] = z[i]
+			if func == 2 and h[i] < BOT[i]:
+				h[i] = BOT[i]
+			if z_riv[i] < hriv[i]:
+				hriv[i] = z_riv[i]
+
+		# Transmissivity and flux per unit length at each face
+		transmissivity_jit(func, h, Ksat, faq, zm, bm, head, tail, act_link, T)
+		for l in prange(nl):
+			if act_link[l]:
+				qs[l] = -T[l]*((h[head[l]] - h[tail[l]])*inv_length[l])
+
+		aux = 0.0
+		for k in range(fixed_links.shape[0]):
+			aux += qs[fixed_links[k]]
+		flux_out += (aux/dx)*dtsp
+
+		# Outflow of flux head boundary conditions
+		flux_out += sum_fhbc_jit(FHB, z, h)
+
+		# Flux divergence at cells
+		for i in prange(nn):
+			dqsdxy[i] = 0.0
+		for c in prange(cells.shape[0]):
+			net = 0.0
+			for k in range(links_at_cell.shape[1]):
+				net -= (qs[links_at_cell[c, k]]*width_at_cell[c, k])*dirs_at_cell[c, k]
+			dqsdxy[cells[c]] = net/area[c]
+
+		# Node fluxes, head update and soil-gw interactions
+		for i in prange(nn):
+			dfhbc = FHB[i]*60*np.exp(-max(z[i] - h[i], 0.0)/60)
+			dq = -dqsdxy[i] - dfhbc + recharge[i]/dt
+
+			# River cell flux
+			Tch = SS_loss[i]*str_river*np.exp(-max(z_riv[i] - hriv[i], 0.0)/str_river)
+			diff_stage = h[i] - hriv[i]
+			stage_aux = stage[i]
+			if diff_stage < 0:
+				stage_aux = 0.0
+			qs_riv = -(Tch*(diff_stage - stage_aux)*50/(dx - W[i]))
+			if qs_riv < 0:
+				qs_riv = qs_riv*aux_riv[i]
+			dq += kaq*qs_riv
+
+			# Regularization approach for aquifer and river cells
+			if func == 1 or func == 2:
+				r = max((h[i] - z[i])/faq_node[i] + 1, 0.0)
+			else:
+				r = min((h[i] - BOT[i])/(z[i] - BOT[i]), 1.0)
+			dqs = 0.0
+			if dq > 0:
+				dqs = np.exp((r - 1)/reg_factor)*dq
+			dq_riv = -kriv[i]*qs_riv
+			r = max((hriv[i] - z_riv[i])/f_riv + 1, 0.0)
+			dqs_riv = 0.0
+			if dq_riv > 0:
+				dqs_riv = np.exp((r - 1)/reg_factor)*dq_riv
+
+			# Update the head elevations and storage change
+			h[i] += (dq - dqs)*dtsp/Sy[i]
+			hriv[i] += (dq_riv - dqs_riv)*dtsp/Sy[i]
+			anomaly[i] = (dq - dqs)*dtsp
+			discharge[i] += update_UZ_SZ_depth_jit(i, h, anomaly[i], Sy[i],
+				ths[i], fc[i], tht_dt[i], z[i], Droot[i])
+
+			# Calculate total discharge
+			discharge[i] += (dqs + dqs_riv*kAriv[i])*dtsp
+
+		# Calculate maximum time step
+		dtsp = time_step_jit(courant, Sy, T, dx2, links_at_node, core_nodes, dt_node)
+
+		# Update time step
+		if dtsp <= 0:
+			raise Exception("invalid time step")
+		if dtp == dt:
+			dtp += dtsp
+		elif (dtp + dtsp) > dt:
+			dtsp = dt - dtp
+			dtp += dtsp
+		else:
+			dtp += dtsp
+
+	return nsteps, flux_out
+
+@njit(parallel=True, cache=True)
+def transmissivity_jit(func, h, Ksat, faq, zm, bm, head, tail, act_link, T):
+	"""Transmissivity at links"""
+	for l in prange(T.shape[0]):
+		hm = 0.5*(h[head[l]] + h[tail[l]])
+		if func == 1:
+			T[l] = Ksat[l]*faq[l]*np.exp(-max(zm[l] - hm, 0.0)/faq[l])
+		elif act_link[l]:
+			if func == 2:
+				T[l] = Ksat[l]
+			else:
+				T[l] = Ksat[l]*(hm - bm[l])
+		else:
+			T[l] = 0.0
+
+@njit(parallel=True, cache=True)
+def time_step_jit(courant, Sy, T, dx2, links_at_node, core_nodes, dt_node):
+	"""Maximum stable time step of core nodes, from the maximum
+	transmissivity of node links
+	"""
+	for k in prange(core_nodes.shape[0]):
+		i = core_nodes[k]
+		Tmax = -np.inf
+		for j in range(links_at_node.shape[1]):
+			l = links_at_node[i, j]
+			if l >= 0 and T[l] > Tmax:
+				Tmax = T[l]
+		dt_node[k] = courant*Sy[i]*dx2/(4*Tmax)
+	dtmin = np.inf
+	for k in range(core_nodes.shape[0]):
+		if dt_node[k] > 0 and dt_node[k] < dtmin:
+			dtmin = dt_node[k]
+	return dtmin
+
+@njit(cache=True)
+def sum_fhbc_jit(FHB, z, h):
+	"""Outflow of flux head boundary conditions"""
+	total = 0.0
+	for i in range(h.shape[0]):
+		total += FHB[i]*60*np.exp(-max(z[i] - h[i], 0.0)/60)
+	return total
+
+@njit(cache=True)
+def update_UZ_SZ_depth_jit(i, h, anomaly, Sy, ths, fc, tht, z, Droot):
+	"""Water table of node i after a storage change, depending on the
+	water content of the unsaturated zone (fun_update_UZ_SZ_depth).
+	Returns the discharge of the water table above the surface.
+	"""
+	h0 = h[i] - anomaly/Sy
+	if anomaly < 0.0:
+		tht = fc
+	dtht = ths - tht
+	zr = z - Droot
+	ruz = zr - h0
+	if (h0 - zr) > 0.0:
+		dh = anomaly/dtht
+	else:
+		dh = anomaly/Sy
+	h_aux = h0 + dh - zr
+	dhr_aux = abs(ruz) - abs(dh)
+	dh_aux = 1.0 if dh >= 0 else -1.0
+	alpha = 0.0
+	beta = 0.0
+	if dhr_aux <= 0 and ruz <= 0:
+		alpha = -dh_aux
+		beta = dh_aux
+	if h_aux < 0:
+		dht = (anomaly + ruz*(alpha*Sy + beta*dtht))/Sy
+	else:
+		dht = (anomaly + ruz*(alpha*Sy + beta*dtht))/dtht
+	h[i] = h0 + dht
+	q = 0.0
+	if (z - h[i]) <= 0.0:
+		q = -(z - h[i])*dtht
+		h[i] = z
+	return q
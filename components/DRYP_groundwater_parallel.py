@@ -0,0 +1,308 @@
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+# Parallel explicit groundwater solver. Core nodes of SZgrid are split
+# in row strips, one per worker process. Heads, fluxes and storage live
+# in shared memory, so neighbour (halo) values are read directly after
+# each barrier. Every node and link is computed by one worker with the
+# same operations as the serial solver, and the sums of boundary
+# outflows are done by worker 0 over the whole grid, so results are the
+# same as the serial explicit solver (bit for bit).
+
+# Node and link arrays in shared memory
+SHARED_NODE = ['h', 'hriv', 'discharge', 'anomaly', 'dfhbc', 'recharge',
+	'stage', 'SS_loss', 'tht', 'Droot']
+SHARED_LINK = ['T', 'qs']
+
+class gw_domain(object):
+	"""Row strips of SZgrid solved by worker processes.
+	Parameters:
+		gw:			gwflow_EFD object
+		env_state:	State variables and model parameters
+		nworkers:	Number of worker processes
+	"""
+	def __init__(self, gw, env_state, nworkers):
+		grid = env_state.SZgrid
+		nn = grid.number_of_nodes
+		nl = grid.number_of_links
+		nrows, ncols = grid.shape
+		nworkers = max(1, min(nworkers, nrows))
+
+		# Shared arrays
+		self.shm = {}
+		self.arrays = {}
+		shapes = {}
+		for name in SHARED_NODE:
+			shapes[name] = (nn,)
+		for name in SHARED_LINK:
+			shapes[name] = (nl,)
+		# dt, flux_out, sub-steps, command and the time step of workers
+		shapes['scalars'] = (4 + nworkers,)
+		for name, shape in shapes.items():
+			self.shm[name] = shared_memory.SharedMemory(create=True,
+				size=max(8, 8*int(np.prod(shape))))
+			self.arrays[name] = np.ndarray(shape, dtype=float,
+				buffer=self.shm[name].buf)
+			self.arrays[name][:] = 0.0
+
+		# Static data of the grid and aquifer
+		ops = gw.ops
+		static = {
+			'func': env_state.func, 'dx': float(grid.dx),
+			'z': np.array(grid.at_node['topographic__elevation']),
+			'Sy': np.array(grid.at_node['SZ_Sy']),
+			'BOT': np.array(grid.at_node['BOT']),
+			'FHB': np.array(grid.at_node['SZ_FHB']),
+			'z_riv': np.array(env_state.grid.at_node['river_topo_elevation']),
+			'ths': np.array(env_state.grid.at_node['saturated_water_content']),
+			'fc': np.array(np.broadcast_to(env_state.fc, (nn,))),
+			'W': np.array(np.broadcast_to(gw.W, (nn,))),
+			'kriv': np.array(gw.kriv), 'kaq': gw.kaq, 'kAriv': np.array(gw.kAriv),
+			'faq_node': np.array(gw.faq_node), 'f': gw.f,
+			'Ksat': gw.Ksat, 'faq': np.array(gw.faq), 'zm': np.array(gw.zm),
+			'bm': gw.bm, 'T_static': gw.T_static,
+			'head': ops.head, 'tail': ops.tail, 'inv_length': ops.inv_length,
+			'links_at_node': ops.links_at_node, 'cells': ops.cells,
+			'area': ops.area, 'links_at_cell': ops.links_at_cell,
+			'width_at_cell': ops.width_at_cell, 'dirs_at_cell': ops.dirs_at_cell,
+			'core': np.array(grid.core_nodes),
+			'act_fix_link': gw.act_fix_link,
+			'fixed_links': gw.fixed_links if gw.act_fix_link == 1 else None,
+			}
+
+		# Row strips, links belong to the strip of their tail node
+		bounds = np.linspace(0, nrows, nworkers+1).astype(int)*ncols
+		act_links = np.array(grid.active_links)
+		strips = []
+		for k in range(nworkers):
+			n0, n1 = bounds[k], bounds[k+1]
+			own_cells = np.where((ops.cells >= n0) & (ops.cells < n1))[0]
+			strips.append({
+				'nodes': slice(n0, n1),
+				'links': act_links[(ops.tail[act_links] >= n0) & (ops.tail[act_links] < n1)],
+				'cells': own_cells,
+				'core': static['core'][(static['core'] >= n0) & (static['core'] < n1)],
+				'riv': gw.riv_nodes[(gw.riv_nodes >= n0) & (gw.riv_nodes < n1)],
+				})
+
+		ctx = mp.get_context()
+		self.start = ctx.Barrier(nworkers+1)
+		self.done = ctx.Barrier(nworkers+1)
+		step = ctx.Barrier(nworkers)
+		shm_names = {name: (self.shm[name].name, shape) for name, shape in shapes.items()}
+		self.workers = []
+		for k in range(nworkers):
+			p = ctx.Process(target=gw_worker, args=(k, nworkers, shm_names,
+				static, strips[k], self.start, self.done, step), daemon=True)
+			p.start()
+			self.workers.append(p)
+		self.nworkers = nworkers
+		print('Groundwater solver: explicit, ' + str(nworkers) + ' worker processes')
+
+	def run(self, gw, env_state, dt, tht_dt, Droot):
+		"""Explicit groundwater sub-steps over dt"""
+		a = self.arrays
+		nn = len(a['h'])
+		a['h'][:] = env_state.SZgrid.at_node['water_table__elevation']
+		a['hriv'][:] = gw.hriv
+		a['recharge'][:] = env_state.SZgrid.at_node['recharge']
+		a['stage'][:] = env_state.grid.at_node['Q_ini'] * gw.kriv
+		a['SS_loss'][:] = env_state.grid.at_node['SS_loss']
+		a['tht'][:] = np.broadcast_to(tht_dt, (nn,))
+		a['Droot'][:] = np.broadcast_to(Droot, (nn,))
+		a['scalars'][:4] = [dt, 0.0, 0.0, 1.0]
+
+		self.start.wait()
+		self.done.wait()
+
+		env_state.SZgrid.at_node['water_table__elevation'][:] = a['h']
+		env_state.SZgrid.at_node['discharge'][:] = a['discharge']
+		env_state.SZgrid.at_node['water_storage_anomaly'][:] = a['anomaly']
+		gw.hriv = np.array(a['hriv'])
+		gw.flux_out = a['scalars'][1]
+		return int(a['scalars'][2])
+
+	def close(self):
+		"""Stop workers and release shared memory"""
+		self.arrays['scalars'][3] = 0.0
+		self.start.wait()
+		for p in self.workers:
+			p.join()
+		self.arrays = {}
+		for shm in self.shm.values():
+			shm.close()
+			shm.unlink()
+		self.shm = {}
+
+def gw_worker(k, nworkers, shm_names, static, strip, start, done, step):
+	"""Worker process of a row strip of the groundwater grid"""
+	from components.DRYP_groundwater_EFD import (exponential_T,
+		regularization, regularization_T, update_UZ_SZ_depth, river_cell_flux,
+		COURANT_2D, REG_FACTOR)
+
+	shm = {}
+	a = {}
+	for name, (shm_name, shape) in shm_names.items():
+		shm[name] = shared_memory.SharedMemory(name=shm_name)
+		a[name] = np.ndarray(shape, dtype=float, buffer=shm[name].buf)
+	s = static
+	h, hriv = a['h'], a['hriv']
+	T, qs = a['T'], a['qs']
+	scalars = a['scalars']
+
+	n = strip['nodes']
+	links = strip['links']
+	cells = strip['cells']
+	core = strip['core']
+	head, tail = s['head'][links], s['tail'][links]
+	z, Sy, BOT, z_riv = s['z'][n], s['Sy'][n], s['BOT'][n], s['z_riv'][n]
+	# River nodes of the strip and their position in the strip
+	rn = strip['riv']
+	rpos = rn - n.start
+	z_riv_r, kriv_r, kAriv_r = s['z_riv'][rn], s['kriv'][rn], s['kAriv'][rn]
+	dx = s['dx']
+	func = s['func']
+
+	def transmissivity():
+		# Transmissivity of the links of the strip
+		if func == 2:
+			T[links] = s['T_static'][links]
+			return
+		hm = 0.5*(h[head] + h[tail])
+		if func == 1:
+			T[links] = exponential_T(s['Ksat'][links], s['faq'][links], s['zm'][links], hm)
+		else:
+			T[links] = s['Ksat'][links]*(hm - s['bm'][links])
+
+	# Links of core nodes, missing links take the smallest float
+	core_links = s['links_at_node'][core]
+	no_link = core_links < 0
+
+	def time_step():
+		# Courant time step of the core nodes of the strip
+		values = T[core_links]
+		values[no_link] = np.finfo(dtype=float).min
+		Tmax = np.amax(values, axis=1)
+		dt_node = COURANT_2D*s['Sy'][core]*np.power(dx, 2)/(4*Tmax)
+		dt_node = dt_node[dt_node > 0]
+		scalars[4+k] = np.nanmin(dt_node) if len(dt_node) > 0 else np.nan
+
+	def worker_steps():
+		# Explicit sub-steps of the strip over dt
+		dt = scalars[0]
+
+		stage = a['stage'][n]
+		aux_riv = np.ones(len(stage))
+		aux_riv[stage > 0] = 0
+		recharge = a['recharge'][n]
+		SS_loss = a['SS_loss'][n]
+
+		transmissivity()
+		step.wait()
+		time_step()
+		step.wait()
+		dtp = np.nanmin(np.append(scalars[4:], dt))
+		dtsp = dtp
+		a['discharge'][n] = 0.0
+		hriv[n] = np.minimum(hriv[n], z_riv)
+		flux_out = 0.0
+		nsteps = 0
+
+		while dtp <= dt:
+
+			nsteps += 1
+
+			# Make water table always below the surface elevation and
+			# above the bottom elevation
+			h[n] = np.minimum(z, h[n])
+			if func == 2:
+				h[n] = np.maximum(h[n], BOT)
+			hriv[rn] = np.minimum(hriv[rn], z_riv_r)
+			step.wait()
+
+			# Transmissivity and flux per unit length of links
+			transmissivity()
+			qs[links] = -T[links]*((h[head] - h[tail])*s['inv_length'][links])
+			step.wait()
+
+			# Flux gradient
+			hn = h[n]
+			dfhbc = exponential_T(s['FHB'][n], 60, z, hn)
+			a['dfhbc'][n] = dfhbc
+			total_flux = qs[s['links_at_cell'][cells]]*s['width_at_cell'][cells]
+			net = np.zeros(len(cells))
+			for c in range(total_flux.shape[1]):
+				net -= total_flux[:, c]*s['dirs_at_cell'][cells, c]
+			div = np.zeros(len(hn))
+			div[s['cells'][cells] - n.start] = net/s['area'][cells]
+			dqsdxy = -div - dfhbc + recharge/dt
+
+			# River cell flux
+			hr = hriv[rn]
+			qs_riv = river_cell_flux(SS_loss[rpos], z_riv_r, hr, hn[rpos],
+				stage[rpos], aux_riv[rpos], s['W'][rn], dx)
+			dqsdxy[rpos] += s['kaq']*qs_riv
+
+			# Regularization approach for aquifer and river cells
+			if func == 1 or func == 2:
+				dqs = regularization_T(z, hn, s['faq_node'][n], dqsdxy, REG_FACTOR)
+			else:
+				dqs = regularization(z, hn, BOT, dqsdxy, REG_FACTOR)
+			dqs_riv = regularization_T(z_riv_r, hr, s['f'], -kriv_r*qs_riv,
+				REG_FACTOR)
+
+			# Update the head elevations and soil-gw interactions
+			hn += ((dqsdxy-dqs) * dtsp / Sy)
+			hriv[rn] = hr + (-kriv_r*qs_riv - dqs_riv)*dtsp/Sy[rpos]
+			a['anomaly'][n] = (dqsdxy-dqs) *dtsp
+			hn, dis = update_UZ_SZ_depth(hn, a['anomaly'][n], Sy, s['ths'][n],
+				a['tht'][n], s['fc'][n], z, a['Droot'][n])
+			a['discharge'][n] += dis
+			dqs[rpos] += dqs_riv*kAriv_r
+			a['discharge'][n] += dqs*dtsp
+
+			# Time step of the strip, from the transmissivity of the sub-step
+			time_step()
+			step.wait()
+			h[n] = hn
+
+			# Boundary outflows, summed as the serial solver
+			if k == 0:
+				if s['act_fix_link'] == 1:
+					flux_out += (np.sum(qs[s['fixed_links']])/dx)*dtsp
+				flux_out += np.sum(a['dfhbc'])
+
+			# Update time step
+			dtsp = np.nanmin(scalars[4:])
+			if dtsp <= 0:
+				raise Exception("invalid time step", dtsp)
+			if dtp == dt:
+				dtp += dtsp
+			elif (dtp + dtsp) > dt:
+				dtsp = dt - dtp
+				dtp += dtsp
+			else:
+				dtp += dtsp
+			step.wait()
+
+		return nsteps, flux_out
+
+	while True:
+		start.wait()
+		if scalars[3] == 0:
+			break
+		try:
+			nsteps, flux_out = worker_steps()
+		except Exception:
+			# Release the other processes before failing
+			step.abort()
+			done.abort()
+			raise
+		if k == 0:
+			scalars[1] = flux_out
+			scalars[2] = nsteps
+		done.wait()
+
+	for name in shm:
+		shm[name].close()
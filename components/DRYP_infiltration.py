@@ -1,7 +1,18 @@
 import numpy as np
 import os
+import copy
+import scipy.special as spy
 from landlab import RasterModelGrid
 from landlab.io import read_esri_ascii
+try:
+	# compiled infiltration and soil water balance kernel (numba)
+	from components.DRYP_column_kernel import column_step_jit
+except ImportError:
+	column_step_jit = None
+from timing import perf
+
+UGA_TABLE_CLASSES = 1024 # Maximum soil classes of Upscaled GA tables
+UGA_TABLE_MB = 256 # Maximum memory of Upscaled GA tables [MB]
 
 class infiltration(object):
 	def __init__(self, env_state, data_in):		
@@ -10,9 +21,9 @@ class infiltration(object):
 		if data_in.inf_method == 1:
 			print('Infiltration approach: Philips')			
 		elif data_in.inf_method == 2:
-			print('Infiltration approach: Modified GA')			
-		elif data_in.inf_method == 3:
 			print('Infiltration approach: Upscaled GA')			
+		elif data_in.inf_method == 3:
+			print('Infiltration approach: Modified GA')			
 		else:
 			print('Infiltration approach: Schaake Method')			
 		print('Change approach in setting_file: line 20')
@@ -39,9 +50,79 @@ class infiltration(object):
 				sigma_ks = read_esri_ascii(data_in.fname_sigma_ks, name = 'sigma_ks',grid = env_state.grid)[1]				
 				sigma_Ksat = np.array(env_state.grid.at_node['sigma_ks'][act_nodes]*data_in.k_sigma_ks)
 			mu_log_Ksat = np.log(self.K_sat) - 0.5*(sigma_Ksat**2)
-			self.args = (mu_log_Ksat, sigma_Ksat)
+			# Lookup tables of the infiltration, exact formulation if the
+			# tolerance is zero
+			table = None
+			if data_in.inf_table_tol > 0:
+				table = upscaled_ga_table(self.K_sat, mu_log_Ksat, sigma_Ksat,
+					data_in.inf_table_tol)
+			self.args = (mu_log_Ksat, sigma_Ksat, table)
+		# Ponding time of the previous step, first guess of the Newton
+		# iterations for Modified GA
+		elif data_in.inf_method == 3:
+			self.args = np.full(len(act_nodes), 0.1)
+			# Newton iterations of the ponding time of the current step
+			self.mod_ga_stats = {'nodes': 0, 'iterations': 0, 'not_converged': 0}
 		else:
 			self.args = ()
+		
+		# Rain-gated infiltration, only cells with rain are computed
+		self.sparse = data_in.sparse_soil
+		
+		# Compiled soil column kernel, infiltration and soil water balance
+		# of hillslope cells in one pass
+		self.column_kernel = data_in.column_kernel
+		if self.column_kernel and column_step_jit is None:
+			print('Compiled soil column kernel needs numba, using python infiltration')
+			self.column_kernel = 0
+		if self.column_kernel and data_in.dry_spell:
+			print('Soil dry spells are not available in the compiled soil column kernel, using python infiltration and soil water balance')
+			self.column_kernel = 0
+		if self.column_kernel and self.sparse:
+			print('Rain-gated soil updates are not available in the compiled soil column kernel, all cells are updated')
+		if self.column_kernel and data_in.inf_method == 2:
+			print('Upscaled GA is not available in the compiled soil column kernel, using python infiltration')
+			self.column_kernel = 0
+		if self.column_kernel:
+			self.kernel_nodes = np.ascontiguousarray(act_nodes, dtype=np.int64)
+			if data_in.inf_method == 0:
+				self.ga_kdt = np.array(self.args)
+			else:
+				self.ga_kdt = np.zeros(len(act_nodes))
+			# Ponding time of the previous step (Modified GA), updated
+			# in place by the kernel
+			if data_in.inf_method == 3:
+				self.to_0 = self.args
+			else:
+				self.to_0 = np.zeros(len(act_nodes))
+	
+	def run_column_one_step(self, rf, swb, env_state, data_in):
+		"""Infiltration and soil water balance of hillslope cells in the
+		compiled kernel, it updates the same states and fluxes as
+		run_infiltration_one_step and swbm.run_swbm_one_step
+		"""
+		grid = env_state.grid
+		swb.sro_dt *= 0.0
+		swb.pcl_dt *= 0.0
+		(self.rain_day_before, ponding, iterations,
+			not_converged) = column_step_jit(data_in.inf_method,
+			int(data_in.dt >= 1440), self.rain_day_before, self.kernel_nodes,
+			np.asarray(rf.rain, dtype=float), self.K_sat, self.PSI_f,
+			self.ga_kdt, self.to_0, env_state.Duz, env_state.SORP0, env_state.L_0,
+			env_state.Lsat, env_state.t_0, env_state.Ft_0, self.inf_dt,
+			self.exs_dt, np.asarray(rf.PET, dtype=float), env_state.Kc,
+			grid.at_node['Ksat_soil'], swb.L_0,
+			grid.at_node['saturated_water_content'], env_state.fc,
+			grid.at_node['wilting_point'], env_state.c_SOIL,
+			swb.aet_dt, swb.pcl_dt, swb.tht_dt, swb.sro_dt, swb.WRSI)
+		swb.gwe_dt = rf.PET - swb.aet_dt
+		if data_in.inf_method == 3:
+			self.mod_ga_stats.update(nodes=ponding, iterations=iterations,
+				not_converged=not_converged)
+			if ponding > 0:
+				perf.count('Mod GA ponding cells', int(ponding))
+				perf.count('Mod GA Newton iterations', int(iterations))
+				perf.count('Mod GA not converged', int(not_converged))
 	
 	def run_infiltration_one_step(self, rf, env_state, data_in):
 		# L_0:	Initial soil water content [mm]
@@ -51,8 +132,19 @@ class infiltration(object):
 		# SORP0:Sorptivity at the begining of the time step
 		inf_method = data_in.inf_method
 		act_nodes = env_state.act_nodes
+		cells = slice(None)
+		args = self.args
+		if self.sparse:
+			# Infiltration of cells with rain, dry cells are updated
+			# after (run_infiltration_dry)
+			rain = rf.rain[act_nodes] != 0.0
+			cells = np.where(rain)[0]
+			dry = act_nodes[~rain]
+			act_nodes = act_nodes[cells]
+			args = self.subset_args(inf_method, cells)
 		rainfall = np.array(rf.rain[act_nodes])
-		PSI_f = np.array(self.PSI_f)
+		K_sat = self.K_sat[cells]
+		PSI_f = np.array(self.PSI_f[cells])
 		Droot = np.array(env_state.Duz[act_nodes])
 		SORP0 = np.array(env_state.SORP0[act_nodes])
 		L_0 = np.array(env_state.L_0[act_nodes])
@@ -60,16 +152,21 @@ class infiltration(object):
 		t_0 = np.array(env_state.t_0[act_nodes])
 		Ft0 = np.array(env_state.Ft_0[act_nodes])
 		rain_day_before = self.rain_day_before
+		stats = None
+		if inf_method == 3:
+			stats = self.mod_ga_stats
+			stats.update(nodes=0, iterations=0, not_converged=0)
 				
 		Ft, SORP, inf_t, excess, t_0, rain_day_before = infiltration_model(rainfall,
-																self.K_sat,
+																K_sat,
 																PSI_f,
 																Droot,SORP0,
 																L_0,Lsat,
 																np.array(t_0),
 																Ft0,rain_day_before,
 																inf_method,
-																self.args)
+																args,
+																stats=stats)
 
 		# Update environmental states
 		env_state.Ft_0[act_nodes] = Ft
@@ -78,8 +175,47 @@ class infiltration(object):
 		self.rain_day_before = rain_day_before
 		self.inf_dt[act_nodes] = inf_t
 		self.exs_dt[act_nodes] = excess
+		if self.sparse:
+			if inf_method == 3:
+				self.args[cells] = args
+			self.run_infiltration_dry(env_state, inf_method, dry, rain)
+		if inf_method == 3 and stats['nodes'] > 0:
+			perf.count('Mod GA ponding cells', stats['nodes'])
+			perf.count('Mod GA Newton iterations', stats['iterations'])
+			perf.count('Mod GA not converged', stats['not_converged'])
 
-def infiltration_model(rainfall,K_sat,PSI_f,Droot,SORP0,L_0,Lsat,t_0,Ft0,rain_day_before,inf_method,*args):
+	def subset_args(self, inf_method, cells):
+		"""Parameters of the infiltration method for a subset of
+		active cells
+		"""
+		if inf_method == 0 or inf_method == 3:
+			return self.args[cells]
+		elif inf_method == 2:
+			mu_log_Ksat, sigma_Ksat, table = self.args
+			if table is not None:
+				table = table.subset(cells)
+			return (mu_log_Ksat[cells], sigma_Ksat[cells], table)
+		return self.args
+	
+	def run_infiltration_dry(self, env_state, inf_method, dry, rain):
+		"""Update of cells without rain (nodes dry), no infiltration and
+		runoff, the sorptivity is kept for the next step if it rains
+		over other cells, otherwise the infiltration event finishes
+		Parameters:
+			rain:	Active cells with rain (boolean)
+		"""
+		self.inf_dt[dry] = 0.0
+		self.exs_dt[dry] = 0.0
+		env_state.Ft_0[dry] = 0.0
+		if self.rain_day_before == 1:
+			env_state.SORP0[dry] = sorptivity(self.K_sat[~rain], self.PSI_f[~rain],
+				env_state.Duz[dry], env_state.Lsat[dry], env_state.L_0[dry],
+				inf_method)
+		else:
+			env_state.SORP0[dry] = 0.0
+			env_state.t_0[dry] = 0.0
+
+def infiltration_model(rainfall,K_sat,PSI_f,Droot,SORP0,L_0,Lsat,t_0,Ft0,rain_day_before,inf_method,*args,stats=None):
 	"""
 	Parameters:
 		grid		: Landlad grid
@@ -114,12 +250,12 @@ def infiltration_model(rainfall,K_sat,PSI_f,Droot,SORP0,L_0,Lsat,t_0,Ft0,rain_da
 		t_i = np.zeros(len(rainfall))
 		if inf_method == 0: # SCHAAKE METHOD
 			ga_kdt = args[0]
-			SORP = np.zeros(len(rainfall))
+			SORP = sorptivity(K_sat,PSI_f,Droot,Lsat,L_0,inf_method)
 			Ft = np.zeros(len(rainfall))
 			inf_dt, excess_dt = SCHAAKE(rainfall, ga_kdt, Lsat, L_0)
 		elif inf_method == 1: # PHILIPS EQUATION
 			F = np.zeros(len(rainfall))
-			SORP = np.where(Droot == 0,0.0,np.sqrt(2*K_sat*PSI_f*((Lsat-L_0)/Droot)))
+			SORP = sorptivity(K_sat,PSI_f,Droot,Lsat,L_0,inf_method)
 			if rain_day_before == 1:
 				SORP[inode_inf_aux] = SORP0[inode_inf_aux]
 				t_i[inode_inf_aux] = t_0[inode_inf_aux]
@@ -132,17 +268,22 @@ def infiltration_model(rainfall,K_sat,PSI_f,Droot,SORP0,L_0,Lsat,t_0,Ft0,rain_da
 			Ft = np.zeros(len(rainfall))
 			mu_logks = args[0][0]
 			sigma_ks = args[0][1]
-			SORP = np.where(Droot == 0,0.0,PSI_f*((Lsat-L_0)/Droot))
+			table = args[0][2]
+			SORP = sorptivity(K_sat,PSI_f,Droot,Lsat,L_0,inf_method)
 			if rain_day_before == 1:
 				SORP[inode_inf_aux] = SORP0[inode_inf_aux]
 				t_i[inode_inf_aux] = t_0[inode_inf_aux]
-			inf_dt,excess_dt = Upscaled_GA(rainfall,K_sat,SORP,
-											np.array(t_i+1.0),
-											mu_logks,
-											sigma_ks)
+			if table is None:
+				inf_dt,excess_dt = Upscaled_GA(rainfall,K_sat,SORP,
+												np.array(t_i+1.0),
+												mu_logks,
+												sigma_ks)
+			else:
+				inf_dt,excess_dt = table.run(rainfall,SORP,np.array(t_i+1.0),
+												K_sat,mu_logks,sigma_ks)
 		elif inf_method == 3: # MODIFIED GREEN AND AMPT EQUATION
 			F = np.zeros(len(rainfall))
-			SORP = np.where(Droot == 0,0.0,np.sqrt(2*K_sat*PSI_f*((Lsat-L_0)/Droot)))
+			SORP = sorptivity(K_sat,PSI_f,Droot,Lsat,L_0,inf_method)
 			if rain_day_before == 1:
 				SORP[inode_inf_aux] = SORP0[inode_inf_aux]
 				t_i[inode_inf_aux] = t_0[inode_inf_aux]
@@ -151,7 +292,9 @@ def infiltration_model(rainfall,K_sat,PSI_f,Droot,SORP0,L_0,Lsat,t_0,Ft0,rain_da
 										K_sat,
 										np.array(SORP),
 										F,
-										np.array(t_i),1.)
+										np.array(t_i),1.,
+										args[0],
+										stats=stats)
 		
 		t_0[inode_inf_aux] += 1
 		rain_day_before = 1
@@ -165,6 +308,14 @@ def infiltration_model(rainfall,K_sat,PSI_f,Droot,SORP0,L_0,Lsat,t_0,Ft0,rain_da
 	excess_dt += sat_excess_dt
 	return Ft, SORP, inf_dt, excess_dt, t_0, rain_day_before
 
+# Sorptivity at the beginning of an infiltration event
+def sorptivity(K_sat,PSI_f,Droot,Lsat,L_0,inf_method):
+	if inf_method == 1 or inf_method == 3:
+		return np.where(Droot == 0,0.0,np.sqrt(2*K_sat*PSI_f*((Lsat-L_0)/Droot)))
+	elif inf_method == 2:
+		return np.where(Droot == 0,0.0,PSI_f*((Lsat-L_0)/Droot))
+	return np.zeros(len(L_0))
+
 # Schaake infiltration approach, Schaake et. al. (1996)
 def SCHAAKE(P,ga_kdt,Lsat,L):
 	D = Lsat-L
@@ -217,7 +368,7 @@ def Gauss2p(t, Sp, P, mu_Y, sigma_Y, ks):
 	km = P*X-dk
 	k1 = km-0.57735*dk
 	k2 = km+0.57735*dk
-	return dk*P*(epsilon_fks(k1,t,Sp,P,mu_Y,sigma_Y,ks)+epsilon_fks(k1,t,Sp,P,mu_Y,sigma_Y,ks))
+	return dk*P*(epsilon_fks(k1,t,Sp,P,mu_Y,sigma_Y,ks)+epsilon_fks(k2,t,Sp,P,mu_Y,sigma_Y,ks))
 
 # Epsilon funtion for upscaled GA infiltration	
 def epsilon_fks(k,t,Sp,P,mu_Y,sigma_Y,ks):
@@ -229,6 +380,208 @@ def epsilon_fks(k,t,Sp,P,mu_Y,sigma_Y,ks):
 	epsilon[kp == 0.0] = 0
 	return epsilon*fks
 
+# Upscaled GA with y = P*X, I = P*(I_1+(1-X)**0.484*I_2), where I_1
+# and I_2 only depend on y and the soil parameters, through
+# log(y)-mu_Y, sigma_Y and log(ks)-mu_Y
+def Upscaled_GA_terms(y, ks, mu_Y, sigma_Y):
+	A = np.where(sigma_Y == 0, 1e99, (np.log(y)-mu_Y)/(sigma_Y*np.sqrt(2)))
+	Aaux = np.exp(mu_Y+0.5*(sigma_Y**2))
+	I_1 = 0.5*spy.erfc(A)+(0.5/y)*Aaux*spy.erfc((sigma_Y/np.sqrt(2))-A)
+	dk = 0.5*(y-np.exp(mu_Y-3.0*sigma_Y))
+	km = y-dk
+	fks = 0.0
+	for k in (km-0.57735*dk, km+0.57735*dk):
+		fks = fks + np.where(k <= 0.0,0.0,(1.0/(k*sigma_Y*np.sqrt(2.0*np.pi)))*np.exp(-0.5*(np.power((np.log(k)-mu_Y)/sigma_Y,2))))
+	kp = ks/y
+	epsilon = np.where((kp >= 1.0) | (kp == 0.0),0.0,0.36315*np.power(np.abs(1.0-kp),1.74)*np.power(kp,0.38))
+	I_2 = dk*epsilon*fks
+	return I_1, I_2
+
+class upscaled_ga_table(object):
+	"""Lookup tables of the Upscaled GA infiltration for each class of
+	soil parameters (sigma_Y, log(ks)-mu_Y), linear in z = log(P*X)-mu_Y.
+	Parameters of cells are binned into at most max_classes classes
+	(parameter_classes). Points of a class are doubled until the error of
+	infiltration [fraction of rainfall] against the exact formulation
+	(Upscaled_GA) is below tol (half of tol if parameters are binned), up
+	to n_max points and max_mb of tables. Classes above tol, including the
+	binning error, use the exact formulation.
+	Parameters:
+		ks:		Saturated hydraulic conductivity of cells
+		mu_Y:	Mean of log(Ksat) of cells
+		sigma_Y:Standard deviation of log(Ksat) of cells
+		tol:	Error tolerance
+	"""
+	def __init__(self, ks, mu_Y, sigma_Y, tol, n_max=16385,
+			max_classes=UGA_TABLE_CLASSES, max_mb=UGA_TABLE_MB):
+		par_cells = np.column_stack((sigma_Y, np.log(ks)-mu_Y))
+		self.cls, par, bin_size = parameter_classes(par_cells, max_classes)
+		self.sigma_Y, self.d = par[:, 0], par[:, 1]
+		ncls = len(self.d)
+		# z range, outside the range the exact formulation is used
+		self.z0 = -9.0*self.sigma_Y-5.0
+		z1 = 9.0*self.sigma_Y+5.0
+		self.n = np.zeros(ncls, dtype=int)
+		self.dz = np.zeros(ncls)
+		error = np.zeros(ncls)
+		I_1, I_2 = [None]*ncls, [None]*ncls
+		refine = np.arange(ncls)
+		# half of the tolerance is left to binned parameters
+		tol_table = tol
+		if bin_size > 0:
+			tol_table = 0.5*tol
+		n = 65
+		while True:
+			dz = (z1[refine]-self.z0[refine])/(n-1)
+			z = self.z0[refine, None]+dz[:, None]*np.arange(n)
+			with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+				T_1, T_2 = Upscaled_GA_terms(np.exp(z), np.exp(self.d[refine, None]),
+					0.0, self.sigma_Y[refine, None])
+				error[refine] = self.validate(refine, z, T_1, T_2)
+			for k, c in enumerate(refine):
+				I_1[c], I_2[c] = T_1[k], T_2[k]
+			self.n[refine] = n
+			self.dz[refine] = dz
+			refine = refine[error[refine] > tol_table]
+			if len(refine) == 0 or n >= n_max:
+				break
+			# Memory of the tables after the next refinement
+			mb = 16.0*(np.sum(self.n)+len(refine)*(n-1))/2**20
+			if mb > max_mb:
+				print('Upscaled GA tables: memory limit of %d MB reached' % max_mb)
+				break
+			n = 2*n-1
+		self.offset = np.concatenate(([0], np.cumsum(self.n)[:-1]))
+		self.I_1 = np.concatenate(I_1)
+		self.I_2 = np.concatenate(I_2)
+		
+		# Error of binned cells against their own parameters
+		if bin_size > 0:
+			with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+				error += self.binning_error(par_cells)
+		self.exact = error > tol
+		
+		print('Upscaled GA tables: %d soil classes, %d to %d points, %.1f MB, max error %.2e (tolerance %.2e)'
+			% (ncls, np.min(self.n), np.max(self.n), 16.0*len(self.I_1)/2**20,
+			np.max(error[~self.exact], initial=0.0), tol))
+		if bin_size > 0:
+			print('Upscaled GA tables: %d cells binned into %d classes, bin size %.3g'
+				% (len(self.cls), ncls, bin_size))
+		if np.any(self.exact):
+			print('Upscaled GA tables: tolerance not reached for %d soil classes (%d cells), they use the exact formulation'
+				% (np.sum(self.exact), np.sum(self.exact[self.cls])))
+			print('Increase the tolerance or use the exact formulation (tolerance 0)')
+	
+	def validate(self, classes, z, I_1, I_2):
+		"""Maximum error of infiltration [fraction of rainfall] of classes
+		against the exact formulation at the midpoints of their tables
+		(points z), for X = 0.01, 0.5 and 0.99
+		"""
+		z = 0.5*(z[:, :-1]+z[:, 1:])
+		I_1 = 0.5*(I_1[:, :-1]+I_1[:, 1:])
+		I_2 = 0.5*(I_2[:, :-1]+I_2[:, 1:])
+		error = np.zeros(len(classes))
+		for X in (0.01, 0.5, 0.99):
+			P = np.exp(z)/X
+			Sp = P*(1.0/X-1.0)
+			t = np.ones(P.shape)
+			I_exact = Upscaled_GA(P, np.exp(self.d[classes, None]), Sp, t, 0.0,
+				self.sigma_Y[classes, None])[0]
+			I_table = P*(I_1+np.power(1.0-X, 0.484)*I_2)
+			error = np.fmax(error, np.nanmax(np.abs(I_table-I_exact)/P, axis=1))
+		return error
+	
+	def binning_error(self, par, npoints=65):
+		"""Maximum difference of infiltration [fraction of rainfall] of
+		classes and the cells with the lowest and highest parameters of
+		each class (par), for npoints in the range of the tables and
+		X = 0.01, 0.5 and 0.99
+		"""
+		cells = []
+		for j in range(par.shape[1]):
+			order = np.lexsort((par[:, j], self.cls))
+			first = np.searchsorted(self.cls[order], np.arange(len(self.d)))
+			last = np.append(first[1:], len(order))-1
+			cells.append(order[first])
+			cells.append(order[last])
+		cells = np.unique(np.concatenate(cells))
+		c = self.cls[cells]
+		z = (self.z0[c, None]+self.dz[c, None]*(self.n[c, None]-1)
+			* (np.arange(npoints)+0.5)/npoints)
+		error = np.zeros(len(self.d))
+		for X in (0.01, 0.5, 0.99):
+			P = np.exp(z)/X
+			Sp = P*(1.0/X-1.0)
+			t = np.ones(P.shape)
+			I_cell = Upscaled_GA(P, np.exp(par[cells, 1])[:, None], Sp, t, 0.0,
+				par[cells, 0][:, None])[0]
+			I_class = Upscaled_GA(P, np.exp(self.d[c, None]), Sp, t, 0.0,
+				self.sigma_Y[c, None])[0]
+			np.fmax.at(error, c, np.nanmax(np.abs(I_cell-I_class)/P, axis=1))
+		return error
+	
+	def interpolate(self, P, Sp, t, mu_Y, cls):
+		"""Infiltration from the tables, cells outside the range of the
+		tables are returned as out
+		"""
+		X = getX(t, Sp, P)
+		I = np.zeros(len(P))
+		wet = np.where(X > 0.0)[0]
+		c = cls[wet]
+		pos = (np.log(P[wet]*X[wet])-mu_Y[wet]-self.z0[c])/self.dz[c]
+		i = np.floor(pos).astype(int)
+		inside = (i >= 0) & (i < self.n[c]-1)
+		out = wet[~inside]
+		wet, pos, i, c = wet[inside], pos[inside], i[inside], c[inside]
+		w = pos-i
+		i = i+self.offset[c]
+		I_1 = self.I_1[i]*(1.0-w)+self.I_1[i+1]*w
+		I_2 = self.I_2[i]*(1.0-w)+self.I_2[i+1]*w
+		I[wet] = P[wet]*(I_1+np.power(1.0-X[wet], 0.484)*I_2)
+		return I, out
+	
+	def subset(self, cells):
+		"""Tables of a subset of cells
+		"""
+		table = copy.copy(self)
+		table.cls = self.cls[cells]
+		return table
+	
+	def run(self, P, Sp, t, ks, mu_Y, sigma_Y):
+		"""Upscaled GA infiltration of active cells from the tables, cells
+		outside the tables or in classes above the tolerance use the exact
+		formulation with the parameters of cells (ks, mu_Y, sigma_Y)
+		"""
+		I, out = self.interpolate(P, Sp, t, mu_Y, self.cls)
+		out = np.union1d(out, np.where(self.exact[self.cls] & (P > 0.0))[0])
+		if len(out) > 0:
+			perf.count('Upscaled GA exact cells', len(out))
+			I[out] = Upscaled_GA(P[out], ks[out], Sp[out], t[out],
+				mu_Y[out], sigma_Y[out])[0]
+		return I, P-I
+
+def parameter_classes(par, max_classes):
+	"""Classes of the parameters of cells (par, a row per cell), one class
+	per parameter set if there are at most max_classes, otherwise the
+	parameters are binned on a regular grid, the bin size is doubled
+	until there are at most max_classes bins.
+	Returns the class of cells, the mean parameters of classes and the
+	bin size (0 if not binned)
+	"""
+	key, cls = np.unique(par, axis=0, return_inverse=True)
+	bin_size = 0.0
+	if len(key) > max_classes:
+		bin_size = np.max(np.ptp(par, axis=0))/max_classes
+		while True:
+			key, cls = np.unique(np.floor(par/bin_size), axis=0, return_inverse=True)
+			if len(key) <= max_classes:
+				break
+			bin_size *= 2
+	cls = cls.reshape(-1)
+	ncells = np.bincount(cls)
+	mean = np.column_stack([np.bincount(cls, p)/ncells for p in par.T])
+	return cls, mean, bin_size
+
 # Dimentionless time parameter	
 def getX(t, Sp, P):
 	X_aux = P*t/Sp
@@ -237,14 +590,24 @@ def getX(t, Sp, P):
 
 # Modified Green & Ampt infiltration approach
 # Requires solver (Newthon_Rap_Mod_GA) and F (f_GA) and F' (dF_GA)
-def Mod_GA(P,ks,Sp,F,t,dt):
+def Mod_GA(P,ks,Sp,F,t,dt,*to_0,stats=None):
+	"""Modified Green & Ampt infiltration
+	Parameters:
+		to_0:	Ponding time of the previous step, first guess of the
+				Newton iterations (0.1 if not given), it is updated
+				for cells ponding during the time step
+		stats:	Newton iteration counters, updated if given
+	"""
 	tp = np.where(P > ks,Sp/(P-ks),0)
 	aux_1 = tp-t
 	aux_2 = t+1-tp
 	aux = aux_1*aux_2
 	id_error = np.where(aux >= 0)[0]
 	if len(id_error) > 0: # ponding during time step
-		to = Newthon_Rap_Mod_GA(P,ks,Sp,F,t,tp,0.1)
+		if to_0:
+			to = Newthon_Rap_Mod_GA(P,ks,Sp,F,t,tp,to_0[0],stats=stats)
+		else:
+			to = Newthon_Rap_Mod_GA(P,ks,Sp,F,t,tp,0.1,stats=stats)
 	else:
 		to = t
 	Faux = np.where(to == 0,0,ks*(t+dt-to)+Sp*np.log((t+dt)/to))
@@ -257,23 +620,46 @@ def Mod_GA(P,ks,Sp,F,t,dt):
 	RO = P-I
 	return F_tf, I, RO
 	
-def Newthon_Rap_Mod_GA(P,ks,Sp,F,t,tp,to_0):
-	error = np.zeros(len(F))
-	aux_1 = tp-t
-	aux_2 = t+1-tp
-	aux = aux_1*aux_2
-	id_error = np.where(aux > 0)[0]
-	len_error = len(id_error)
-	error[id_error] = 1
-	to = t
-	
-	while len_error > 0:
-		to = np.where(error < 0.001,t,to_0-f_GA(P,ks,Sp,F,t,tp,to_0)/dF_GA(ks,Sp,to_0))
-		error = np.where(error <= 0.001,0.0,np.abs(to-to_0)/to)
-		len_error = len(np.where(error >= 0.001)[0])
-		to_0 = to	
+def Newthon_Rap_Mod_GA(P,ks,Sp,F,t,tp,to_0,max_iter=50,stats=None):
+	"""Ponding time of cells ponding during the time step, only cells
+	that have not converged are iterated, up to max_iter iterations.
+	Iterations start below the solution (f_GA > 0), convergence is
+	monotonic from there: the first guess to_0 (value or array) is
+	used if it is below the solution, otherwise 0.1, halved until it
+	is below the solution. An array to_0 is updated in place.
+	Iterations are added to the counters of stats if given.
+	"""
+	to = np.array(t, dtype=float)
+	act = np.where((tp-t)*(t+1-tp) > 0)[0]
+	if len(act) == 0:
+		return to
+	start = np.broadcast_to(to_0, to.shape)[act]
+	to[act] = np.where(start > 0, start, 0.1)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		above = act[f_GA(P[act],ks[act],Sp[act],F[act],t[act],tp[act],to[act]) <= 0]
+		to[above] = 0.1
+		while len(above) > 0:
+			above = above[f_GA(P[above],ks[above],Sp[above],F[above],t[above],tp[above],to[above]) <= 0]
+			to[above] *= 0.5
+	ponding = act
+	niter = 0
+	iterations = 0
+	while len(act) > 0 and niter < max_iter:
+		to_aux = to[act]
+		to[act] = to_aux-(f_GA(P[act],ks[act],Sp[act],F[act],t[act],tp[act],to_aux)
+			/ dF_GA(ks[act],Sp[act],to_aux))
+		error = np.abs(to[act]-to_aux)/to[act]
+		iterations += len(act)
+		act = act[error >= 0.001]
+		niter += 1
+	if stats is not None:
+		stats['nodes'] += len(ponding)
+		stats['iterations'] += iterations
+		stats['not_converged'] += len(act)
+	if isinstance(to_0, np.ndarray):
+		to_0[ponding] = to[ponding]
 	return to
-	
+
 # Implicit solution of Green and Ampt equation	
 def f_GA(P,ks,Sp,F,t,tp,to):	
 	return ks*(tp-to)+Sp*np.log(tp/to)-F-P*(tp-t)
@@ -8,7 +8,8 @@ from landlab.io import read_esri_ascii, write_esri_ascii
 from landlab.io.netcdf import read_netcdf, write_netcdf
 from datetime import timedelta, datetime
 from netCDF4 import Dataset, num2date, date2num
-from landlab.components import FlowDirectorSteepest, FlowAccumulator
+from landlab.components import FlowDirectorSteepest
+from components.DRYP_flow_topology import set_flow_topology
 # Global parameters
 ABC_RIVER = 0.2 # River abstraction parameter
 
@@ -140,6 +141,45 @@ class inputfile(object):
 		self.kKsat_gw = float(fsimpar.DWAPM_SET[62])# Runoff decay flow
 		self.kSy_gw = float(fsimpar.DWAPM_SET[64])
 		
+		# Performance options, not available in older setting files
+		self.routing_engine = int(read_setting(fsimpar, 67, 1))
+		self.save_flow_topology = int(read_setting(fsimpar, 69, 0))
+		self.wet_front_routing = int(read_setting(fsimpar, 71, 0))
+		self.linear_routing = int(read_setting(fsimpar, 73, 0))
+		self.loss_model = int(read_setting(fsimpar, 75, 0))
+		self.n_manning = float(read_setting(fsimpar, 77, 0.035))
+		# Ensemble routing, space separated values of Kloss and T_loss
+		self.ens_Kloss = np.array(str(read_setting(fsimpar, 79, 0)).split(), dtype=float)
+		self.ens_T_loss = np.array(str(read_setting(fsimpar, 81, 0)).split(), dtype=float)
+		self.ensemble_routing = int(np.any(self.ens_Kloss != 0) or np.any(self.ens_T_loss != 0))
+		self.instrumentation = int(read_setting(fsimpar, 83, 0))
+		self.gw_solver = int(read_setting(fsimpar, 85, 0))
+		self.gw_local_steps = int(read_setting(fsimpar, 87, 0))
+		self.gw_workers = int(read_setting(fsimpar, 89, 1))
+		# Steady-state groundwater spin-up, recharge [mm/year] as a value or map
+		self.gw_steady_state = int(read_setting(fsimpar, 91, 0))
+		self.gw_steady_recharge = str(read_setting(fsimpar, 93, 0)).strip()
+		# Dormant groundwater regions, head change rate tolerance [mm/day]
+		self.gw_dormant_tol = float(read_setting(fsimpar, 95, 0))
+		# Groundwater grid size as a multiple of the surface grid size
+		self.gw_coarse_factor = int(read_setting(fsimpar, 97, 1))
+		# Deep groundwater layer, space separated values of thickness [m],
+		# saturated hydraulic conductivity, specific yield and specific
+		# storage [1/m], a zero thickness is a single layer model
+		self.gw_deep_layer = np.array(str(read_setting(fsimpar, 99, 0)).split(), dtype=float)
+		if self.gw_coarse_factor > 1 and self.gw_deep_layer[0] > 0:
+			raise Exception("Groundwater deep layer is not available on a coarse groundwater grid")
+		# Groundwater sub-steps and Courant limiting nodes
+		self.gw_telemetry = int(read_setting(fsimpar, 101, 0))
+		# Infiltration and soil water balance in the compiled column kernel
+		self.column_kernel = int(read_setting(fsimpar, 103, 0))
+		# Upscaled GA lookup tables, error tolerance [fraction of rainfall]
+		self.inf_table_tol = float(read_setting(fsimpar, 105, 0))
+		# Infiltration and soil water balance of cells with rain only
+		self.sparse_soil = int(read_setting(fsimpar, 107, 0))
+		# Maximum length of dry spells of the soil water balance [steps]
+		self.dry_spell = int(read_setting(fsimpar, 109, 0))
+		
 		#self.kTr_ini_par = float(fsimpar.DWAPM_SET[51])
 		#self.kpKloss = float(fsimpar.DWAPM_SET[51])
 		#self.kpLoss = float(fsimpar.DWAPM_SET[51])
@@ -162,11 +202,32 @@ class inputfile(object):
 		self.kpKloss = 1.0							# initial Kloss increase for TL
 		self.T_str_channel = 0.0			# duration of initial Kloss increase for TL
 		self.Kloss = self.Kloss*self.unit_sim_k
+		self.ens_Kloss = self.ens_Kloss*self.unit_sim_k
 		self.river_banks = 20.0 					# Riparian zone with [m]
 		self.run_FAc = 1
 		self.dt_OF = 1
 		self.Sim_period = self.end_datet - self.ini_date
 
+def read_setting(fsimpar, line, default):
+	"""Read an optional line of the parameter setting file, the
+	default value is used when the line is not in the file
+	"""
+	if len(fsimpar) <= line:
+		return default
+	return fsimpar.DWAPM_SET[line]
+
+def steady_state_recharge(inputfile, env_state):
+	"""Recharge rate of the steady-state groundwater spin-up [m/h], a
+	constant value or a raster map of long-term mean recharge [mm/year]
+	"""
+	if os.path.exists(inputfile.gw_steady_recharge):
+		recharge = np.array(read_esri_ascii(inputfile.gw_steady_recharge,
+			name='steady_state_recharge', grid=env_state.SZgrid)[1])
+	else:
+		recharge = np.zeros(env_state.SZgrid.number_of_nodes)
+		recharge += float(inputfile.gw_steady_recharge)
+	return recharge*0.001/(365.25*24)
+
 class model_environment_status(object):
 	"""Setting model input varables and environmental states
 	"""
@@ -223,13 +284,6 @@ class model_environment_status(object):
 		# Reading catchment cell areas
 		if os.path.exists(inputfile.fname_Area):
 			cth_area = read_esri_ascii(inputfile.fname_Area, name = 'cth_area_k', grid = rg)[1]
-			
-			area_aux = FlowAccumulator(rg, 'topographic__elevation',
-										flow_director = 'D8',
-										runoff_rate = 'cth_area_k')
-					
-			area_aux.accumulate_flow(update_flow_director=self.act_update_flow_director)	
-			self.area_discharge = np.array(rg.at_node['surface_water__discharge'])
 			self.cth_area = np.array(cth_area)
 			self.run_flow_accum_areas = 1
 		else:
@@ -341,6 +395,15 @@ class model_environment_status(object):
 		gw.status_at_node[np.where(gwz <= 0)[0]] = gw.BC_NODE_IS_CLOSED # Model domain of the GW
 		rg.status_at_node[np.where(gwz <= 0)[0]] = rg.BC_NODE_IS_CLOSED # Model domain of the OF
 		
+		# Flow directions and upstream node order are computed only once,
+		# they are used for catchment areas and for routing
+		self.flow_topology = set_flow_topology(rg, inputfile.fname_DEM,
+			self.act_update_flow_director, inputfile.save_flow_topology)
+		self.act_update_flow_director = False
+		
+		if self.run_flow_accum_areas == 1:
+			self.area_discharge = self.flow_topology.accumulate(rg.at_node['cth_area_k'])
+		
 		# ========================== Creating landlab fields =====================
 		# Soil parameters fields
 		rg.add_zeros('node', 'runoff', dtype=float)
@@ -82,6 +82,42 @@ class rainfall(object):
 		self.PET = np.zeros(env_state.grid_size)
 		self.PETr = np.zeros(env_state.grid_size)
 		self.t_end = t_end
+		# Length of dry spells from each time step for the soil water
+		# balance
+		self.dry_steps = None
+		self.dry_pet = None
+		if inputfile.dry_spell > 0:
+			self.dry_spell_index(inputfile)
+	
+	def dry_spell_index(self, inputfile):
+		"""Number of time steps from each step, up to inputfile.dry_spell,
+		without precipitation (no record or zero uniform precipitation).
+		Uniform evapotranspiration of steps is kept in dry_pet, for NETCF
+		files spells are limited to steps with the same record
+		"""
+		nsteps = len(self.idatepre)
+		dry = np.isnan(self.idatepre)
+		if inputfile.netcf_pre != 1:
+			pre = np.asarray(self.fpre['pre'], dtype=float)
+			dry[~dry] = pre[self.idatepre[~dry].astype(int)] == 0
+		# Evapotranspiration of each step, record for NETCF files
+		j_te = np.minimum(np.arange(nsteps)//inputfile.dt_sub_hourly, len(self.idateETo)-1)
+		if inputfile.netcf_ETo != 1:
+			eto = np.asarray(self.dataETo['ETo'], dtype=float)[self.idateETo[j_te]]
+			self.dry_pet = eto*inputfile.unit_sim
+		else:
+			eto = np.array(self.idateETo[j_te], dtype=float)
+		self.dry_steps = np.zeros(nsteps, dtype=int)
+		n = 0
+		for j in range(nsteps-1, -1, -1):
+			if not dry[j]:
+				n = 0
+			elif j+1 < nsteps and dry[j+1] and (self.dry_pet is not None
+					or eto[j+1] == eto[j]):
+				n += 1
+			else:
+				n = 1
+			self.dry_steps[j] = min(n, inputfile.dry_spell)
 
 	# find precipitation and PET for an specific time step
 	def run_rainfall_one_step(self, j_tp, j_te, env_state, inputfile):
@@ -1,12 +1,21 @@
+import os
 import numpy as np
+from functools import partial
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.linalg import splu
 from landlab.components import LossyFlowAccumulator
 # import pyximport; pyximport.install()
 # from components.TransLoss import TransLossWVc # for windows
 # from TransLoss import TransLossWVc # for linux
+try:
+	# compiled routing kernel (components/setup.py)
+	from components.DRYP_routing_kernel import route_stack_wv
+except ImportError:
+	route_stack_wv = None
 
 # ADDITIONAL MODULES
-from timing import timer
-from termcolor import colored
+from timing import perf
 # ADDITIONAL MODULES
 
 river = None
@@ -28,12 +37,50 @@ class runoff_routing(object):
 		self.tls_dt = np.zeros(env_state.grid_size)
 		self.flow_tls_dt = np.zeros(env_state.grid_size)
 		self.carea = None
+		# routing engine: 0 landlab accumulator, 1 topological levels,
+		# 2 compiled kernel
+		self.engine = data_in.routing_engine
+		self.topology = None
+		if self.engine == 2 and route_stack_wv is None:
+			print('Compiled routing kernel not found, using python routing')
+			print('Build it in components with: python setup.py build_ext --inplace')
+			self.engine = 1
+		# wet front: route only the network downstream of wet nodes
+		self.wet_front = data_in.wet_front_routing
+		if self.engine == 0 and self.wet_front == 1:
+			print('Wet front routing is not available for the landlab accumulator')
+			self.wet_front = 0
+		# linear routing when transmission losses are not active
+		self.linear_path = data_in.linear_routing
+		if self.engine == 0 and self.linear_path == 1:
+			print('Linear routing is not available for the landlab accumulator')
+			self.linear_path = 0
+		# transmission losses: 0 exponential decay, 1 Manning
+		self.loss_model = data_in.loss_model
+		loss_function = TransLossWV
+		self.loss_function_level = TransLossWV_level
+		if self.loss_model == 1:
+			if self.engine == 2:
+				print('Manning losses are not available in the compiled kernel, using python routing')
+				self.engine = 1
+			self.linear_path = 0
+			loss_function = TranslossManning
+			# Newton iterations of the Manning losses of the current step
+			self.manning_stats = {'nodes': 0, 'iterations': 0,
+				'max_iterations': 0, 'not_converged': 0}
+			self.loss_function_level = partial(TranslossManning_level,
+				stats=self.manning_stats)
 				
 		fa = LossyFlowAccumulator(env_state.grid, 'topographic__elevation',
 								flow_director = 'D8',
-								loss_function = TransLossWV,
+								loss_function = loss_function,
 								runoff_rate = 'runoff')
 		self.fa = fa
+		if self.engine != 0:
+			self.set_topology(env_state)
+		if self.loss_model == 1:
+			Create_parameter_ManningTL(env_state.grid, data_in.n_manning,
+				data_in.unit_change_manning)
 
 	def base_flow_streams(self,env_state,dt):				
 		# dis_dt:	Discharge [mm]
@@ -63,9 +110,27 @@ class runoff_routing(object):
 					+ env_state.grid.at_node['Q_ini'][act_nodes]) > 0.0)[0])
 		
 		if check_dry_conditions > 0:
-			with timer('Accumulate flow...'):
+			perf.count('routing accumulations')
+			if self.loss_model == 1:
+				self.manning_stats.update(nodes=0, iterations=0,
+					max_iterations=0, not_converged=0)
+			# nodes downstream of wet nodes, once per step
+			mark = None
+			if self.engine != 0 and (self.wet_front == 1 or self.linear_path == 1):
+				mark = self.wet_nodes(env_state.grid)
+			if self.engine == 0:
 				self.fa.accumulate_flow(update_flow_director = env_state.act_update_flow_director)		# This one here needs a bit time to compute
-				print(colored(' ✔ Done!', 'green'))
+			elif self.linear_path == 1 and self.accumulate_flow_linear(env_state, mark):
+				perf.count('routing linear steps')
+			elif self.engine == 2:
+				self.accumulate_flow_kernel(env_state, mark)
+			else:
+				self.accumulate_flow_levels(env_state, mark)
+			if self.loss_model == 1 and self.engine != 0:
+				perf.count('routing Manning iterations', self.manning_stats['iterations'])
+				perf.count('routing Manning not converged', self.manning_stats['not_converged'])
+				if self.manning_stats['not_converged'] > 0:
+					print_manning_stats(self.manning_stats)
 			self.dis_dt[act_nodes] = np.array(
 					env_state.grid.at_node["surface_water__discharge"][act_nodes])
 			if self.carea is None:
@@ -88,6 +153,263 @@ class runoff_routing(object):
 		self.tls_dt = np.array(env_state.grid.at_node['Transmission_losses']*1000.0/env_state.area_cells)
 		self.tls_flow_dt = np.array(env_state.grid.at_node['Transmission_losses'])
 		self.qfl_dt[act_nodes] = np.array(env_state.grid.at_node['Q_ini'][act_nodes])
+
+	def accumulate_flow_levels(self, env_state, mark=None):
+		"""Route runoff and transmission losses level by level through
+		the flow network, it fills the same fields as the landlab
+		LossyFlowAccumulator. mark is the mask of wet_nodes.
+		"""
+		grid = env_state.grid
+		levels = None
+		if self.wet_front == 1:
+			levels = self.topology.subset_levels(mark)
+		Q, Qloss = route_flow_levels(self.topology, grid.at_node['runoff'],
+			self.loss_function_level, grid, levels)
+		grid.at_node['surface_water__discharge'][:] = Q
+		grid.at_node['surface_water__discharge_loss'][:] = Qloss
+
+	def accumulate_flow_kernel(self, env_state, mark=None):
+		"""Route runoff and transmission losses along the upstream node
+		order with the compiled kernel, it fills the same fields as the
+		landlab LossyFlowAccumulator. mark is the mask of wet_nodes.
+		"""
+		grid = env_state.grid
+		stack = self.kernel_stack
+		if self.wet_front == 1:
+			stack = self.topology.subset_stack(mark)
+		route_stack_wv(stack, self.kernel_receivers, self.kernel_area,
+			grid.at_node['runoff'], self.kernel_river,
+			grid.at_node['Q_ini'], grid.at_node['AOF'], grid.at_node['AOFT'],
+			grid.at_node['riv_sat_deficit'], grid.at_node['SS_loss'],
+			grid.at_node['decay_flow'], grid.at_node['par_3'], grid.at_node['par_4'],
+			grid.at_node['Transmission_losses'],
+			grid.at_node['surface_water__discharge'],
+			grid.at_node['surface_water__discharge_loss'])
+
+	def accumulate_flow_linear(self, env_state, mark):
+		"""Route runoff with the linear routing operator, it returns False
+		if transmission losses or abstraction limits may be active, then
+		the step has to be routed by the other engines. mark is the mask
+		of wet_nodes.
+		"""
+		grid = env_state.grid
+		if (np.any(grid.at_node['runoff'] < 0.0)
+				or np.any(grid.at_node['Q_ini'] < 0.0)):
+			return False
+		wet = self.river_flow_nodes[mark[self.river_flow_nodes]]
+		if np.any(grid.at_node['riv_sat_deficit'][wet] > 0.0):
+			return False
+		flow = self.linear.route(self.topology.node_cell_area*grid.at_node['runoff'], grid)
+		if flow is None:
+			return False
+		grid.at_node['surface_water__discharge'][:] = flow[0]
+		grid.at_node['surface_water__discharge_loss'][:] = flow[1]
+		return True
+
+	def set_topology(self, env_state):
+		"""Flow network used by the routing engines
+		"""
+		grid = env_state.grid
+		self.topology = env_state.flow_topology
+		grid.at_node['drainage_area'][:] = self.topology.drainage_area
+		r = self.topology.receivers
+		self.river_flow_nodes = np.where((grid.at_node['river'] != 0)
+			& (r != np.arange(len(r))))[0]
+		if self.engine == 2:
+			# the kernel reads contiguous 64 bit arrays
+			self.kernel_stack = np.ascontiguousarray(self.topology.stack, dtype=np.int64)
+			self.kernel_receivers = np.ascontiguousarray(r, dtype=np.int64)
+			self.kernel_river = np.ascontiguousarray(grid.at_node['river'], dtype=np.int64)
+			self.kernel_area = np.ascontiguousarray(self.topology.node_cell_area, dtype=np.float64)
+		if self.linear_path == 1:
+			self.linear = linear_routing(self.topology, self.river_flow_nodes,
+				grid.at_node['decay_flow'])
+
+	def wet_nodes(self, grid):
+		"""Mask of nodes downstream of wet nodes (runoff, water in the
+		channel or negative abstractions). Dry river nodes outside the
+		wet network have zero losses and abstractions.
+		"""
+		seeds = np.where((grid.at_node['runoff'] != 0.0)
+			| (grid.at_node['Q_ini'] != 0.0)
+			| ((grid.at_node['river'] != 0) & (grid.at_node['AOF'] < 0.0)))[0]
+		mark = self.topology.downstream(seeds)
+		dry = self.river_flow_nodes[~mark[self.river_flow_nodes]]
+		grid.at_node['AOF'][dry] = 0.0
+		grid.at_node['Transmission_losses'][dry] = 0.0
+		return mark
+
+class runoff_routing_ensemble(object):
+	"""Routing of the model runoff for an ensemble of transmission loss
+	parameters (Kloss, T_loss). Loss parameters and channel states
+	(Q_ini, AOF, Transmission_losses) have members in the first axis,
+	all members are routed in one pass through the flow network levels.
+	Parameters:
+		env_state:	Model environment
+		data_in:	Model inputs, ensemble Kloss and T_loss values
+	"""
+	def __init__(self, env_state, data_in):
+		grid = env_state.grid
+		if data_in.loss_model != 0:
+			raise Exception("Ensemble routing is only available for exponential decay losses")
+		# a zero value takes the parameter of the setting file
+		Kloss = np.where(data_in.ens_Kloss == 0, data_in.Kloss, data_in.ens_Kloss)
+		T_loss = np.where(data_in.ens_T_loss == 0, data_in.T_loss, data_in.ens_T_loss)
+		self.Kloss, self.T_loss = np.broadcast_arrays(Kloss, T_loss)
+		if data_in.Kloss == 0:
+			raise Exception("Ensemble routing requires a Kloss value different from zero")
+		self.members = len(self.Kloss)
+		self.topology = env_state.flow_topology
+		shape = (self.members, env_state.grid_size)
+		
+		# Channel losses scale with Kloss (Ksat_ch)
+		self.fields = node_fields(grid)
+		self.fields['decay_flow'] = (data_in.kT_units/self.T_loss)[:, None]*np.ones(shape)
+		self.fields['SS_loss'] = grid.at_node['SS_loss']*(self.Kloss/data_in.Kloss)[:, None]
+		Create_parameter_WV(self.fields, self.Kloss[:, None])
+		for field in ['Q_ini', 'AOF', 'Transmission_losses']:
+			self.fields[field] = np.zeros(shape)
+		self.unit_sim_k = data_in.unit_sim_k
+		self.OFL = []
+		print('Ensemble routing: %d members' % self.members)
+	
+	def run_runoff_one_step(self, aof, env_state):
+		"""Route the runoff of the model step for all members
+		"""
+		runoff = env_state.grid.at_node['runoff']
+		Q_ini = self.fields['Q_ini']
+		if np.any(runoff[env_state.act_nodes] > 0.0) or np.any(Q_ini > 0.0):
+			self.fields['AOF'][:] = aof
+			Q, Qloss = route_flow_levels(self.topology,
+				np.broadcast_to(runoff, Q_ini.shape), TransLossWV_level, self.fields)
+		else:
+			self.fields['Transmission_losses'][:, env_state.river_ids_nodes] = 0.0
+			Q = np.zeros(Q_ini.shape)
+		self.OFL.append(Q[:, env_state.gaugeidOF])
+	
+	def save_point_var(self, fname, time, area):
+		"""Save discharge [mm] of all members at discharge points and
+		the parameters of members
+		"""
+		df = pd.DataFrame()
+		df['Date'] = time
+		data = np.array(self.OFL)
+		for m in range(self.members):
+			for i, iarea in enumerate(area):
+				df['OF_'+str(i)+'_'+str(m)] = data[:, m, i]*1000./iarea
+		fname_out = fname+'Dis_ensemble.csv'
+		os.remove(fname_out) if os.path.exists(fname_out) else None
+		df.to_csv(fname_out, index = False)
+		
+		df = pd.DataFrame()
+		df['Member'] = np.arange(self.members)
+		df['Kloss'] = self.Kloss/self.unit_sim_k
+		df['T_loss'] = self.T_loss
+		df.to_csv(fname+'Dis_ensemble_members.csv', index = False)
+
+# Flow accumulation by topological levels, all nodes of a level are
+# routed at once with a vectorized loss function
+def route_flow_levels(topology, runoff, loss_function, grid, levels=None):
+	# Q:		Discharge at nodes [m3/dt]
+	# Qout:		Discharge leaving nodes after losses [m3/dt]
+	# Qloss:	Discharge lost at nodes [m3/dt]
+	# levels:	Levels to route, all the network if not given
+	# Ensemble members are in the first axis of runoff and channel states
+	if levels is None:
+		levels = topology.levels
+	if not isinstance(grid, node_fields):
+		grid = node_fields(grid)
+	Q = topology.node_cell_area*runoff
+	Qout = np.zeros(Q.shape)
+	Qloss = np.zeros(Q.shape)
+	for level_nodes, flow_nodes, pull in levels:
+		for rcv, don in pull:
+			Q[..., rcv] += Qout[..., don]
+		if len(flow_nodes) > 0:
+			Qout[..., flow_nodes] = np.clip(loss_function(Q[..., flow_nodes],
+				flow_nodes, grid), 0.0, np.inf)
+			Qloss[..., flow_nodes] = Q[..., flow_nodes] - Qout[..., flow_nodes]
+	return Q, Qloss
+
+class linear_routing(object):
+	"""Routing operator of the flow network when transmission losses are
+	not active: discharge only decays along river nodes (exp_decay_wp),
+	so flow accumulation is the lower triangular linear system
+		(I - C*A)*Q = q + C*d
+	C:	Donor to receiver connectivity
+	A:	Fraction of the discharge leaving nodes
+	d:	Water in the channel minus abstractions leaving river nodes
+	It is factorized once, nodes are sorted from upstream to downstream.
+	Parameters:
+		topology:		Flow network (DRYP_flow_topology)
+		river_nodes:	River nodes with a receiver
+		decay_flow:		Decay flow parameter at nodes
+	"""
+	def __init__(self, topology, river_nodes, decay_flow):
+		r = topology.receivers
+		n = len(r)
+		flowing = np.where(r != np.arange(n))[0]
+		self.flowing = flowing
+		self.river_nodes = river_nodes
+		self.k = np.array(decay_flow[river_nodes])
+		self.fout = 1-np.exp(-self.k)
+		fout = np.ones(n)
+		fout[river_nodes] = self.fout
+		self.C = sparse.csr_matrix((np.ones(len(flowing)), (r[flowing], flowing)),
+			shape=(n, n))
+		self.order = topology.stack[::-1]
+		M = (sparse.identity(n, format='csr') - self.C @ sparse.diags(fout)).tocsr()
+		self.lu = splu(M[self.order][:, self.order].tocsc(),
+			permc_spec='NATURAL', diag_pivot_thresh=0.0)
+
+	def route(self, q, grid):
+		"""Discharge and discharge loss at nodes, None if abstractions
+		are limited by the available water
+		Parameters:
+			q:		Local runoff [m3/dt]
+			grid:	Landlab grid
+		"""
+		nodes = self.river_nodes
+		Q_ini = grid.at_node['Q_ini'][nodes]
+		AOF = grid.at_node['AOF'][nodes]
+		d = np.zeros(len(q))
+		d[nodes] = self.fout*(Q_ini-AOF)
+		
+		Q = np.zeros(len(q))
+		Q[self.order] = self.lu.solve((q + self.C @ d)[self.order])
+		
+		Qin = Q[nodes]+Q_ini
+		if np.any((Qin <= AOF) & (AOF > 0.0)):
+			return None
+		# abstractions
+		abst = Qin <= AOF
+		AOF[abst] = grid.at_node['AOFT'][nodes[abst]]*Qin[abst]
+		grid.at_node['AOF'][nodes] = AOF
+		Qin += -AOF
+		
+		wet = Qin > 0.0
+		Qout_riv, Qo = exp_decay_wp(Qin, self.k)
+		Qout = np.array(Q)
+		Qout[nodes[wet]] = Qout_riv[wet]
+		grid.at_node['Q_ini'][nodes] = np.where(wet, Qo, 0.0)
+		grid.at_node['Transmission_losses'][nodes] = 0.0
+		
+		Qloss = np.zeros(len(q))
+		Qloss[self.flowing] = Q[self.flowing]-Qout[self.flowing]
+		return Q, Qloss
+
+class node_fields(dict):
+	"""Grid proxy keeping the node field arrays used by loss functions,
+	landlab field lookups are slow compared to the operations on levels
+	with few nodes
+	"""
+	def __init__(self, grid):
+		self.grid = grid
+		self.at_node = self
+
+	def __missing__(self, name):
+		self[name] = self.grid.at_node[name]
+		return self[name]
 # ===================================================================
 # Transmission losses functions
 # Exponential decay parameters
@@ -186,6 +508,59 @@ def TransLossWV1(Qw, nodeID, linkID, grid):
 					
 	return Qout
 
+# Transmission losses function for the nodes of a routing level
+def TransLossWV_level(Qw, nodes, grid):
+	# Qw:		Discharge at nodes [m3/dt], ensemble members in the
+	#			first axis when channel states have members
+	# nodes:	Node IDs
+	Qout = np.array(Qw)
+	riv = np.where(grid.at_node['river'][nodes] != 0)[0]
+	if len(riv) == 0:
+		return Qout
+	nodeID = nodes[riv]
+	Qin = Qw[..., riv]+grid.at_node['Q_ini'][..., nodeID]
+	shape = Qin.shape
+	# abstractions
+	AOF = grid.at_node['AOF'][..., nodeID]
+	abst = Qin <= AOF
+	AOF[abst] = np.broadcast_to(grid.at_node['AOFT'][nodeID], shape)[abst]*Qin[abst]
+	grid.at_node['AOF'][..., nodeID] = AOF
+	Qin += -AOF
+	
+	wet = Qin > 0.0
+	Qin = Qin[wet]
+	rsd = np.broadcast_to(grid.at_node['riv_sat_deficit'][nodeID], shape)[wet]
+	k = np.broadcast_to(grid.at_node['decay_flow'][..., nodeID], shape)[wet]
+	
+	Qout_riv, Qo = exp_decay_wp(Qin, k)
+	TL = np.zeros(len(Qin))
+	
+	loss = rsd > 0.0
+	Qout_loss, TL_loss, Qo_loss = exp_decay_loss_wp_level(
+		np.broadcast_to(grid.at_node['SS_loss'][..., nodeID], shape)[wet][loss],
+		Qin[loss], k[loss],
+		np.broadcast_to(grid.at_node['par_3'][..., nodeID], shape)[wet][loss],
+		np.broadcast_to(grid.at_node['par_4'][..., nodeID], shape)[wet][loss])
+	
+	over = TL_loss > rsd[loss]
+	Qo_loss[over] += TL_loss[over]-rsd[loss][over]
+	TL_loss[over] = rsd[loss][over]
+	
+	Qout_riv[loss] = Qout_loss
+	Qo[loss] = Qo_loss
+	TL[loss] = TL_loss
+	
+	Q_ini = np.zeros(shape)
+	Q_ini[wet] = Qo
+	grid.at_node['Q_ini'][..., nodeID] = Q_ini
+	TL_riv = np.zeros(shape)
+	TL_riv[wet] = TL
+	grid.at_node['Transmission_losses'][..., nodeID] = TL_riv
+	Qout_wet = Qw[..., riv]
+	Qout_wet[wet] = Qout_riv
+	Qout[..., riv] = Qout_wet
+	return Qout
+
 def exp_decay_loss_wp(TL,Qin,k,P3,P4):
 
 	Qout, Qo = 0, 0	
@@ -208,6 +583,17 @@ def exp_decay_loss_wp(TL,Qin,k,P3,P4):
 		
 	return Qout, Qtl, Qo
 
+# Vectorized exp_decay_loss_wp
+def exp_decay_loss_wp_level(TL,Qin,k,P3,P4):
+	t = -(1/k)*np.log(P3/(Qin*k))
+	t = np.where(t > 1, 1, t)
+	Q1 = Qin*(1-np.exp(-k*t))
+	Qtl = Qin*k*P4*(1-np.exp(-k*t))+TL*t
+	Qout = np.where(t > 0, Q1-Qtl, 0.0)
+	Qo = np.where(t >= 1, Qin-Q1, 0.0)
+	Qtl = np.where(t >= 1, Qtl, Qin-Qout)
+	return Qout, Qtl, Qo
+
 def exp_decay_wp(Qin,k):
 	Qout = Qin*(1-np.exp(-k))
 	Qo = Qin-Qout
@@ -285,6 +671,79 @@ def Newthon_R_Manning(qo,k,iloss,D,n3_5,t0):
 
 	return t
 
+# Transmission losses function for the nodes of a routing level
+# Manning with exponential recesion
+def TranslossManning_level(Qw, nodes, grid, stats=None):
+	# Qw:		Discharge at nodes [m3/dt]
+	# nodes:	Node IDs
+	# stats:	Newton iteration counters, updated if given
+	Qout = np.array(Qw)
+	riv = np.where(grid.at_node['river'][nodes] != 0)[0]
+	if len(riv) == 0:
+		return Qout
+	nodeID = nodes[riv]
+	D = 1.0
+	k = grid.at_node['decay_flow'][nodeID]
+	iloss = grid.at_node['SS_loss'][nodeID]
+	par_m = grid.at_node['par_m'][nodeID]
+	qo = (Qw[riv]+grid.at_node['Q_ini'][nodeID])*k
+	
+	t = np.zeros(len(riv))
+	act = qo > iloss
+	if np.any(act):
+		t[act] = Newthon_R_Manning_level(qo[act], k[act], iloss[act], D,
+			par_m[act], 0.01, stats=stats)
+	
+	TL = iloss*t+(5/3)*(par_m/k)*(qo**(3/5))*(1-np.exp(-3/5*k*t))
+	Q = (qo/k)*(1-np.exp(-k*t))
+	Qout_riv = Q-TL
+	
+	# flow does not last the whole time step
+	part = t < 1.0
+	Qout_riv[part] = 0.0
+	TL[part] = qo[part]/k[part]-Qout_riv[part]
+	grid.at_node['Q_ini'][nodeID] = np.where(part, 0.0, (qo/k)-Qout_riv-TL)
+	grid.at_node['Transmission_losses'][nodeID] = TL
+	Qout[riv] = Qout_riv
+	return Qout
+
+def Newthon_R_Manning_level(qo,k,iloss,D,n3_5,t0,max_iter=50,stats=None):
+	"""Newthon_R_Manning for arrays of nodes, only nodes that have not
+	converged are iterated, up to max_iter iterations. Iterations are
+	added to the counters of stats if given.
+	"""
+	t = np.full(len(qo), t0, dtype=float)
+	act = np.arange(len(qo))
+	niter = 0
+	iterations = 0
+	while len(act) > 0 and niter < max_iter:
+		t0 = t[act]
+		t[act] = t0-(fmaning(qo[act],k[act],iloss[act],D,n3_5[act],t0)
+			/ dfmanning(qo[act],k[act],iloss[act],D,n3_5[act],t0))
+		error = np.abs((t[act]-t0)/t[act])
+		iterations += len(act)
+		act = act[error > 0.001]
+		niter += 1
+	if stats is not None:
+		stats['nodes'] += len(qo)
+		stats['iterations'] += iterations
+		stats['max_iterations'] = max(stats['max_iterations'], niter)
+		stats['not_converged'] += len(act)
+	# it means greather than the time step
+	t[t > 1.0] = 1.0
+	t[t < 0] = 0.0
+	return t
+
+def print_manning_stats(stats):
+	"""Newton iterations of the Manning losses of the last step
+	"""
+	if stats['nodes'] > 0:
+		print('Manning losses: %d nodes, %.1f mean and %d max iterations, %d not converged'
+			% (stats['nodes'],
+			stats['iterations']/stats['nodes'],
+			stats['max_iterations'],
+			stats['not_converged']))
+
 # Transmission losses functions - Constant loss
 def TransLoss(Qw, nodeID, linkID, grid):	
 	Qout = Qw	
@@ -0,0 +1,103 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+# Compiled routing kernel, build it with (inside components):
+#	python setup.py build_ext --inplace
+from libc.math cimport exp, log
+
+cpdef void route_stack_wv(const long long[::1] stack,
+		const long long[::1] receivers,
+		const double[::1] node_cell_area,
+		const double[::1] runoff,
+		const long long[::1] river,
+		double[::1] Q_ini,
+		double[::1] AOF,
+		const double[::1] AOFT,
+		const double[::1] riv_sat_deficit,
+		const double[::1] SS_loss,
+		const double[::1] decay_flow,
+		const double[::1] par_3,
+		const double[::1] par_4,
+		double[::1] TL,
+		double[::1] Q,
+		double[::1] Qloss) noexcept nogil:
+	"""Flow accumulation with exponential decay transmission losses
+	(TransLossWV) over the upstream node order (or part of it).
+	Q_ini, AOF and TL are updated in place, Q and Qloss are the discharge
+	and discharge loss at nodes.
+	"""
+	cdef Py_ssize_t i
+	cdef long long donor, recvr
+	cdef double Qout
+
+	for i in range(Q.shape[0]):
+		Q[i] = node_cell_area[i]*runoff[i]
+		Qloss[i] = 0.0
+
+	# Iterate from upstream to downstream
+	for i in range(stack.shape[0]-1, -1, -1):
+		donor = stack[i]
+		recvr = receivers[donor]
+		if donor != recvr:
+			Qout = trans_loss_wv(Q[donor], donor, river, Q_ini, AOF, AOFT,
+				riv_sat_deficit, SS_loss, decay_flow, par_3, par_4, TL)
+			if Qout < 0.0:
+				Qout = 0.0
+			Qloss[donor] = Q[donor]-Qout
+			Q[recvr] += Qout
+
+cdef inline double trans_loss_wv(double Qw, long long nodeID,
+		const long long[::1] river,
+		double[::1] Q_ini,
+		double[::1] AOF,
+		const double[::1] AOFT,
+		const double[::1] riv_sat_deficit,
+		const double[::1] SS_loss,
+		const double[::1] decay_flow,
+		const double[::1] par_3,
+		const double[::1] par_4,
+		double[::1] TL) noexcept nogil:
+	cdef double Qout = Qw
+	cdef double Qin, Qo, Q1, Qtl, t, k, rsd
+
+	if river[nodeID] != 0:
+		Qin = Qw+Q_ini[nodeID]
+		# abstractions
+		if Qin <= AOF[nodeID]:
+			AOF[nodeID] = AOFT[nodeID]*Qin
+		Qin += -AOF[nodeID]
+
+		Q_ini[nodeID] = 0
+		TL[nodeID] = 0
+
+		if Qin > 0.0:
+			k = decay_flow[nodeID]
+			rsd = riv_sat_deficit[nodeID]
+			if rsd <= 0.0:
+				# exp_decay_wp
+				Qout = Qin*(1-exp(-k))
+				Qo = Qin-Qout
+				Qtl = 0
+			else:
+				# exp_decay_loss_wp
+				Qout, Qo, Q1 = 0, 0, 0
+				Qtl = 0
+				t = -(1/k)*log(par_3[nodeID]/(Qin*k))
+				if t > 0:
+					if t > 1:
+						t = 1
+					Q1 = Qin*(1-exp(-k*t))
+					Qtl = Qin*k*par_4[nodeID]*(1-exp(-k*t))+SS_loss[nodeID]*t
+					Qout = Q1-Qtl
+				if t >= 1:
+					Qo = Qin-Q1
+				else:
+					Qo = 0.0
+					Qtl = Qin-Qout
+
+				if Qtl > rsd:
+					Qo += Qtl-rsd
+					Qtl = rsd
+
+			Q_ini[nodeID] = Qo
+			TL[nodeID] = Qtl
+
+	return Qout
@@ -1,4 +1,9 @@
 import numpy as np
+try:
+	# compiled soil water balance kernel (numba)
+	from components.DRYP_column_kernel import swbm_jit
+except ImportError:
+	swbm_jit = None
 
 class swbm(object):
 
@@ -15,6 +20,21 @@ class swbm(object):
 		self.WRSI = np.zeros(env_state.grid_size)
 		self.Duz = env_state.Duz		
 		self.L_0 = env_state.Duz*self.tht_dt
+		# Dry spells are only computed by the python soil water balance
+		self.column_kernel = int(data_in.column_kernel and swbm_jit is not None
+			and not data_in.dry_spell)
+		# Rain-gated soil water balance, cells without infiltration and
+		# below field capacity only lose evapotranspiration (SWBM_dry)
+		self.sparse = data_in.sparse_soil
+		if self.column_kernel:
+			self.sparse = 0
+		# Dry spells, AET and water content of cells without infiltration
+		# below field capacity are computed for the whole spell at its
+		# first step (SWBM_dry_spell)
+		self.dry_spell = data_in.dry_spell
+		self.spell_left = 0
+		self.spell_nodes = np.array([], dtype=int)
+		self.in_spell = np.zeros(env_state.grid_size, dtype=bool)
 	
 	def run_soil_aquifer_one_step(self, env_state, sur_elev, wt_elev, Duz0, tht_dt):
 		"""	Update depth of the unsaturated soil depending on the
@@ -39,17 +59,52 @@ class swbm(object):
 		self.L_0 = tht*Duz
 		self.Duz = Duz
 			
-	def run_swbm_one_step(self, inf, pet, Kc, Ksat, env_state, data_in, *nodes):
+	def run_swbm_one_step(self, inf, pet, Kc, Ksat, env_state, data_in, *nodes, dry_steps=1, dry_pet=None):
 		"""Run soil water balance
+		dry_steps:	Time steps without precipitation from this step
+		dry_pet:	Uniform PET of the dry_steps (constant if not given)
 		"""
 		if nodes:		
 			act_nodes = nodes[0]		
 		else:		
 			act_nodes = env_state.act_nodes
+		
+		if self.column_kernel:
+			self.sro_dt *= 0.0
+			self.pcl_dt *= 0.0
+			swbm_jit(int(data_in.dt >= 1440),
+				np.ascontiguousarray(act_nodes, dtype=np.int64),
+				np.asarray(inf, dtype=float), np.asarray(pet, dtype=float),
+				Kc, Ksat, self.L_0, self.Duz,
+				env_state.grid.at_node['saturated_water_content'],
+				env_state.fc, env_state.grid.at_node['wilting_point'],
+				env_state.c_SOIL, self.aet_dt, self.pcl_dt, self.tht_dt,
+				self.sro_dt, self.WRSI)
+			self.gwe_dt = pet - self.aet_dt
+			return
+		
 		nodes_aux = np.where(env_state.Duz[act_nodes] > 0.0)[0]		
 		act_nodes = act_nodes[nodes_aux]
 		del nodes_aux #to reduce memory use
 		
+		if self.dry_spell:
+			act_nodes = self.run_dry_spell(inf, pet, Kc, env_state, act_nodes,
+				dry_steps, dry_pet)
+		
+		if self.sparse:
+			wet = ((inf[act_nodes] != 0.0)
+				| (self.L_0[act_nodes] > self.Duz[act_nodes]*env_state.fc[act_nodes]))
+			dry = act_nodes[~wet]
+			act_nodes = act_nodes[wet]
+			AET, L = SWBM_dry(pet[dry], Kc[dry], self.L_0[dry], self.Duz[dry],
+				env_state.fc[dry], env_state.grid.at_node['wilting_point'][dry])
+			self.aet_dt[dry] = AET
+			self.tht_dt[dry] = L/self.Duz[dry]
+			WSRI = np.zeros(len(dry))
+			WSRI[pet[dry] != 0] = AET[pet[dry] != 0]/pet[dry][pet[dry] != 0]
+			self.WRSI[dry] = WSRI
+			self.L_0[dry] = L
+		
 		inf_dt = inf[act_nodes]		
 		Kc = Kc[act_nodes]		
 		Ks = Ksat[act_nodes]		
@@ -80,6 +135,60 @@ class swbm(object):
 		self.gwe_dt = pet - self.aet_dt		
 		self.L_0[act_nodes] = np.array(L)
 	
+	def run_dry_spell(self, inf, pet, Kc, env_state, act_nodes, dry_steps, dry_pet=None):
+		"""Soil water balance of cells in a dry spell, without infiltration
+		and below field capacity. AET and water content of all steps of
+		the spell are computed at its first step (SWBM_dry_spell), with
+		the uniform PET of steps (dry_pet, constant PET if not given).
+		Cells leave the spell if they get infiltration or the soil depth
+		changes.
+		Returns active nodes out of the spell
+		"""
+		if self.spell_left > 0:
+			keep = ((inf[self.spell_nodes] == 0.0)
+				& (self.Duz[self.spell_nodes] == self.spell_Duz))
+			if not np.all(keep):
+				self.in_spell[self.spell_nodes[~keep]] = False
+				self.spell_nodes = self.spell_nodes[keep]
+				self.spell_Duz = self.spell_Duz[keep]
+				self.spell_aet = self.spell_aet[:, keep]
+				self.spell_L = self.spell_L[:, keep]
+			self.spell_left -= 1
+		elif dry_steps > 1:
+			L0 = self.L_0[act_nodes]
+			Lfc = self.Duz[act_nodes]*env_state.fc[act_nodes]
+			Lwp = self.Duz[act_nodes]*env_state.grid.at_node['wilting_point'][act_nodes]
+			# PET of cells is Kc times the uniform PET of steps
+			if dry_pet is None:
+				Kc_pet = Kc[act_nodes]*pet[act_nodes]
+				dry_pet = np.ones(dry_steps)
+			else:
+				Kc_pet = np.array(Kc[act_nodes])
+			dry = ((inf[act_nodes] == 0.0) & (L0 <= Lfc) & (L0 >= Lwp)
+				& (Kc_pet >= 0.0) & (Lfc > Lwp))
+			self.spell_nodes = act_nodes[dry]
+			self.spell_Duz = np.array(self.Duz[self.spell_nodes])
+			self.spell_aet, self.spell_L = SWBM_dry_spell(dry_pet, Kc_pet[dry],
+				L0[dry], self.spell_Duz, env_state.fc[self.spell_nodes],
+				env_state.grid.at_node['wilting_point'][self.spell_nodes])
+			self.spell_left = dry_steps-1
+			self.in_spell[:] = False
+			self.in_spell[self.spell_nodes] = True
+		else:
+			return act_nodes
+		
+		nodes = self.spell_nodes
+		k = len(self.spell_L)-1-self.spell_left
+		AET = self.spell_aet[k]
+		self.L_0[nodes] = self.spell_L[k]
+		self.aet_dt[nodes] = AET
+		self.tht_dt[nodes] = self.L_0[nodes]/self.Duz[nodes]
+		WSRI = np.zeros(len(nodes))
+		PET = pet[nodes]
+		WSRI[PET != 0] = AET[PET != 0]/PET[PET != 0]
+		self.WRSI[nodes] = WSRI
+		return act_nodes[~self.in_spell[act_nodes]]
+	
 	def run_swb_lat_flow_one_step(self, env_state_soil, env_state_rip):
 		""" This function estimate lateral flow in river cell, it is
 		assumed that channel width is less than river cell size
@@ -221,6 +330,36 @@ def SWBMh(I, PET, Kc, L0, SMD_0, z_soil, fs, fc, wp, c, Ksat):
 	SMD = np.where(L < Lfc, SMD_0+AET-I, 0)	
 	return AET, SMD, D, L, RO
 
+# Soil water balance without infiltration below field capacity, there
+# is no drainage and runoff, it gives the same AET and L as SWBM and SWBMh
+def SWBM_dry(PET, Kc, L0, z_soil, fc, wp):
+	PET = Kc*PET
+	Lwp = z_soil*wp
+	Lfc = z_soil*fc
+	TAW = Lfc - Lwp
+	L_RAW = Lfc - 0.5*TAW
+	L_TAW = Lfc - TAW
+	beta = (L0-L_TAW) / (L_RAW-L_TAW)
+	beta[beta > 1] = 1
+	beta[beta < 0] = 0
+	I_AET = np.where(0.0 > PET, PET, 0.0)
+	AET = I_AET*(1-beta)+beta*PET
+	AET[AET < 0] = 0
+	L_aux = L0-AET
+	AET = np.where((L_aux-Lwp) < 0, L0-Lwp, AET)
+	L = L0-AET
+	return AET, L
+
+# AET and water content of each step of a dry spell (SWBM_dry), PET
+# is Kc*pet_steps[k] at step k
+def SWBM_dry_spell(pet_steps, Kc, L0, z_soil, fc, wp):
+	AET = np.zeros((len(pet_steps), len(L0)))
+	L = np.zeros((len(pet_steps), len(L0)))
+	for k, pet_k in enumerate(pet_steps):
+		AET[k], L[k] = SWBM_dry(pet_k, Kc, L0, z_soil, fc, wp)
+		L0 = L[k]
+	return AET, L
+
 # Variable soil depth
 def variable_soil_depth(z, h, Droot):
 	# Luz	: Soil depth variation
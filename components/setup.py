@@ -1,2 +1,22 @@
-import setuptools  # importantfrom distutils.core import setupfrom Cython.Build import cythonizesetup(ext_modules=cythonize("TransLoss.pyx", build_dir="build"),                                           script_args=['build'],                                            options={'build':{'build_lib':'.'}})
-#setup(#ext_modules = cythonize('TransLoss.pyx')#)
+# Build the compiled DRYP kernels, run inside the components folder:
+#	python setup.py build_ext --inplace
+# Requires Cython, numpy and a C compiler (e.g. gcc on linux).
+# The model falls back to the python routing if the kernel is not built.
+import sys
+import numpy as np
+from setuptools import setup, Extension
+from Cython.Build import cythonize
+
+extensions = [
+	Extension('DRYP_routing_kernel', ['DRYP_routing_kernel.pyx'],
+		include_dirs=[np.get_include()],
+		extra_compile_args=[] if sys.platform.startswith('win') else ['-O3']),
+	Extension('TransLoss', ['TransLoss.pyx'],
+		include_dirs=[np.get_include()]),
+	]
+
+setup(
+	name='DRYP_kernels',
+	ext_modules=cythonize(extensions, build_dir='build',
+		compiler_directives={'language_level': 3}),
+	)
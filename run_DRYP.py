@@ -3,15 +3,17 @@
 DRYP: Dryland WAter Partitioning Model
 """
 import numpy as np
-from components.DRYP_io import inputfile, model_environment_status
+from components.DRYP_io import inputfile, model_environment_status, steady_state_recharge
 from components.DRYP_infiltration import infiltration
 from components.DRYP_rainfall import rainfall
 from components.DRYP_ABM_connector import ABMconnector
-from components.DRYP_routing import runoff_routing
+from components.DRYP_routing import runoff_routing, runoff_routing_ensemble
 from components.DRYP_soil_layer import swbm
 from components.DRYP_groundwater_EFD import gwflow_EFD, storage_uz_sz
+from components.DRYP_groundwater_coarse import gwflow_coarse
 from components.DRYP_Gen_Func import (GlobalTimeVarPts, GlobalTimeVarAvg, GlobalGridVar,
 									  save_map_to_rastergrid, check_mass_balance)
+from timing import perf
 # Ignore division by zero and invalid value warnings globally
 np.seterr(divide='ignore', invalid='ignore')
 
@@ -30,6 +32,8 @@ def run_DRYP(filename_input):
 
 	data_in = inputfile(filename_input)
 	daily = 1
+	if data_in.instrumentation == 1:
+		perf.enable()
 	# setting model fluxes and state variables
 	env_state = model_environment_status(data_in)
 	env_state.set_output_dir(data_in)
@@ -42,7 +46,31 @@ def run_DRYP(filename_input):
 	swb = swbm(env_state, data_in)
 	swb_rip = swbm(env_state, data_in)
 	ro = runoff_routing(env_state, data_in)
-	gw = gwflow_EFD(env_state, data_in)
+	ro_ens = None
+	if data_in.ensemble_routing == 1:
+		ro_ens = runoff_routing_ensemble(env_state, data_in)
+	if data_in.gw_coarse_factor > 1:
+		gw = gwflow_coarse(env_state, data_in)
+	else:
+		gw = gwflow_EFD(env_state, data_in)
+	
+	# Steady-state groundwater spin-up, equilibrium heads are saved as an
+	# initial water table
+	if data_in.gw_steady_state > 0:
+		t_perf = perf.tic()
+		gw.steady_state(env_state, steady_state_recharge(data_in, env_state))
+		perf.toc('groundwater steady state', t_perf)
+		fname_out = env_state.fnameTS_avg + '_wte_steady.asc'
+		save_map_to_rastergrid(env_state.SZgrid, 'water_table__elevation', fname_out)
+		print('Steady-state water table saved: ' + fname_out)
+		if data_in.gw_steady_state == 2:
+			gw.close()
+			perf.report(env_state.fnameTS_avg + '_timing.json')
+			return
+	
+	# Deep groundwater layer, initial heads are the water table
+	if data_in.gw_deep_layer[0] > 0:
+		gw.add_second_layer_gw(env_state, *data_in.gw_deep_layer[:4])
 	
 	# Output variables and location
 	outavg = GlobalTimeVarAvg(env_state.area_catch_factor)
@@ -79,15 +107,19 @@ def run_DRYP(filename_input):
 				print('t = ', t, 'UZ_ti = ', UZ_ti, 'dt_pre_sub = ', dt_pre_sub)
 				# PRINT THE TIME STEPS
 
+				t_perf = perf.tic()
 				swb.run_soil_aquifer_one_step(env_state,
 					env_state.grid.at_node['topographic__elevation'],
 					env_state.SZgrid.at_node['water_table__elevation'],
 					env_state.Duz,
 					swb.tht_dt)
+				perf.toc('soil-aquifer', t_perf)
 															
 				env_state.Duz = swb.Duz
 				
+				t_perf = perf.tic()
 				rf.run_rainfall_one_step(t_pre, t_eto, env_state, data_in)
+				perf.toc('rainfall', t_perf)
 				
 				abc.run_ABM_one_step(t_pre, env_state,
 					rf.rain, env_state.Duz, swb.tht_dt, env_state.fc,
@@ -96,24 +128,50 @@ def run_DRYP(filename_input):
 					
 				rf.rain += abc.auz
 				
-				inf.run_infiltration_one_step(rf, env_state, data_in)
+				# Steps without precipitation from this step (dry spells)
+				dry_steps = 1
+				dry_pet = None
+				if rf.dry_steps is not None:
+					dry_steps = rf.dry_steps[t_pre]
+					if rf.dry_pet is not None:
+						dry_pet = rf.dry_pet[t_pre:t_pre+dry_steps]
 				
 				aux_usz = np.sum((swb.L_0*env_state.hill_factor)[env_state.act_nodes])
 				aux_usp = np.sum((swb_rip.L_0*env_state.riv_factor)[env_state.act_nodes])
 				
-				swb.run_swbm_one_step(inf.inf_dt, rf.PET, env_state.Kc,
-					env_state.grid.at_node['Ksat_soil'], env_state, data_in)
+				if inf.column_kernel:
+					t_perf = perf.tic()
+					inf.run_column_one_step(rf, swb, env_state, data_in)
+					perf.toc('infiltration-SWBM', t_perf)
+				else:
+					t_perf = perf.tic()
+					inf.run_infiltration_one_step(rf, env_state, data_in)
+					perf.toc('infiltration', t_perf)
+					
+					t_perf = perf.tic()
+					swb.run_swbm_one_step(inf.inf_dt, rf.PET, env_state.Kc,
+						env_state.grid.at_node['Ksat_soil'], env_state, data_in,
+						dry_steps=dry_steps, dry_pet=dry_pet)
+					perf.toc('SWBM', t_perf)
 				
 				env_state.grid.at_node['riv_sat_deficit'][:] *= (swb_rip.tht_dt)
 				
+				t_perf = perf.tic()
 				ro.run_runoff_one_step(inf, swb, abc.aof, env_state, data_in)
+				perf.toc('routing', t_perf)
+				if ro_ens is not None:
+					t_perf = perf.tic()
+					ro_ens.run_runoff_one_step(abc.aof, env_state)
+					perf.toc('ensemble routing', t_perf)
 				
 				tls_aux = ro.tls_flow_dt*env_state.rip_factor
 				
 				rip_inf_dt = inf.inf_dt + tls_aux
+				t_perf = perf.tic()
 				swb_rip.run_swbm_one_step(rip_inf_dt, rf.PET, env_state.Kc,
 						env_state.grid.at_node['Ksat_ch'], env_state,
-						data_in, env_state.river_ids_nodes)
+						data_in, env_state.river_ids_nodes, dry_steps=dry_steps, dry_pet=dry_pet)
+				perf.toc('SWBM riparian', t_perf)
 						
 				swb_rip.pcl_dt *= env_state.riv_factor
 				swb_rip.aet_dt *= env_state.riv_factor
@@ -141,18 +199,22 @@ def run_DRYP(filename_input):
 					# Change units to m/h
 					env_state.SZgrid.at_node['discharge'][:] = 0.0
 					env_state.SZgrid.at_node['recharge'][:] = (rch_agg - etg_agg)*0.001 #[mm/dt]
+					t_perf = perf.tic()
 					gw.run_one_step_gw(env_state, data_in.dtSZ/60, swb.tht_dt,
 						env_state.Droot*0.001)
+					perf.toc('groundwater', t_perf)
 					rch_agg = np.zeros(len(swb.L_0))
 					etg_agg = np.zeros(len(swb.L_0))
 					dt_GW = 0
 					
 				dt_GW += np.int(data_in.dt)				
 				
-				gws_mb.append(storage_uz_sz(env_state, np.array(swb.tht_dt), gw.dh))#-aux_ssz)
+				gws_mb.append(storage_uz_sz(env_state, np.array(swb.tht_dt), gw.dh)
+					+ gw.deep_storage_change)#-aux_ssz)
 				dis_mb.append(np.sum(env_state.SZgrid.at_node['discharge'][env_state.act_nodes])-gw.flux_out)
 
 				#Extract average state and fluxes				
+				t_perf = perf.tic()
 				outavg.extract_avg_var_pre(env_state.basin_nodes,rf)				
 				outavg.extract_avg_var_UZ_inf(env_state.basin_nodes,inf)
 				outavg.extract_avg_var_UZ_swb(env_state.basin_nodes,swb)
@@ -165,10 +227,13 @@ def run_DRYP(filename_input):
 				outpts.extract_point_var_UZ_swb(env_state.gaugeidUZ,swb)
 				outpts.extract_point_var_OF(env_state.gaugeidOF,ro)
 				outpts.extract_point_var_SZ(env_state.gaugeidGW,gw)
+				if gw.layers == 2:
+					outpts.extract_point_var_SZ_L2(env_state.gaugeidGW, env_state.SZgrid)
 				state_var.get_env_state(t_pre, rf, inf, swb,
 									ro, gw, swb_rip, env_state)
 				
 				env_state.L_0 = np.array(swb.L_0)
+				perf.toc('outputs', t_perf)
 
 				t_pre += 1
 
@@ -176,6 +241,9 @@ def run_DRYP(filename_input):
 
 		t += 1
 	
+	# Stop groundwater worker processes
+	gw.close()
+	
 	mb = [pre_mb, exs_mb, tls_mb, rch_mb, gws_mb,
 		uzs_mb, dis_mb, aet_mb, egw_mb]
 	
@@ -184,6 +252,9 @@ def run_DRYP(filename_input):
 	outpts.save_point_var(env_state.fnameTS_OF, rf.date_sim_dt,
 			ro.carea[env_state.gaugeidOF],
 			env_state.rarea[env_state.gaugeidOF])	
+	if ro_ens is not None:
+		ro_ens.save_point_var(env_state.fnameTS_OF, rf.date_sim_dt,
+			ro.carea[env_state.gaugeidOF])
 	state_var.save_netCDF_var(env_state.fnameTS_avg+'.nc')
 	check_mass_balance(env_state.fnameTS_avg, outavg, outpts,
 			outavg_rip, mb, rf.date_sim_dt,
@@ -193,5 +264,11 @@ def run_DRYP(filename_input):
 	fname_out = env_state.fnameTS_avg + '_wte_ini.asc'	
 	save_map_to_rastergrid(env_state.SZgrid, 'water_table__elevation', fname_out)
 	
+	# Groundwater sub-steps and map of Courant limiting nodes
+	gw.save_telemetry(env_state.fnameTS_avg)
+	
+	# Component timings and counters
+	perf.report(env_state.fnameTS_avg + '_timing.json')
+	
 if __name__ == '__main__':
 	run_DRYP(filename_input)
\ No newline at end of file
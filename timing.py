@@ -1,5 +1,6 @@
 # Import modules:
 import time
+import json
 import atexit
 import threading
 from itertools import cycle
@@ -120,4 +121,122 @@ class script_timer:
         time_str = f"{str(int(hours)).zfill(2)}:{str(int(minutes)).zfill(2)}:{str(int(seconds)).zfill(2)}"
         # Print the runtime:
         print(colored(f"\nTOTAL RUNTIME ▶   {time_str}", 'cyan', attrs=['bold']))
-        print('==========================================================================================')
\ No newline at end of file
+        print('==========================================================================================')
+
+
+# Define the instrumentation class:
+class instrumentation:
+
+    """
+    Registry of timers and counters of model components. Timers use
+    `time.perf_counter_ns` and count the calls of each component, when
+    the registry is disabled `tic` and `toc` return immediately.
+
+    Attributes:
+    ----------
+    enabled : bool
+        Whether timings and counters are recorded.
+    timers : dict
+        Total time [ns] and number of calls of each component.
+    counters : dict
+        Counters of each component (e.g. iterations, sub-steps).
+    start_time : int
+        The time at which the registry was enabled [ns].
+
+    Methods:
+    -------
+    enable()
+        Starts recording timings and counters.
+    tic()
+        Returns the current time [ns], or 0 if disabled.
+    toc(name, start)
+        Adds the time elapsed since `start` to the timer `name`.
+    count(name, value)
+        Adds `value` to the counter `name`.
+    summary()
+        Returns the timers and counters as a dictionary.
+    report(fname)
+        Prints the summary table and saves it as JSON.
+    """
+
+    # Initialize the class:
+    def __init__(self):
+        # Disabled until requested:
+        self.enabled = False
+        # Initialize the timers and counters:
+        self.timers = {}
+        self.counters = {}
+        self.start_time = None
+
+    # Function to start recording:
+    def enable(self):
+        self.enabled = True
+        self.timers = {}
+        self.counters = {}
+        self.start_time = time.perf_counter_ns()
+
+    # Function to get the starting time of a block:
+    def tic(self):
+        if not self.enabled:
+            return 0
+        return time.perf_counter_ns()
+
+    # Function to add the elapsed time of a block:
+    def toc(self, name, start):
+        if not self.enabled:
+            return
+        elapsed = time.perf_counter_ns() - start
+        # Get the timer, [total time, calls]:
+        entry = self.timers.get(name)
+        if entry is None:
+            self.timers[name] = [elapsed, 1]
+        else:
+            entry[0] += elapsed
+            entry[1] += 1
+
+    # Function to add to a counter:
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    # Function to get timers and counters:
+    def summary(self):
+        # Total time since the registry was enabled:
+        total = time.perf_counter_ns() - self.start_time
+        timers = {}
+        for name, (elapsed, calls) in self.timers.items():
+            timers[name] = {
+                'calls': calls,
+                'total_s': elapsed*1e-9,
+                'mean_ms': elapsed*1e-6/calls,
+                'percent': 100.0*elapsed/total if total > 0 else 0.0,
+            }
+        return {'total_s': total*1e-9, 'timers': timers,
+                'counters': dict(self.counters)}
+
+    # Function to print and save the summary:
+    def report(self, fname=None):
+        if not self.enabled:
+            return
+        summary = self.summary()
+        # Print the table of timers:
+        print('==========================================================================================')
+        print(f"{'Component':<24}{'Calls':>10}{'Total [s]':>14}{'Mean [ms]':>14}{'%':>9}")
+        for name, entry in sorted(summary['timers'].items(),
+                                  key=lambda item: -item[1]['total_s']):
+            print(f"{name:<24}{entry['calls']:>10}{entry['total_s']:>14.3f}"
+                  f"{entry['mean_ms']:>14.4f}{entry['percent']:>9.2f}")
+        print(f"{'Total':<24}{'':>10}{summary['total_s']:>14.3f}")
+        # Print the counters:
+        for name, value in sorted(summary['counters'].items()):
+            print(f"{name:<48}{value:>14}")
+        print('==========================================================================================')
+        # Save the summary:
+        if fname is not None:
+            with open(fname, 'w') as f:
+                json.dump(summary, f, indent=2)
+
+
+# Instrumentation registry shared by the model components:
+perf = instrumentation()